@@ -0,0 +1,79 @@
+"""
+Compression Benchmark
+
+Weighs the CPU time of compressing customer lists against the bytes it
+saves, for gzip and (when installed) brotli at several levels, and for a
+single customer, which is below COMPRESS_MIN_SIZE and sent as it is.
+Run from the repository root:
+
+    python -m benchmarks.compression --rows 1 100 1000 10000
+"""
+import argparse
+import logging
+import os
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+from benchmarks.serialization import best_of, seed  # noqa: E402
+from service import app, compression  # noqa: E402
+from service.encoding import RowEncoder  # noqa: E402
+from service.models import Customer  # noqa: E402
+
+# (encoding, setting name, levels) to compare
+SETTINGS = [
+    ("gzip", "COMPRESS_LEVEL", (1, 6, 9)),
+    ("br", "COMPRESS_BROTLI_QUALITY", (1, 4, 11)),
+]
+
+
+def run(count, repeat):
+    """ Returns the size and time of every encoding and level for a list of count customers """
+    seed(count)
+    columns = Customer.columns()
+    body = RowEncoder(columns).encode_rows(Customer.page(limit=count, columns=columns).all())
+    results = [("identity", "-", len(body), 0.0)]
+    for encoding, setting, levels in SETTINGS:
+        if encoding == "br" and compression.brotli is None:
+            continue
+        for level in levels:
+            compression.configure(dict(app.config, COMPRESS_ENCODINGS=encoding, **{setting: level}))
+            seconds = best_of(lambda: compression.compress(body, encoding), repeat)
+            size = len(compression.compress(body, encoding))
+            results.append((encoding, level, size, seconds))
+    compression.configure(app.config)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    if compression.brotli is None:
+        print("brotli is not installed: only gzip is compared")
+    print(
+        "{:>8}  {:<9}{:>6}{:>12}{:>8}{:>12}{:>10}".format(
+            "rows", "encoding", "level", "bytes", "ratio", "ms", "MB/s"
+        )
+    )
+    for count in args.rows:
+        results = run(count, args.repeat)
+        plain = results[0][2]
+        for encoding, level, size, seconds in results:
+            print(
+                "{:>8}  {:<9}{:>6}{:>12}{:>8.1f}{:>12.3f}{:>10}".format(
+                    count,
+                    encoding,
+                    level,
+                    size,
+                    plain / size,
+                    seconds * 1000,
+                    "{:.0f}".format(plain / seconds / 1e6) if seconds else "-",
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Load Generator
+
+Starts the service under gunicorn and drives it with concurrent HTTP
+clients, reporting throughput and latency percentiles. Run from the
+repository root, e.g. to compare the serving modes:
+
+    python -m benchmarks.load --worker-class sync gthread gevent
+
+DATABASE_URI selects the database, which gets --seed more customers
+before the run. The customer cache is turned off so that every request
+reaches the database.
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(samples, fraction):
+    """ Returns the value below which a fraction of the sorted samples fall """
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+def summarize(latencies, errors, elapsed):
+    """ Returns the throughput and latency percentiles of one run """
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def request(port, method, path, body=None):
+    """ Sends one request on a fresh connection and returns its status """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def run_load(port, make_request, concurrency, duration):
+    """
+    Calls make_request(port, n) from concurrent clients for a duration
+
+    make_request returns True when the response was the expected one.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(number):
+        count = 0
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                ok = make_request(port, number * 1000000 + count)
+            except (OSError, http.client.HTTPException):
+                ok = False
+            elapsed = time.monotonic() - start
+            count += 1
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    started = time.monotonic()
+    clients = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return summarize(latencies, errors[0], time.monotonic() - started)
+
+
+class Server:
+    """ The service running under gunicorn in a child process """
+
+    def __init__(self, port=5055, env=None, args=()):
+        self.port = port
+        self.env = dict(os.environ, PORT=str(port), **(env or {}))
+        self.args = list(args)
+        self.process = None
+        # seconds from starting gunicorn to its first answer
+        self.boot_seconds = None
+
+    def __enter__(self):
+        # the service leaves the schema to the migration step
+        subprocess.run(
+            [sys.executable, "-m", "flask", "db-upgrade"],
+            cwd=ROOT, env=dict(self.env, FLASK_APP="service:app"),
+            stdout=subprocess.DEVNULL, check=True,
+        )
+        command = [
+            sys.executable, "-c", "from gunicorn.app.wsgiapp import run; run()",
+            "--config=gunicorn.conf.py",
+            "--log-level=critical", "--bind=127.0.0.1:{}".format(self.port),
+        ] + self.args + ["service:app"]
+        started = time.monotonic()
+        self.process = subprocess.Popen(command, cwd=ROOT, env=self.env)
+        deadline = started + 30
+        while time.monotonic() < deadline:
+            try:
+                if request(self.port, "GET", "/status") == 200:
+                    self.boot_seconds = time.monotonic() - started
+                    return self
+            except OSError:
+                time.sleep(0.01)
+        self.__exit__()
+        raise RuntimeError("gunicorn did not start")
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.wait()
+
+
+def seed(port, count, batch=1000):
+    """ Creates count customers through the batch endpoint and returns their ids """
+    ids = []
+    for start in range(0, count, batch):
+        rows = [
+            {
+                "name": "Customer {}".format(number),
+                "address": "Washington Square Park",
+                "phone_number": "555-555-{:04d}".format(number % 10000),
+                "email": "customer{}@example.com".format(number),
+                "credit_card": "VISA",
+            }
+            for number in range(start, min(count, start + batch))
+        ]
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        connection.request(
+            "POST", "/customers/batch", body=json.dumps(rows),
+            headers={"Content-Type": "application/json"},
+        )
+        ids.extend(json.loads(connection.getresponse().read())["ids"])
+        connection.close()
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--worker-class", nargs="+", default=["sync", "gevent"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=1000)
+    args = parser.parse_args()
+
+    env = {
+        "WEB_CONCURRENCY": str(args.workers),
+        "GUNICORN_THREADS": str(args.threads),
+        "GUNICORN_WORKER_CONNECTIONS": str(args.concurrency),
+        "CUSTOMER_CACHE_SIZE": "0",
+    }
+    results = {}
+    for worker_class in args.worker_class:
+        env["GUNICORN_WORKER_CLASS"] = worker_class
+        with Server(env=env) as server:
+            ids = seed(server.port, args.seed)
+
+            def get_customer(port, number):
+                path = "/customers/{}".format(ids[number % len(ids)])
+                return request(port, "GET", path) == 200
+
+            results[worker_class] = run_load(
+                server.port, get_customer, args.concurrency, args.duration
+            )
+        print(worker_class, json.dumps(results[worker_class]))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Model Benchmarks
+
+Times the Customer model without HTTP: serialize() and deserialize(), and
+the queries behind the routes. Every operation is called repeatedly and
+each call is timed, for throughput and latency percentiles. Run from the
+repository root:
+
+    python -m benchmarks.models --seed 10000
+
+DATABASE_URI selects the database (an in-memory SQLite one by default);
+its customers are replaced by --seed new ones. The customer cache is
+turned off so that every lookup reaches the database.
+"""
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import time
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+os.environ.setdefault("CUSTOMER_CACHE_SIZE", "0")
+
+from benchmarks.load import summarize  # noqa: E402
+from service import app  # noqa: E402
+from service.models import Customer, db  # noqa: E402
+
+RECORD = {
+    "name": "Customer",
+    "address": "Washington Square Park",
+    "phone_number": "555-555-1234",
+    "email": "customer@example.com",
+    "credit_card": "VISA",
+}
+
+
+def seed(count, chunk_size=1000):
+    """ Replaces the customers with count new ones and returns their ids """
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    Customer.load_many(
+        (
+            {
+                "name": "Customer {}".format(number),
+                "address": "Washington Square Park",
+                "phone_number": "555-555-{:04d}".format(number % 10000),
+                "email": "customer{}@example.com".format(number),
+                "credit_card": "VISA",
+                "active": number % 2 == 0,
+            }
+            for number in range(count)
+        ),
+        chunk_size,
+    )
+    return [row.id for row in Customer.query.with_entities(Customer.id).order_by(Customer.id)]
+
+
+def measure(operation, iterations):
+    """ Calls operation(n) for n in range(iterations) and summarizes the timings """
+    latencies = []
+    # leave one-off costs, such as building the search index, out of the timings
+    operation(iterations)
+    gc.collect()
+    started = time.perf_counter()
+    for number in range(iterations):
+        start = time.perf_counter()
+        operation(number)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, 0, time.perf_counter() - started)
+
+
+def run(ids, iterations=1000):
+    """ Returns the timings of every model operation, by name """
+    customer = Customer.find(ids[0])
+    names = itertools.cycle("Customer {}".format(number) for number in range(len(ids)))
+
+    def find(number):
+        Customer.find(ids[number * 7919 % len(ids)])
+        db.session.expunge_all()
+
+    def find_by_name(number):
+        Customer.find_by_name(next(names)).all()
+        db.session.expunge_all()
+
+    def page(number):
+        after_id = ids[number * 7919 % len(ids)]
+        Customer.page(after_id=after_id, limit=100, columns=Customer.columns()).all()
+
+    operations = {
+        "model.serialize": lambda number: customer.serialize(),
+        "model.deserialize": lambda number: Customer().deserialize(RECORD),
+        "model.find": find,
+        "model.find_by_name": find_by_name,
+        "model.page": page,
+        "model.search": lambda number: Customer.search("Custmer 42", limit=20),
+    }
+    results = {}
+    for name, operation in operations.items():
+        # the cheap in-memory operations get more calls for stable percentiles
+        count = iterations * 10 if name.endswith("serialize") else iterations
+        results[name] = measure(operation, count)
+    db.session.remove()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seed", type=int, default=10000)
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    results = run(seed(args.seed), args.iterations)
+    for name, result in results.items():
+        print(name, json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Serialization Benchmark
+
+Compares the ways of turning a list of customers into a JSON body:
+    orm+jsonify   Customer objects -> serialize() dicts -> flask.jsonify
+    rows+dumps    row tuples -> dicts -> encoding.dumps (orjson or json)
+    rows+encoder  row tuples -> RowEncoder, without per-customer dicts
+
+"encode" times only the encoding of data already in memory; "query+encode"
+also reads the rows from the database. Run from the repository root:
+
+    python -m benchmarks.serialization --rows 10000 100000
+"""
+import argparse
+import gc
+import logging
+import os
+import time
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+from flask import jsonify  # noqa: E402
+from service import app, encoding  # noqa: E402
+from service.encoding import RowEncoder  # noqa: E402
+from service.models import Customer, db  # noqa: E402
+
+
+def best_of(function, repeat):
+    """ Returns the fastest of several timed calls, in seconds """
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def seed(count):
+    """ Replaces the customers with count new ones """
+    db.drop_all()
+    db.create_all()
+    Customer.create_many(
+        Customer(
+            name="Customer {}".format(number),
+            address="Washington Square Park",
+            phone_number="555-555-{:04d}".format(number % 10000),
+            email="customer{}@example.com".format(number),
+            credit_card="VISA",
+            active=number % 2 == 0,
+        )
+        for number in range(count)
+    )
+    db.session.expunge_all()
+
+
+def run(count, repeat):
+    """ Returns the timings of every strategy for count customers """
+    seed(count)
+    columns = Customer.columns()
+    keys = Customer.SERIALIZED_FIELDS
+    encoder = RowEncoder(columns)
+
+    def load_customers():
+        customers = Customer.page(limit=count).all()
+        db.session.expunge_all()
+        return customers
+
+    def load_rows():
+        return Customer.page(limit=count, columns=columns).all()
+
+    customers = load_customers()
+    rows = load_rows()
+    results = {}
+    with app.test_request_context():
+        results["orm+jsonify"] = (
+            best_of(lambda: jsonify([c.serialize() for c in customers]), repeat),
+            best_of(lambda: jsonify([c.serialize() for c in load_customers()]), repeat),
+        )
+    results["rows+dumps"] = (
+        best_of(lambda: encoding.dumps([dict(zip(keys, r)) for r in rows]), repeat),
+        best_of(lambda: encoding.dumps([dict(zip(keys, r)) for r in load_rows()]), repeat),
+    )
+    results["rows+encoder"] = (
+        best_of(lambda: encoder.encode_rows(rows), repeat),
+        best_of(lambda: encoder.encode_rows(load_rows()), repeat),
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    print("JSON backend: {}".format(encoding.backend()))
+    print("{:>8}  {:<14}{:>12}{:>16}".format("rows", "strategy", "encode ms", "query+encode ms"))
+    for count in args.rows:
+        for strategy, (encode, total) in run(count, args.repeat).items():
+            print("{:>8}  {:<14}{:>12.1f}{:>16.1f}".format(count, strategy, encode * 1000, total * 1000))
+
+
+if __name__ == "__main__":
+    main()
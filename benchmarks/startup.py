@@ -0,0 +1,75 @@
+"""
+Startup Benchmarks
+
+Times how long the service takes to start, which bounds how fast it can
+scale out and recover from crashed workers: importing the app in a fresh
+interpreter, and booting gunicorn until it answers its first request.
+Run from the repository root:
+
+    python -m benchmarks.startup --runs 10
+
+DATABASE_URI selects the database, whose schema is upgraded first.
+Set GUNICORN_PRELOAD=true to time a preloaded app.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+os.environ.setdefault(
+    "DATABASE_URI",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "customers-benchmark.db"),
+)
+
+from benchmarks.load import ROOT, Server, summarize  # noqa: E402
+
+IMPORT_SCRIPT = (
+    "import time\n"
+    "start = time.perf_counter()\n"
+    "import service\n"
+    "print(time.perf_counter() - start)\n"
+)
+
+
+def time_import(runs):
+    """ Returns the timings of importing the app in fresh interpreters """
+    latencies = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+        ).stdout
+        latencies.append(float(output.decode("ascii").split()[-1]))
+    return summarize(latencies, 0, sum(latencies))
+
+
+def time_boot(runs, env=None):
+    """ Returns the timings of booting gunicorn until its first answer """
+    latencies = []
+    for _ in range(runs):
+        with Server(env=env) as server:
+            latencies.append(server.boot_seconds)
+    return summarize(latencies, 0, sum(latencies))
+
+
+def run(runs, env=None):
+    """ Returns the timings of every startup benchmark, by name """
+    return {
+        "startup.import": time_import(runs),
+        "startup.boot": time_boot(runs, env),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    for name, result in run(args.runs).items():
+        print(name, json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Benchmark Suite
+
+Seeds a database with customers, runs the model benchmarks, then starts
+the service under gunicorn and loads each route in turn: create, get,
+list, update, deactivate, activate and delete. Last, it times how long
+the service takes to start. Throughput and p50/p95/p99
+latencies are printed and can be saved as a baseline, which later runs
+are compared against to catch regressions. Run from the repository root:
+
+    python -m benchmarks.suite --save benchmarks/baseline.json
+    python -m benchmarks.suite --compare benchmarks/baseline.json
+
+DATABASE_URI selects the database, which must be shared with the gunicorn
+workers (a SQLite file under the temporary directory by default). Its
+customers are replaced by --seed new ones. Compare runs made on the same
+machine only: the Python version, JSON backend and database of the
+baseline are checked, but not the speed of the machine that recorded it.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+os.environ.setdefault(
+    "DATABASE_URI",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "customers-benchmark.db"),
+)
+os.environ.setdefault("CUSTOMER_CACHE_SIZE", "0")
+
+from benchmarks import models, startup  # noqa: E402
+from benchmarks.load import Server, request, run_load  # noqa: E402
+from service import app, encoding  # noqa: E402
+from service.models import db  # noqa: E402
+
+BODY = json.dumps(models.RECORD)
+
+# Settings that must match the baseline for the results to be comparable
+RUN_SETTINGS = (
+    "database", "python", "json_backend", "worker_class", "workers", "concurrency", "seed"
+)
+
+
+def route_loads(ids, concurrency):
+    """
+    Returns the request function of every route benchmark, in running order
+
+    Each client works on its own share of the ids, so that concurrent
+    updates never race for the same customer. The delete benchmark runs
+    last and removes customers from the start of each share.
+    """
+    shares = [ids[client::concurrency] for client in range(concurrency)]
+
+    def pick(number):
+        share = shares[number // 1000000 % concurrency]
+        return share[number % 1000000 % len(share)]
+
+    def create(port, number):
+        return request(port, "POST", "/customers", BODY) == 201
+
+    def get(port, number):
+        return request(port, "GET", "/customers/{}".format(pick(number))) == 200
+
+    def list_page(port, number):
+        path = "/customers?limit=100&after_id={}".format(pick(number))
+        return request(port, "GET", path) == 200
+
+    def update(port, number):
+        path = "/customers/{}".format(pick(number))
+        return request(port, "PUT", path, BODY) == 200
+
+    def deactivate(port, number):
+        path = "/customers/{}/deactivate".format(pick(number))
+        return request(port, "PUT", path) == 200
+
+    def activate(port, number):
+        path = "/customers/{}/activate".format(pick(number))
+        return request(port, "PUT", path) == 200
+
+    def delete(port, number):
+        return request(port, "DELETE", "/customers/{}".format(pick(number))) == 204
+
+    return {
+        "http.create": create,
+        "http.get": get,
+        "http.list": list_page,
+        "http.update": update,
+        "http.deactivate": deactivate,
+        "http.activate": activate,
+        "http.delete": delete,
+    }
+
+
+def run_suite(args):
+    """ Returns the environment and the results of every benchmark """
+    ids = models.seed(args.seed)
+    results = models.run(ids, args.iterations)
+    env = {
+        "WEB_CONCURRENCY": str(args.workers),
+        "GUNICORN_WORKER_CLASS": args.worker_class,
+        "GUNICORN_THREADS": str(args.concurrency),
+        "GUNICORN_WORKER_CONNECTIONS": str(args.concurrency),
+    }
+    with Server(env=env) as server:
+        for name, make_request in route_loads(ids, args.concurrency).items():
+            results[name] = run_load(server.port, make_request, args.concurrency, args.duration)
+            print(name, json.dumps(results[name]), file=sys.stderr)
+    results.update(startup.run(args.startup_runs, env))
+    return {
+        "environment": {
+            "database": db.engine.dialect.name,
+            "python": platform.python_version(),
+            "json_backend": encoding.backend(),
+            "worker_class": args.worker_class,
+            "workers": args.workers,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline, current, tolerance):
+    """
+    Returns the regressions of the current results against a baseline
+
+    A benchmark regressed when its throughput dropped, or its p95 latency
+    grew, by more than the tolerance (a fraction of the baseline value).
+    Latencies under a millisecond are too noisy to compare.
+    """
+    regressions = []
+    for name, before in sorted(baseline["results"].items()):
+        after = current["results"].get(name)
+        if after is None:
+            continue
+        if after["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(
+                "{}: throughput {} -> {} per second".format(
+                    name, before["throughput"], after["throughput"]
+                )
+            )
+        if after["p95_ms"] > max(before["p95_ms"], 1.0) * (1 + tolerance):
+            regressions.append(
+                "{}: p95 {} -> {} ms".format(name, before["p95_ms"], after["p95_ms"])
+            )
+        if after["errors"] > before["errors"]:
+            regressions.append(
+                "{}: errors {} -> {}".format(name, before["errors"], after["errors"])
+            )
+    return regressions
+
+
+def print_table(current, baseline=None):
+    """ Prints the throughput and latencies of every benchmark """
+    print("{:<20}{:>12}{:>10}{:>10}{:>10}{:>8}{:>14}".format(
+        "benchmark", "per second", "p50 ms", "p95 ms", "p99 ms", "errors", "baseline/s"
+    ))
+    for name, result in current["results"].items():
+        before = (baseline or {}).get("results", {}).get(name, {}).get("throughput", "")
+        print("{:<20}{:>12}{:>10}{:>10}{:>10}{:>8}{:>14}".format(
+            name, result["throughput"], result["p50_ms"], result["p95_ms"],
+            result["p99_ms"], result["errors"], before
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seed", type=int, default=10000)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--startup-runs", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--worker-class", default="sync")
+    parser.add_argument("--save", metavar="FILE", help="write the results to a baseline file")
+    parser.add_argument("--compare", metavar="FILE", help="fail on regressions against a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    app.logger.disabled = True
+    current = run_suite(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_table(current, baseline)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(current, file, indent=2, sort_keys=True)
+            file.write("\n")
+    if baseline is None:
+        return 0
+    settings = [
+        (key, baseline["environment"].get(key), value)
+        for key, value in current["environment"].items()
+        if key in RUN_SETTINGS and baseline["environment"].get(key) != value
+    ]
+    for key, before, after in settings:
+        print("The baseline was measured with {} {}, not {}".format(key, before, after))
+    if settings:
+        return 1
+    regressions = compare(baseline, current, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,7 @@ Global Configuration for Application
 """
 import os
 import json
+import tempfile
 
 # Get configuration from environment
 #DATABASE_URI = os.getenv("DATABASE_URI", "sqlite:///../development.db")
@@ -19,5 +20,126 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool (SQLite manages its own connections and ignores these)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Reconnect before the server or a failover drops idle connections
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Set when connecting through PgBouncer in transaction pooling mode
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() == "true"
+
+# Read replicas, comma separated: GET requests read from one of them, picked
+# round_robin or least_loaded, unless their client wrote in the last
+# DB_READ_YOUR_WRITES_SECONDS
+DATABASE_REPLICA_URIS = [
+    uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()
+]
+DB_REPLICA_BALANCE = os.getenv("DB_REPLICA_BALANCE", "round_robin")
+DB_READ_YOUR_WRITES_SECONDS = int(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+
+# Apply pending schema migrations when the service starts (manifest.yml sets
+# it for Cloud Foundry, which has no release phase). Leave this off for large
+# tables and run `flask db-upgrade` before deploying instead.
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "false").lower() == "true"
+
+# Keyset pagination of GET /customers
+CUSTOMERS_PAGE_SIZE = int(os.getenv("CUSTOMERS_PAGE_SIZE", "1000"))
+CUSTOMERS_MAX_PAGE_SIZE = int(os.getenv("CUSTOMERS_MAX_PAGE_SIZE", "1000"))
+# Page size cap of filters that no index can answer, which scan the table,
+# and of sort orders that are not ranges of an index
+CUSTOMERS_UNINDEXED_PAGE_SIZE = int(os.getenv("CUSTOMERS_UNINDEXED_PAGE_SIZE", "100"))
+# Page size of GET /customers/search and the number of matches it ranks at most
+CUSTOMERS_SEARCH_PAGE_SIZE = int(os.getenv("CUSTOMERS_SEARCH_PAGE_SIZE", "20"))
+CUSTOMERS_SEARCH_MAX_RESULTS = int(os.getenv("CUSTOMERS_SEARCH_MAX_RESULTS", "1000"))
+# Rows fetched per round-trip from the server-side cursor when streaming
+CUSTOMERS_STREAM_BATCH_SIZE = int(os.getenv("CUSTOMERS_STREAM_BATCH_SIZE", "1000"))
+
+# Rows per INSERT statement for POST /customers/batch, and ids per UPDATE
+# statement for the bulk updates
+CUSTOMERS_BATCH_CHUNK_SIZE = int(os.getenv("CUSTOMERS_BATCH_CHUNK_SIZE", "1000"))
+
+# Hide deleted customers instead of removing them, until `flask customers-purge`
+# removes those deleted more than CUSTOMERS_PURGE_AFTER_DAYS ago, a batch at a time
+CUSTOMERS_SOFT_DELETE = os.getenv("CUSTOMERS_SOFT_DELETE", "false").lower() == "true"
+CUSTOMERS_PURGE_AFTER_DAYS = float(os.getenv("CUSTOMERS_PURGE_AFTER_DAYS", "30"))
+CUSTOMERS_PURGE_BATCH_SIZE = int(os.getenv("CUSTOMERS_PURGE_BATCH_SIZE", "1000"))
+CUSTOMERS_PURGE_PAUSE = float(os.getenv("CUSTOMERS_PURGE_PAUSE", "0.1"))
+
+# Read-through cache of GET /customers/<id> (a size of 0 turns it off); each
+# worker has its own, and writes only invalidate the cache of the worker that
+# ran them, so the others may serve a stale customer for CUSTOMER_CACHE_TTL
+CUSTOMER_CACHE_SIZE = int(os.getenv("CUSTOMER_CACHE_SIZE", "1024"))
+CUSTOMER_CACHE_TTL = float(os.getenv("CUSTOMER_CACHE_TTL", "30"))
+
+# Concurrent identical reads of a customer or a page share one query:
+# "worker" within a worker, "host" across the workers of a host through lock
+# files in CUSTOMERS_SINGLE_FLIGHT_DIR (best on local storage), or "off";
+# the directory must belong to the service's user and have mode 0700
+CUSTOMERS_SINGLE_FLIGHT = os.getenv("CUSTOMERS_SINGLE_FLIGHT", "worker")
+CUSTOMERS_SINGLE_FLIGHT_DIR = os.getenv(
+    "CUSTOMERS_SINGLE_FLIGHT_DIR",
+    os.path.join(tempfile.gettempdir(), "customers-single-flight-{}".format(os.getuid())),
+)
+
+# Responses of POST /customers replayed to retries sending the same
+# Idempotency-Key, for IDEMPOTENCY_TTL seconds; the last IDEMPOTENCY_CACHE_SIZE
+# are kept in memory, and a key claimed for IDEMPOTENCY_CLAIM_TIMEOUT seconds
+# without a response is given to the next request
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "1024"))
+IDEMPOTENCY_CLAIM_TIMEOUT = int(os.getenv("IDEMPOTENCY_CLAIM_TIMEOUT", "30"))
+
+# Per-client rate limit: a bucket of RATE_LIMIT_BURST requests refilled at
+# RATE_LIMIT_PER_SECOND (0 turns it off) for each X-Api-Key, or else each
+# client address, kept by every worker ("memory") or shared by the workers of
+# a host through the SQLite file RATE_LIMIT_FILE ("host"). Behind proxies that
+# append to X-Forwarded-For, set RATE_LIMIT_TRUSTED_PROXIES to their number
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_FILE = os.getenv(
+    "RATE_LIMIT_FILE", os.path.join(tempfile.gettempdir(), "customers-rate-limit.db")
+)
+RATE_LIMIT_CLIENTS = int(os.getenv("RATE_LIMIT_CLIENTS", "10000"))
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+
+# Admission control: a worker sheds requests with 503 while it runs
+# ADMISSION_MAX_IN_FLIGHT requests, or while connections of the pool have
+# recently waited over ADMISSION_MAX_POOL_WAIT_MS (0 turns either off)
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "0"))
+ADMISSION_MAX_POOL_WAIT_MS = float(os.getenv("ADMISSION_MAX_POOL_WAIT_MS", "500"))
+
+# Log records are JSON lines (or text), written by a background thread from
+# a queue of LOG_QUEUE_SIZE records; LOG_SAMPLE_RATES keeps a share of the
+# records of some levels, e.g. INFO=0.05,DEBUG=0
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+# Level of the records of the models and the other service modules, which
+# log every call at INFO; slow queries are warnings
+LOG_MODEL_LEVEL = os.getenv("LOG_MODEL_LEVEL", "WARNING")
+
+# Opt-in query profiling: requests sending X-Profile: true, and a sample of
+# the others, record their SQL statements for GET /debug/profiles
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_HISTORY = int(os.getenv("PROFILE_HISTORY", "100"))
+# Log SQL statements slower than this many milliseconds (0 turns it off)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+
+# Response compression: encodings in order of preference (br needs the brotli
+# package), the smallest body worth compressing, the gzip level (1-9; 1 is
+# about as small as 6 on customer lists, for half the CPU) and the
+# brotli quality (0-11; the higher ones are too slow for every request)
+COMPRESS_ENCODINGS = os.getenv("COMPRESS_ENCODINGS", "br,gzip")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "1"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+
+# JSON library for customer payloads: auto (orjson when installed), orjson or json
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto")
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
@@ -23,11 +23,15 @@ ID_PREFIX = 'customer_'
 def step_impl(context):
     """ Delete all Customers and load new ones """
     headers = {'Content-Type': 'application/json'}
-    context.resp = requests.get(context.base_url + '/customers', headers=headers)
-    expect(context.resp.status_code).to_equal(200)
-    for customer in context.resp.json():
-        context.resp = requests.delete(context.base_url + '/customers/' + str(customer["id"]), headers=headers)
-        expect(context.resp.status_code).to_equal(204)
+    # delete a page of customers at a time with one bulk request
+    while True:
+        context.resp = requests.get(context.base_url + '/customers?fields=id', headers=headers)
+        expect(context.resp.status_code).to_equal(200)
+        ids = [str(customer["id"]) for customer in context.resp.json()]
+        if not ids:
+            break
+        context.resp = requests.delete(context.base_url + '/customers?ids=' + ','.join(ids), headers=headers)
+        expect(context.resp.status_code).to_equal(200)
 
     #load the database with new customers
     create_url = context.base_url + '/customers'
@@ -0,0 +1,87 @@
+"""
+Gunicorn Configuration
+
+The serving mode is chosen with environment variables:
+    WEB_CONCURRENCY              worker processes (default 1)
+    GUNICORN_WORKER_CLASS        sync, gthread or gevent (default sync)
+    GUNICORN_THREADS             threads per gthread worker (default 4)
+    GUNICORN_WORKER_CONNECTIONS  concurrent requests per gevent worker (default 100)
+    GUNICORN_TIMEOUT             seconds before a silent worker is restarted (default 30)
+    GUNICORN_PRELOAD             import the app once in the master (default false)
+
+A sync worker serves one request at a time, so one slow query stalls the
+whole worker. gthread and gevent workers keep serving other requests while
+a request waits on the database; size DB_POOL_SIZE and DB_MAX_OVERFLOW for
+the number of requests a worker can have in flight.
+
+Set PROMETHEUS_MULTIPROC_DIR to a directory for the workers to share
+their metrics; it is emptied when gunicorn starts.
+
+Run with:
+    gunicorn --config=gunicorn.conf.py service:app
+"""
+import glob
+import os
+import sys
+
+bind = "0.0.0.0:{}".format(os.getenv("PORT", "5000"))
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+# Import the app once in the master and fork the workers from it, except for
+# gevent, which must patch the standard library before the app is imported
+preload_app = (
+    os.getenv("GUNICORN_PRELOAD", "false").lower() == "true" and worker_class != "gevent"
+)
+errorlog = "-"
+
+
+def on_starting(server):
+    """ Removes the metrics left behind by a previous run """
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    """ Drops the live gauges of a worker that exited """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def pre_fork(server, worker):
+    """
+    Leaves a preloaded app nothing a fork would share with the worker: no
+    open database or replica connection and no log listener thread holding a lock
+    """
+    models = sys.modules.get("service.models")
+    if models is not None:
+        models.db.engine.dispose()
+        replica_set = models.Customer.app and models.replicas.replica_set(models.Customer.app)
+        if replica_set:
+            replica_set.dispose()
+    logs = sys.modules.get("service.logs")
+    if logs is not None:
+        logs.stop_listener()
+
+
+def post_fork(server, worker):
+    """
+    Restarts the log listener thread, which a fork does not copy, and makes
+    psycopg2 yield to other greenlets while it waits on PostgreSQL
+    """
+    # only imported yet when gunicorn preloads the app in the master
+    logs = sys.modules.get("service.logs")
+    if logs is not None:
+        logs.restart_listener()
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+        server.log.info("psycopg2 patched for gevent in worker %s", worker.pid)
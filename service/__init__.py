@@ -14,20 +14,15 @@ app = Flask(__name__)
 app.config.from_object("config")
 
 # Import the rutes After the Flask app is created
-from service import routes, models
+from service import routes, models, commands, logs
 
 # Set up logging for production
 if __name__ != "__main__":
     gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
     app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
+    # Write the records from a background thread, in the same format as gunicorn's
+    logs.init_logging(app, gunicorn_logger.handlers)
     app.logger.info("Logging handler established")
 
 app.logger.info(70 * "*")
@@ -0,0 +1,103 @@
+"""
+API Documentation
+
+Serves the Swagger UI at /apidocs/ and the Swagger spec at /v1/spec at the
+URLs and endpoint names flasgger uses, without importing flasgger when the
+service starts. flasgger (with jsonschema, PyYAML and markdown) is only
+imported by the first request for the spec, which parses the docstrings
+of every route once; later requests get the same spec from memory. The UI
+page and its static files come straight from the flasgger package.
+"""
+import importlib.util
+import os
+import threading
+from flask import current_app, jsonify, redirect, render_template_string, request
+from flask import send_from_directory, url_for
+from flask_api import status  # HTTP Status Codes
+
+BLUEPRINT = "flasgger"
+UI_ROUTE = "/apidocs/"
+STATIC_ROUTE = "/flasgger_static"
+
+# Generated specs by endpoint, as JSON
+_specs = {}
+_specs_lock = threading.Lock()
+
+
+def init_apidocs(app):
+    """ Adds the routes of the API documentation to an app configured with SWAGGER """
+    app.add_url_rule(UI_ROUTE, BLUEPRINT + ".apidocs", apidocs)
+    app.add_url_rule(
+        UI_ROUTE + "index.html",
+        BLUEPRINT + ".apidocs_index",
+        lambda: redirect(url_for(BLUEPRINT + ".apidocs")),
+    )
+    app.add_url_rule(STATIC_ROUTE + "/<path:filename>", BLUEPRINT + ".static", static)
+    for spec in app.config["SWAGGER"]["specs"]:
+        app.add_url_rule(spec["route"], BLUEPRINT + "." + spec["endpoint"], api_spec)
+
+
+def ui_folder():
+    """ Returns the folder of the Swagger UI in the flasgger package, without importing it """
+    package = importlib.util.find_spec(BLUEPRINT).submodule_search_locations[0]
+    return os.path.join(package, "ui2")
+
+
+def apidocs():
+    """ Returns the Swagger UI page, or the list of specs with ?json """
+    config = current_app.config["SWAGGER"]
+    data = {
+        "specs": [
+            {
+                "url": url_for(BLUEPRINT + "." + spec["endpoint"]),
+                "title": spec.get("title", "API Spec 1"),
+                "version": spec.get("version", "0.0.1"),
+                "endpoint": spec["endpoint"],
+            }
+            for spec in config["specs"]
+        ],
+        "title": config.get("title", "Flasgger"),
+    }
+    if request.args.get("json"):
+        return jsonify(data)
+    path = os.path.join(ui_folder(), "templates", "flasgger", "index.html")
+    with open(path, encoding="utf-8") as template:
+        return render_template_string(template.read(), **data)
+
+
+def static(filename):
+    """ Returns a static file of the Swagger UI """
+    return send_from_directory(os.path.join(ui_folder(), "static"), filename)
+
+
+def api_spec():
+    """ Returns the Swagger spec, generated from the route docstrings on first use """
+    endpoint = request.url_rule.endpoint.split(".", 1)[1]
+    with _specs_lock:
+        if endpoint not in _specs:
+            _specs[endpoint] = generate_spec(endpoint)
+    return current_app.response_class(
+        _specs[endpoint], status=status.HTTP_200_OK, mimetype="application/json"
+    )
+
+
+def generate_spec(endpoint):
+    """ Returns the Swagger spec of one of the SWAGGER specs as JSON """
+    from flasgger import Swagger  # pylint: disable=import-outside-toplevel
+    from flasgger.base import APISpecsView  # pylint: disable=import-outside-toplevel
+
+    swagger = Swagger()
+    swagger.config.update(current_app.config["SWAGGER"])
+    spec = next(item for item in swagger.config["specs"] if item["endpoint"] == endpoint)
+    view = APISpecsView.as_view(
+        endpoint,
+        view_args=dict(
+            app=current_app,
+            config=swagger.config,
+            spec=spec,
+            sanitizer=swagger.sanitizer,
+            template=swagger.template,
+            definition_models=swagger.definition_models,
+        ),
+    )
+    return view().get_data()
@@ -0,0 +1,180 @@
+"""
+Cache Backends
+
+Stores used by the read-through cache in front of Customer.find. Every
+backend implements the CacheBackend interface so that a store shared
+between workers can replace the in-process LRUCache later on.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheBackend:
+    """ Interface of the stores used by the read-through cache """
+
+    def get(self, key):
+        """ Returns the value stored for a key or None when it is missing """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Stores a value for a key """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Removes a key so that the next get() misses """
+        raise NotImplementedError
+
+    def start_load(self, key):
+        """ Returns the generation of a key about to be read from the database """
+        raise NotImplementedError
+
+    def finish_load(self, key, value, generation):
+        """
+        Stores a value read since start_load(), unless the key was deleted
+        or the cache cleared in the meantime; a value of None is not stored
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every key """
+        raise NotImplementedError
+
+    def stats(self):
+        """ Returns the counters of the cache as a dictionary """
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    """ A cache that stores nothing, used when caching is turned off """
+
+    def __init__(self):
+        self.misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def start_load(self, key):
+        return 0
+
+    def finish_load(self, key, value, generation):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {"backend": "null", "hits": 0, "misses": self.misses}
+
+
+class LRUCache(CacheBackend):
+    """
+    An in-process least recently used cache with a time to live
+
+    At most ``maxsize`` entries are kept; the least recently used one is
+    evicted to make room for a new one, and entries older than ``ttl``
+    seconds are treated as missing. Each worker process has its own cache,
+    so the ttl bounds how long another worker can serve a stale entry.
+
+    A row read while a write invalidates it would put the old row back in
+    the cache after the write. Every delete and clear bumps a generation,
+    and the keys deleted while they are being loaded remember theirs, so
+    finish_load() drops a value read before the last invalidation of its key.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._cleared_at = 0
+        # loads in flight by key, and the generation of the last delete of those keys
+        self._loading = {}
+        self._deleted_at = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+            if key in self._loading:
+                self._deleted_at[key] = self._generation
+
+    def start_load(self, key):
+        with self._lock:
+            self._loading[key] = self._loading.get(key, 0) + 1
+            return self._generation
+
+    def finish_load(self, key, value, generation):
+        with self._lock:
+            fresh = (
+                self._cleared_at <= generation
+                and self._deleted_at.get(key, 0) <= generation
+            )
+            self._loading[key] -= 1
+            if not self._loading[key]:
+                del self._loading[key]
+                self._deleted_at.pop(key, None)
+            if value is not None and fresh:
+                self._set(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._cleared_at = self._generation
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "lru",
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def create_cache(size, ttl):
+    """ Returns an LRUCache, or a NullCache when the size is 0 """
+    if size <= 0:
+        return NullCache()
+    return LRUCache(size, ttl)
@@ -0,0 +1,72 @@
+"""
+Command Line Interface
+
+Maintenance commands run with the flask command, e.g.:
+    FLASK_APP=service:app flask db-upgrade
+"""
+from datetime import timedelta
+import click
+from service import app, transfer
+from service.models import Customer, IdempotencyKey
+
+
+@app.cli.command("db-upgrade")
+@click.option("--target", type=int, help="Schema version to stop at")
+def db_upgrade(target):
+    """ Creates the missing tables and applies the pending schema migrations """
+    version = Customer.upgrade_schema(target)
+    click.echo("Database schema is at version {}".format(version))
+
+
+@app.cli.command("customers-purge")
+@click.option(
+    "--older-than",
+    type=float,
+    default=lambda: app.config["CUSTOMERS_PURGE_AFTER_DAYS"],
+    help="Only remove Customers soft deleted more than this many days ago",
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=lambda: app.config["CUSTOMERS_PURGE_BATCH_SIZE"],
+    help="Customers removed per transaction",
+)
+@click.option(
+    "--pause",
+    type=float,
+    default=lambda: app.config["CUSTOMERS_PURGE_PAUSE"],
+    help="Seconds to wait between two batches",
+)
+def customers_purge(older_than, batch_size, pause):
+    """ Removes the soft deleted Customers for good, in bounded batches """
+    count = Customer.purge(timedelta(days=older_than), batch_size, pause)
+    click.echo("Purged {} customers".format(count))
+
+
+@app.cli.command("idempotency-purge")
+def idempotency_purge():
+    """ Removes the expired idempotency keys """
+    count = IdempotencyKey.purge()
+    click.echo("Purged {} idempotency keys".format(count))
+
+
+@app.cli.command("customers-export")
+@click.argument("output", type=click.File("wb"), default="-")
+@click.option("--format", "export_format", type=click.Choice(transfer.FORMATS), default="csv")
+def customers_export(output, export_format):
+    """ Writes every Customer to a CSV or NDJSON file (standard output by default) """
+    for chunk in transfer.export_customers(
+        export_format, app.config["CUSTOMERS_STREAM_BATCH_SIZE"]
+    ):
+        output.write(chunk)
+
+
+@app.cli.command("customers-import")
+@click.argument("source", type=click.File("rb"), default="-")
+@click.option("--format", "import_format", type=click.Choice(transfer.FORMATS), default="csv")
+def customers_import(source, import_format):
+    """ Creates Customers from a CSV or NDJSON file (standard input by default) """
+    count = transfer.import_customers(
+        source, import_format, app.config["CUSTOMERS_BATCH_CHUNK_SIZE"]
+    )
+    click.echo("Imported {} customers".format(count), err=True)
@@ -0,0 +1,144 @@
+"""
+Response Compression
+
+Compresses the JSON, NDJSON and CSV responses of clients that accept it,
+with brotli when the brotli package is installed and the client prefers
+it or takes either, and with gzip otherwise. Bodies smaller than
+COMPRESS_MIN_SIZE are sent as they are, since a single customer saves a
+few bytes for the CPU it costs. Streamed responses have no size up
+front and are always compressed, a block at a time as the compressor
+fills up, so memory stays bounded.
+
+A compressed body is a different representation from the plain one, so
+its strong ETag gets the encoding as a suffix ("1.2" becomes "1.2-gzip").
+Caches then never serve one encoding for the other. The version is the
+same, so If-Match and If-None-Match strip the suffix with decoded_etag()
+and accept the ETag of either encoding.
+"""
+import gzip
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+ENCODINGS = ("br", "gzip")
+# Media types worth compressing; the others are already compressed or tiny
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/csv", "text/html")
+
+_settings = {"encodings": ("gzip",), "min_size": 1024, "level": 1, "brotli_quality": 4}
+
+
+def init_compression(app):
+    """ Compresses the responses of an app """
+    configure(app.config)
+    app.after_request(compress_response)
+
+
+def configure(config):
+    """
+    Applies the compression settings of a configuration
+
+    Raises:
+        ValueError: when COMPRESS_ENCODINGS names an unknown encoding
+    """
+    encodings = [
+        name.strip() for name in config.get("COMPRESS_ENCODINGS", "br,gzip").split(",")
+        if name.strip()
+    ]
+    for name in encodings:
+        if name not in ENCODINGS:
+            raise ValueError(
+                "COMPRESS_ENCODINGS must be some of {}: {}".format(", ".join(ENCODINGS), name)
+            )
+    if brotli is None and "br" in encodings:
+        encodings.remove("br")
+    _settings.update(
+        encodings=tuple(encodings),
+        min_size=config.get("COMPRESS_MIN_SIZE", 1024),
+        level=config.get("COMPRESS_LEVEL", 1),
+        brotli_quality=config.get("COMPRESS_BROTLI_QUALITY", 4),
+    )
+
+
+def choose_encoding():
+    """ Returns the best encoding the client of the current request accepts, or None """
+    if not _settings["encodings"]:
+        return None
+    # on a tie the order of COMPRESS_ENCODINGS wins
+    return request.accept_encodings.best_match(_settings["encodings"])
+
+
+def compress_response(response):
+    """ Compresses a response, when the client accepts it and it is worth it """
+    if (
+        request.method == "HEAD"
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+    if not response.is_streamed and len(response.get_data()) < _settings["min_size"]:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compress(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+    return response
+
+
+def encoded_etag(etag, encoding):
+    """ Returns the ETag of a representation compressed with an encoding """
+    return "{}-{}".format(etag, encoding)
+
+
+def decoded_etag(etag):
+    """ Returns an ETag without the suffix of the encoding it was compressed with """
+    base, _, suffix = etag.rpartition("-")
+    return base if base and suffix in ENCODINGS else etag
+
+
+def compress(data, encoding):
+    """ Returns data compressed with an encoding at the configured level """
+    if encoding == "br":
+        return brotli.compress(data, quality=_settings["brotli_quality"])
+    return gzip.compress(data, compresslevel=_settings["level"], mtime=0)
+
+
+def compressor(encoding):
+    """ Returns the compress and finish functions of an incremental compressor """
+    if encoding == "br":
+        stream = brotli.Compressor(quality=_settings["brotli_quality"])
+        return stream.process, stream.finish
+    # wbits=31 writes the gzip header and trailer
+    stream = zlib.compressobj(_settings["level"], zlib.DEFLATED, 31)
+    return stream.compress, stream.flush
+
+
+def compress_chunks(chunks, encoding):
+    """ Yields the compressed chunks of a streamed body as the compressor fills up """
+    compress_chunk, finish = compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compress_chunk(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
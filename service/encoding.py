@@ -0,0 +1,117 @@
+"""
+JSON Encoding
+
+Encoders for the customer response bodies. dumps() uses orjson when it is
+installed and the standard library json module otherwise; JSON_BACKEND
+picks one explicitly. RowEncoder writes JSON objects straight from the
+row tuples of a column query, without building a dictionary per row.
+"""
+import json
+from json.encoder import encode_basestring
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+BACKENDS = ("auto", "orjson", "json")
+
+_backend = {"name": None, "dumps": None}
+
+
+def _json_dumps(data):
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def set_backend(name="auto"):
+    """ Selects the JSON library used by dumps() """
+    if name not in BACKENDS:
+        raise ValueError("JSON backend must be one of {}".format(", ".join(BACKENDS)))
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("JSON backend orjson is not installed")
+        _backend.update(name="orjson", dumps=orjson.dumps)
+    else:
+        _backend.update(name="json", dumps=_json_dumps)
+    return name
+
+
+def backend():
+    """ Returns the name of the JSON library used by dumps() """
+    return _backend["name"]
+
+
+def dumps(data):
+    """ Encodes data as compact JSON bytes """
+    return _backend["dumps"](data)
+
+
+######################################################################
+#  R O W   E N C O D E R
+######################################################################
+
+_BOOLEANS = {True: "true", False: "false", None: "null"}
+
+
+def _encode_value(value):
+    return _backend["dumps"](value).decode("utf-8")
+
+
+def _column_format(column, index):
+    """ Returns the template placeholder and the Python expression of row[index] """
+    value = "row[{}]".format(index)
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = None
+    if python_type is bool:
+        return "%s", "_booleans[{}]".format(value)
+    if python_type is int and not column.nullable:
+        return "%d", value
+    if python_type is int:
+        return "%s", '("null" if {0} is None else _int_repr({0}))'.format(value)
+    if python_type is str and not column.nullable:
+        return "%s", "_encode_string({})".format(value)
+    if python_type is str:
+        return "%s", '("null" if {0} is None else _encode_string({0}))'.format(value)
+    return "%s", "_encode_value({})".format(value)
+
+
+class RowEncoder:
+    """
+    Encodes row tuples as JSON objects
+
+    The keys are known up front, so a function that formats one row with
+    a fixed template and one inline encoder per column is compiled once
+    per encoder. A row may have more values than there are columns; the
+    extra values are not encoded.
+    """
+
+    def __init__(self, columns):
+        self.keys = tuple(column.name for column in columns)
+        formats = [_column_format(column, index) for index, column in enumerate(columns)]
+        template = "{" + ",".join(
+            encode_basestring(key).replace("%", "%%") + ":" + placeholder
+            for key, (placeholder, _) in zip(self.keys, formats)
+        ) + "}"
+        values = ", ".join(expression for _, expression in formats)
+        namespace = {
+            "_template": template,
+            "_booleans": _BOOLEANS,
+            "_int_repr": int.__repr__,
+            "_encode_string": encode_basestring,
+            "_encode_value": _encode_value,
+        }
+        source = "def encode_row(row):\n    return _template % ({},)\n".format(values)
+        exec(source, namespace)  # pylint: disable=exec-used
+        self.encode_row = namespace["encode_row"]
+        self.encode_row.__doc__ = "Returns the JSON object of one row as a string"
+
+    def encode_rows(self, rows):
+        """ Returns the JSON array of a list of rows as bytes """
+        return ("[" + ",".join(map(self.encode_row, rows)) + "]").encode("utf-8")
+
+
+set_backend()
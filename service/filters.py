@@ -0,0 +1,305 @@
+"""
+Customer Filters
+
+Compiles the filter and sort parameters of GET /customers into a single
+query on Customer.query:
+
+    ?<field>=value              equality (active takes true or false)
+    ?<field>__in=a,b,c          one of a list of values
+    ?<field>__prefix=value      starts with value
+    ?<field>__suffix=value      ends with value (never uses an index)
+    ?<field>__contains=value    contains value (never uses an index)
+    ?sort=name,-id              order by indexed fields, descending with -
+
+Sorted pages are walked with an opaque ``after`` cursor holding the sort
+values and the id of the last row instead of an OFFSET. A sort on one
+field in one direction continues from the cursor along the (field, id)
+index of that field (see is_range_sort()); the database reads every other
+sort order from its start on each page, so the caller caps their pages.
+"""
+import base64
+import binascii
+import json
+from collections import namedtuple
+from sqlalchemy import and_, false, or_, tuple_
+from service.models import Customer, DataValidationError
+
+OPERATORS = ("eq", "in", "prefix", "suffix", "contains")
+
+# Most values accepted by one __in filter
+MAX_IN_VALUES = 100
+
+# Query parameters of GET /customers that are not filters
+RESERVED_ARGS = frozenset(("limit", "after_id", "after", "stream", "fields", "sort"))
+
+# Card numbers are never matched on, so they cannot be guessed a prefix at a time
+FILTER_FIELDS = tuple(name for name in Customer.SERIALIZED_FIELDS if name != "credit_card")
+
+# Fields with a B-tree index usable for equality, IN lists and ordering
+INDEXED_FIELDS = tuple(
+    column.name
+    for column in Customer.__table__.columns
+    if column.primary_key or column.index
+)
+
+# Fields with a (field, id) index, which a sort on the field walks in order
+RANGE_SORT_FIELDS = tuple(
+    index.columns.keys()[0]
+    for index in Customer.__table__.indexes
+    if index.columns.keys()[1:] == ["id"]
+)
+
+# Indexed fields whose values each match a large share of the table, so
+# their index narrows down little of what the other filters must check
+LOW_SELECTIVITY_FIELDS = ("active",)
+
+Filter = namedtuple("Filter", "field operator value")
+SortKey = namedtuple("SortKey", "field descending")
+
+
+def parse_filters(args):
+    """
+    Returns the Filters in the query parameters of a request
+
+    Args:
+        args (MultiDict): the query parameters
+
+    Raises:
+        DataValidationError: when a field, operator or value is not valid
+    """
+    filters = []
+    for key, value in args.items(multi=True):
+        if key in RESERVED_ARGS:
+            continue
+        if key == "ids":
+            # only DELETE /customers takes its ids from the query string
+            raise DataValidationError(
+                "ids is not a filter: use id__in=1,2,3, or the ids of the body"
+            )
+        field, _, operator = key.partition("__")
+        operator = operator or "eq"
+        if field not in FILTER_FIELDS:
+            raise DataValidationError("Unknown filter field: {}".format(field))
+        if operator not in OPERATORS:
+            raise DataValidationError("Unknown filter operator: {}".format(key))
+        column = Customer.__table__.c[field]
+        if operator == "in":
+            values = [item for item in value.split(",") if item != ""]
+            if not values or len(values) > MAX_IN_VALUES:
+                raise DataValidationError(
+                    "{} takes 1 to {} values".format(key, MAX_IN_VALUES)
+                )
+            value = [_convert(column, key, item) for item in values]
+        elif operator == "eq":
+            value = _convert(column, key, value)
+        elif column.type.python_type is not str:
+            raise DataValidationError("{} only applies to text fields".format(key))
+        filters.append(Filter(field, operator, value))
+    return filters
+
+
+def _convert(column, key, value):
+    """ Converts the text of a query parameter to the type of a column """
+    python_type = column.type.python_type
+    if python_type is bool:
+        if value.lower() not in ("true", "false"):
+            raise DataValidationError("{} must be true or false".format(key))
+        return value.lower() == "true"
+    if python_type is int:
+        try:
+            return int(value)
+        except ValueError:
+            raise DataValidationError("{} must be an integer".format(key))
+    return value
+
+
+def apply_filters(query, filters):
+    """ Adds the conditions of the Filters to a query """
+    for field, operator, value in filters:
+        column = Customer.__table__.c[field]
+        if operator == "eq":
+            condition = column == value
+        elif operator == "in":
+            condition = column.in_(value)
+        elif operator == "prefix":
+            condition = column.startswith(value, autoescape=True)
+        elif operator == "suffix":
+            condition = column.endswith(value, autoescape=True)
+        else:
+            condition = column.contains(value, autoescape=True)
+        query = query.filter(condition)
+    return query
+
+
+def uses_index(filter_):
+    """ Returns True when the database can find the matches of a Filter from an index """
+    if filter_.operator in ("eq", "in"):
+        return filter_.field in INDEXED_FIELDS
+    if filter_.operator == "prefix":
+        return filter_.field in Customer.PREFIX_INDEXED_FIELDS
+    return False
+
+
+def is_indexed(filters):
+    """
+    Returns True unless the database has to check many rows per match
+
+    Without filters the pages are ranges of the primary key, and a filter
+    on a selective index narrows the rows down to about the matches. The
+    index of a LOW_SELECTIVITY_FIELDS field returns about half the table:
+    that is fine when every row it returns matches, but not when other
+    filters are checked on those rows one by one. Then, as with filters
+    that cannot use an index at all, the database scans until it finds a
+    page worth of matches, which is why the caller caps such queries.
+    """
+    if any(
+        uses_index(filter_) and filter_.field not in LOW_SELECTIVITY_FIELDS
+        for filter_ in filters
+    ):
+        return True
+    return all(uses_index(filter_) for filter_ in filters)
+
+
+######################################################################
+#  S O R T I N G
+######################################################################
+
+
+def parse_sort(value):
+    """
+    Returns the SortKeys of a ?sort= parameter, ending with the id
+
+    Raises:
+        DataValidationError: when a field is unknown, unindexed or repeated
+    """
+    keys = []
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        field = item.lstrip("-")
+        if field not in INDEXED_FIELDS:
+            raise DataValidationError(
+                "Cannot sort by {}; sortable fields are {}".format(
+                    field, ", ".join(INDEXED_FIELDS)
+                )
+            )
+        if any(key.field == field for key in keys):
+            raise DataValidationError("Cannot sort by {} twice".format(field))
+        if any(key.field == "id" for key in keys):
+            raise DataValidationError("id must be the last sort field")
+        keys.append(SortKey(field, item.startswith("-")))
+    if keys and keys[-1].field != "id":
+        # the unique id breaks ties so that the order, and the cursor, is
+        # total; it follows the last field so that one index serves both
+        keys.append(SortKey("id", keys[-1].descending))
+    return keys
+
+
+def is_range_sort(keys):
+    """
+    Returns True when every page of SortKeys is a range of an index
+
+    The pages of the id alone, or of one RANGE_SORT_FIELDS field and the
+    id in the same direction, start where the cursor is in the (field, id)
+    index. In ascending order the NULLs of a nullable field follow every
+    value, outside of that range, so after() has to OR them in and the
+    database reads the order from its start instead, as for other sorts.
+    """
+    if not keys or [key.field for key in keys] == ["id"]:
+        return True
+    if len(keys) != 2 or keys[0].field not in RANGE_SORT_FIELDS:
+        return False
+    (field, descending), (_, id_descending) = keys
+    if descending != id_descending:
+        return False
+    return descending or not Customer.__table__.c[field].nullable
+
+
+def order_by(keys):
+    """
+    Returns the ORDER BY clauses of SortKeys
+
+    NULLs sort after every value in ascending order and before them in
+    descending order on every database (the PostgreSQL default), which the
+    cursor conditions of after() rely on.
+    """
+    clauses = []
+    for field, descending in keys:
+        column = Customer.__table__.c[field]
+        clause = column.desc() if descending else column.asc()
+        if column.nullable:
+            clause = clause.nullsfirst() if descending else clause.nullslast()
+        clauses.append(clause)
+    return clauses
+
+
+def after(keys, values):
+    """
+    Returns the condition matching the rows that sort after the cursor values
+
+    When the keys share a direction and no NULL can sort after the cursor,
+    that is a single row value comparison, which the database answers from
+    the start of a range of a (field, id) index. Otherwise the condition
+    is expanded into one alternative per sort field.
+    """
+    columns = [Customer.__table__.c[field] for field, _ in keys]
+    descending = keys[0].descending
+    if (
+        all(key.descending == descending for key in keys)
+        and None not in values
+        and (descending or not any(column.nullable for column in columns))
+    ):
+        if descending:
+            return tuple_(*columns) < tuple_(*values)
+        return tuple_(*columns) > tuple_(*values)
+    conditions = []
+    equal = []
+    for (field, descending), value in zip(keys, values):
+        column = Customer.__table__.c[field]
+        if value is None:
+            # only non-NULL values follow a NULL in descending order
+            beyond = column.isnot(None) if descending else None
+        else:
+            beyond = column < value if descending else column > value
+            if column.nullable and not descending:
+                beyond = or_(beyond, column.is_(None))
+        if beyond is not None:
+            conditions.append(and_(*equal, beyond))
+        equal.append(column.is_(None) if value is None else column == value)
+    return or_(*conditions) if conditions else false()
+
+
+def apply_cursor(query, keys, cursor):
+    """ Starts a query ordered by SortKeys after a cursor """
+    return query.filter(after(keys, decode_cursor(keys, cursor)))
+
+
+def encode_cursor(keys, row):
+    """ Returns the cursor of the rows that sort after a row """
+    values = [getattr(row, field) for field, _ in keys]
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(keys, cursor):
+    """
+    Returns the sort values in a cursor
+
+    Raises:
+        DataValidationError: when the cursor was not made for these SortKeys
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, binascii.Error):
+        raise DataValidationError("after is not a valid cursor")
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise DataValidationError("after is not a cursor of this sort order")
+    for (field, _), value in zip(keys, values):
+        column = Customer.__table__.c[field]
+        python_type = column.type.python_type
+        if value is None and column.nullable:
+            continue
+        # bool is an int in Python, but not a valid id
+        if type(value) is not python_type:  # pylint: disable=unidiomatic-typecheck
+            raise DataValidationError("after is not a cursor of this sort order")
+    return values
@@ -0,0 +1,135 @@
+"""
+Idempotency Keys
+
+A client that retries a POST after a timeout cannot tell whether the
+first attempt went through. When it sends the same Idempotency-Key header
+with every attempt, the first one runs and its response is stored; the
+retries get the stored response back, with Idempotent-Replayed: true,
+without running the request again.
+
+Duplicates sent at the same time to one worker wait for the first one
+and then replay its response. A duplicate reaching another worker while
+the first one still runs gets 409 Conflict and a Retry-After header. A
+key sent again with another request body is refused with 422.
+"""
+import contextlib
+import functools
+import hashlib
+import json
+import re
+import threading
+from flask import current_app, request
+from werkzeug.exceptions import BadRequest, Conflict, UnprocessableEntity
+from service.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+# Keys accepted from clients: printable ASCII, at most the size of the column
+KEY_PATTERN = re.compile(r"^[\x21-\x7e]{1,255}$")
+# Headers of a response stored along with its body
+STORED_HEADERS = ("Location", "ETag")
+
+# Lock of each key some request of this process is running, with its number of users
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def idempotent(view):
+    """ Makes a view replay its response to requests repeating an Idempotency-Key """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return view(*args, **kwargs)
+        if not KEY_PATTERN.match(key):
+            raise BadRequest(
+                "{} must be 1 to 255 printable ASCII characters".format(IDEMPOTENCY_HEADER)
+            )
+        fingerprint = request_fingerprint()
+        with key_lock(key):
+            stored = IdempotencyKey.find_response(key)
+            if stored is None and IdempotencyKey.claim(key, fingerprint):
+                return run_and_store(key, view, args, kwargs)
+            if stored is None:
+                # the request holding the key may have just stored its response
+                stored = IdempotencyKey.find_response(key)
+            if stored is None:
+                raise KeyInUse()
+        return replay(stored, fingerprint)
+
+    return wrapper
+
+
+def run_and_store(key, view, args, kwargs):
+    """ Runs a view for a claimed key, and stores its response when it succeeded """
+    try:
+        response = current_app.make_response(view(*args, **kwargs))
+    except Exception:
+        IdempotencyKey.release(key)
+        raise
+    if not 200 <= response.status_code < 300:
+        # a failed request did not happen, so its retry runs again
+        IdempotencyKey.release(key)
+        return response
+    headers = {
+        name: response.headers[name] for name in STORED_HEADERS if name in response.headers
+    }
+    headers["Content-Type"] = response.mimetype
+    IdempotencyKey.store_response(
+        key, response.status_code, json.dumps(headers), response.get_data()
+    )
+    IdempotencyKey.purge_if_due()
+    return response
+
+
+def replay(stored, fingerprint):
+    """ Returns a stored response, unless it answered another request """
+    if stored["fingerprint"] != fingerprint:
+        raise UnprocessableEntity(
+            "This {} was already used by another request".format(IDEMPOTENCY_HEADER)
+        )
+    headers = json.loads(stored["headers"])
+    response = current_app.response_class(
+        stored["body"], status=stored["status"], mimetype=headers.pop("Content-Type")
+    )
+    response.headers.extend(headers)
+    response.headers[REPLAYED_HEADER] = "true"
+    return response
+
+
+def request_fingerprint():
+    """ Returns a digest of the method, path and body of the current request """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(request.method.encode("ascii"))
+    digest.update(request.full_path.encode("utf-8"))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+class KeyInUse(Conflict):
+    """ Another worker is running a request with the same Idempotency-Key """
+
+    description = "A request with this {} is still running".format(IDEMPOTENCY_HEADER)
+    retry_after = 1
+
+
+######################################################################
+#  K E Y   L O C K S
+######################################################################
+
+
+@contextlib.contextmanager
+def key_lock(key):
+    """ Holds the lock of a key in this process, so that duplicates wait for each other """
+    with _locks_lock:
+        entry = _locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _locks[key]
@@ -0,0 +1,343 @@
+"""
+Request Limits
+
+Keeps one client, or a burst of them, from taking the database away from
+everyone else.
+
+Rate limiting gives each client a token bucket of RATE_LIMIT_BURST
+requests, refilled at RATE_LIMIT_PER_SECOND. A request finding the bucket
+of its client empty is refused with 429 Too Many Requests and a
+Retry-After of the time until its next token. Clients are told apart by
+their X-Api-Key header, or else by their address. The buckets are kept in
+each worker ("memory"), or in a SQLite file shared by the workers of a
+host ("host") so that a client gets the same rate whichever worker serves
+it.
+
+Admission control refuses requests with 503 Service Unavailable and a
+Retry-After while a worker is overloaded: when it already runs
+ADMISSION_MAX_IN_FLIGHT requests, or while checkouts of the connection
+pool have recently waited longer than ADMISSION_MAX_POOL_WAIT_MS.
+Refusing them at once keeps latency bounded, where queuing for the pool
+would make every request wait up to DB_POOL_TIMEOUT.
+
+/status and /metrics are never limited, so monitoring keeps working under
+load.
+"""
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from service.metrics import current_engine
+from service.pool import InstrumentedQueuePool
+
+BACKENDS = ("memory", "host")
+API_KEY_HEADER = "X-Api-Key"
+LIMIT_HEADER = "X-RateLimit-Limit"
+REMAINING_HEADER = "X-RateLimit-Remaining"
+EXEMPT_ENDPOINTS = ("service_status", "service_metrics")
+
+logger = logging.getLogger(__name__)
+
+# set by init_limits() from the configuration of the app
+_settings = {"buckets": None, "trusted_proxies": 0, "max_in_flight": 0, "max_pool_wait_ms": 0}
+_state = {"in_flight": 0, "limited": 0, "shed": 0}
+_state_lock = threading.Lock()
+
+
+def init_limits(app):
+    """ Limits the requests of an app, as its configuration asks """
+    configure(app.config)
+    app.before_request(admit_request)
+    app.after_request(add_rate_limit_headers)
+    app.teardown_request(finish_request)
+
+
+def configure(config):
+    """
+    Applies the rate limit and admission settings of a configuration
+
+    Raises:
+        ValueError: when RATE_LIMIT_BACKEND is not a known backend
+    """
+    _settings.update(
+        buckets=create_buckets(
+            config.get("RATE_LIMIT_PER_SECOND", 0),
+            config.get("RATE_LIMIT_BURST", 20),
+            config.get("RATE_LIMIT_BACKEND", "memory"),
+            config.get("RATE_LIMIT_FILE"),
+            config.get("RATE_LIMIT_CLIENTS", 10000),
+        ),
+        trusted_proxies=config.get("RATE_LIMIT_TRUSTED_PROXIES", 0),
+        max_in_flight=config.get("ADMISSION_MAX_IN_FLIGHT", 0),
+        max_pool_wait_ms=config.get("ADMISSION_MAX_POOL_WAIT_MS", 0),
+    )
+
+
+def stats():
+    """ Returns the requests in flight, refused and shed by this worker """
+    buckets = _settings["buckets"]
+    with _state_lock:
+        result = dict(_state)
+    result["rate_limit"] = buckets.stats() if buckets is not None else {"backend": "off"}
+    return result
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+
+
+def admit_request():
+    """ Refuses the current request when its client or the worker is over its limit """
+    # the app context, and so g, can outlive a request in sync workers
+    g.pop("rate_limit_remaining", None)
+    if request.endpoint in EXEMPT_ENDPOINTS:
+        return
+    with _state_lock:
+        if 0 < _settings["max_in_flight"] <= _state["in_flight"]:
+            _state["shed"] += 1
+            raise ServiceUnavailable(
+                "The service is busy: {} requests are running".format(_state["in_flight"]),
+                retry_after=1,
+            )
+        _state["in_flight"] += 1
+    # released by finish_request(), whatever happens next
+    g.in_flight = True
+    wait = pool_wait()
+    if 0 < _settings["max_pool_wait_ms"] < wait * 1000:
+        with _state_lock:
+            _state["shed"] += 1
+        raise ServiceUnavailable(
+            "The database is busy: connections waited {:.0f} ms".format(wait * 1000),
+            retry_after=retry_seconds(wait),
+        )
+    buckets = _settings["buckets"]
+    if buckets is None:
+        return
+    remaining, wait = buckets.take(client_key())
+    if wait:
+        with _state_lock:
+            _state["limited"] += 1
+        raise TooManyRequests(
+            "Rate limit of {:g} requests per second exceeded".format(buckets.rate),
+            retry_after=retry_seconds(wait),
+        )
+    g.rate_limit_remaining = int(remaining)
+
+
+def add_rate_limit_headers(response):
+    """ Tells the client how many requests its bucket holds, and has left """
+    remaining = g.pop("rate_limit_remaining", None)
+    if remaining is not None:
+        response.headers[LIMIT_HEADER] = str(_settings["buckets"].burst)
+        response.headers[REMAINING_HEADER] = str(remaining)
+    return response
+
+
+def finish_request(error=None):  # pylint: disable=unused-argument
+    """ Frees the place of the current request among those in flight """
+    if g.pop("in_flight", False):
+        with _state_lock:
+            _state["in_flight"] -= 1
+
+
+def client_key():
+    """ Returns the key of the bucket of the current request's client """
+    api_key = request.headers.get(API_KEY_HEADER)
+    if api_key:
+        # API keys are secrets: only their digest is kept
+        return "key:" + hashlib.sha1(api_key.encode("utf-8")).hexdigest()
+    address = request.remote_addr
+    proxies = _settings["trusted_proxies"]
+    if proxies:
+        # each trusted proxy appends the address it received the request from
+        forwarded = [
+            hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",")
+            if hop.strip()
+        ]
+        if len(forwarded) >= proxies:
+            address = forwarded[-proxies]
+    return "ip:{}".format(address)
+
+
+def pool_wait():
+    """ Returns how long checkouts of the connection pool have recently waited, in seconds """
+    pool = current_engine().pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.recent_wait()
+    return 0.0
+
+
+def retry_seconds(wait):
+    """ Returns a Retry-After for a wait in seconds: whole seconds, 1 at least """
+    return max(1, math.ceil(wait))
+
+
+######################################################################
+#  T O K E N   B U C K E T S
+######################################################################
+
+
+def refill(tokens, updated, now, rate, burst):
+    """
+    Takes a token from a bucket, after adding the tokens earned since it was updated
+
+    Returns:
+        (float, float): the tokens left, and 0 when a token was taken or
+            else the seconds until the bucket holds one
+    """
+    tokens = min(burst, tokens + max(now - updated, 0) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class TokenBuckets:
+    """ The token buckets of the clients of a worker, the least recently seen dropped first """
+
+    backend = "memory"
+
+    def __init__(self, rate, burst, max_clients=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """
+        Takes a token from the bucket of a client
+
+        Returns:
+            (float, float): the tokens left, and 0 when a token was taken or
+                else the seconds until the bucket holds one
+        """
+        now = self.clock()
+        with self._lock:
+            # a client seen for the first time starts with a full bucket
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens, wait = refill(tokens, updated, now, self.rate, self.burst)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return tokens, wait
+
+    def stats(self):
+        """ Returns the settings of the buckets and the number of clients seen """
+        with self._lock:
+            clients = len(self._buckets)
+        return {
+            "backend": self.backend,
+            "rate": self.rate,
+            "burst": self.burst,
+            "clients": clients,
+        }
+
+
+class SharedTokenBuckets(TokenBuckets):
+    """
+    Token buckets shared by the workers of a host through a SQLite file
+
+    Each take runs in an IMMEDIATE transaction, which the workers of the
+    host run one at a time. A bucket left alone long enough to fill up is
+    the same as a missing one, so those are deleted now and then to keep
+    the file small. When the file stays locked longer than ``timeout``
+    seconds the request is let through rather than failed.
+    """
+
+    backend = "host"
+
+    def __init__(self, path, rate, burst, clock=time.time, timeout=1.0):
+        super().__init__(rate, burst, clock=clock)
+        self.path = path
+        self.timeout = timeout
+        self.errors = 0
+        self._local = threading.local()
+        self._purged_at = 0.0
+        connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets"
+                " (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+        finally:
+            connection.close()
+
+    def _connection(self):
+        """ Returns the connection of the current thread, opened after any fork """
+        pid, connection = getattr(self._local, "connection", (None, None))
+        if pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.connection = (os.getpid(), connection)
+        return connection
+
+    def take(self, key):
+        now = self.clock()
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as error:
+            return self._fail_open(error)
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row is not None else (self.burst, now)
+            tokens, wait = refill(tokens, updated, now, self.rate, self.burst)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+            # a bucket fills up in burst / rate seconds
+            full_after = self.burst / self.rate
+            if now - self._purged_at > full_after:
+                self._purged_at = now
+                connection.execute("DELETE FROM buckets WHERE updated < ?", (now - full_after,))
+            connection.execute("COMMIT")
+        except sqlite3.OperationalError as error:
+            connection.execute("ROLLBACK")
+            return self._fail_open(error)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return tokens, wait
+
+    def _fail_open(self, error):
+        """ Lets a request through when the buckets cannot be read """
+        with self._lock:
+            self.errors += 1
+        logger.warning("Rate limit not applied: %s", error)
+        return 0.0, 0.0
+
+    def stats(self):
+        with self._lock:
+            errors = self.errors
+        try:
+            (clients,) = self._connection().execute("SELECT count(*) FROM buckets").fetchone()
+        except sqlite3.OperationalError:
+            clients = None
+        return {
+            "backend": self.backend,
+            "rate": self.rate,
+            "burst": self.burst,
+            "clients": clients,
+            "errors": errors,
+        }
+
+
+def create_buckets(rate, burst, backend="memory", path=None, max_clients=10000):
+    """ Returns the token buckets of a RATE_LIMIT_BACKEND, or None when the rate is 0 """
+    if backend not in BACKENDS:
+        raise ValueError("Rate limit backend must be one of {}".format(", ".join(BACKENDS)))
+    if rate <= 0:
+        return None
+    if backend == "host":
+        return SharedTokenBuckets(path, rate, burst)
+    return TokenBuckets(rate, burst, max_clients)
@@ -0,0 +1,262 @@
+"""
+Logging
+
+Log records are handed to a bounded in-memory queue, and a background
+listener thread formats them and writes them out through the gunicorn
+handlers, so requests never wait on formatting or write syscalls. When
+the queue is full the record is dropped and counted instead.
+
+Records are JSON objects, one per line, carrying the id of the request
+that logged them: the X-Request-Id header of the request when it sends a
+valid one, or a new id, echoed in the X-Request-Id of the response.
+LOG_FORMAT=text keeps the former plain text lines.
+
+LOG_SAMPLE_RATES keeps only a share of the records of some levels, e.g.
+``INFO=0.05,DEBUG=0``. The choice is made once per request, so a sampled
+request keeps all of its records of that level. Warnings and errors are
+kept unless a rate is given for them too.
+"""
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import uuid
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from flask import g, has_request_context, request
+from service import encoding
+
+REQUEST_ID_HEADER = "X-Request-Id"
+# Request ids accepted from clients: short, and safe to write in a log line
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] [%(request_id)s] %(message)s"
+TEXT_DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+_counters = {"queued": 0, "dropped": 0, "sampled_out": 0}
+_counters_lock = threading.Lock()
+_listener = {"listener": None, "pid": None}
+
+
+def init_logging(app, handlers):
+    """
+    Sends the log records of an app and the service to handlers through a queue
+
+    Args:
+        app (Flask): the app, configured with LOG_FORMAT, LOG_QUEUE_SIZE,
+            LOG_SAMPLE_RATES and LOG_MODEL_LEVEL
+        handlers (list): the handlers writing the records out
+    """
+    if app.config.get("LOG_FORMAT", "json") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter(TEXT_FORMAT, TEXT_DATE_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    # ahead of the hooks registered before, such as the request limits, so
+    # that the requests they refuse get their own id too
+    app.before_request_funcs.setdefault(None, []).insert(0, assign_request_id)
+    app.after_request(add_request_id)
+    # the modules of the service log to "flask.app", which Flask 1.1 does not
+    # name its logger any more, so that it reaches nothing by itself
+    loggers = [app.logger, logging.getLogger("flask.app")]
+    for logger in loggers:
+        logger.propagate = False
+    # the models log every call at INFO, which would multiply the records of
+    # each request, so they only log warnings unless LOG_MODEL_LEVEL says more
+    loggers[1].setLevel(app.config.get("LOG_MODEL_LEVEL", "WARNING"))
+    if not handlers:
+        # nowhere to write to, as when the app is not run by gunicorn
+        app.logger.handlers = []
+        return
+    handler = AsyncHandler(queue.Queue(maxsize=app.config.get("LOG_QUEUE_SIZE", 10000)))
+    handler.addFilter(RequestIdFilter())
+    rates = parse_sample_rates(app.config.get("LOG_SAMPLE_RATES", ""))
+    if rates:
+        handler.addFilter(SamplingFilter(rates))
+    start_listener(handler.queue, handlers)
+    for logger in loggers:
+        logger.handlers = [handler]
+
+
+def start_listener(records, handlers):
+    """ Starts the thread writing out the queued records, replacing any previous one """
+    stop_listener()
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _listener.update(listener=listener, pid=os.getpid())
+
+
+def stop_listener():
+    """ Writes out the queued records and stops the listener thread """
+    listener = _listener["listener"]
+    # a forked worker inherits the listener, but not its thread
+    if listener is not None and _listener["pid"] == os.getpid():
+        listener.stop()
+    _listener["pid"] = None
+
+
+def restart_listener():
+    """ Starts the listener thread again, when it is not running in this process """
+    listener = _listener["listener"]
+    if listener is not None and _listener["pid"] != os.getpid():
+        listener.start()
+        _listener["pid"] = os.getpid()
+
+
+atexit.register(stop_listener)
+
+
+def stats():
+    """ Returns the counters of the log queue """
+    with _counters_lock:
+        return dict(_counters)
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def parse_sample_rates(value):
+    """
+    Returns the sample rate of each level of a LOG_SAMPLE_RATES setting
+
+    Raises:
+        ValueError: when a level or a rate is not valid
+    """
+    rates = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError("Unknown log level in LOG_SAMPLE_RATES: {}".format(name))
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError("Log sample rates must be between 0 and 1: {}".format(item))
+        rates[level] = rate
+    return rates
+
+
+######################################################################
+#  R E Q U E S T   I D S
+######################################################################
+
+
+def assign_request_id():
+    """ Gives the current request the id its client sent, or a new one """
+    request_id = request.headers.get(REQUEST_ID_HEADER, "")
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+    g.request_id = request_id
+    g.log_sample = random.random()
+
+
+def add_request_id(response):
+    """ Echoes the request id in the response """
+    request_id = g.get("request_id")
+    if request_id is not None:
+        response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+
+def current_request_id():
+    """ Returns the id of the current request, or None outside of a request """
+    if not has_request_context():
+        return None
+    return g.get("request_id")
+
+
+######################################################################
+#  H A N D L E R S   A N D   F I L T E R S
+######################################################################
+
+
+class AsyncHandler(QueueHandler):
+    """ A QueueHandler that drops records instead of waiting for room in the queue """
+
+    def prepare(self, record):
+        """
+        Merges the arguments into the message in the calling thread
+
+        Only the message is rendered here, since the arguments may change
+        once the call returns; formatting is left to the listener.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        """ Queues a record, or drops it when the queue is full """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _count("dropped")
+            return
+        _count("queued")
+
+
+class RequestIdFilter(logging.Filter):
+    """ Adds the id of the current request to the records, in the calling thread """
+
+    def filter(self, record):
+        record.request_id = current_request_id() or "-"
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps a share of the records of some levels, by request """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None:
+            return True
+        sample = g.get("log_sample") if has_request_context() else None
+        if sample is None:
+            sample = random.random()
+        if sample < rate:
+            return True
+        _count("sampled_out")
+        return False
+
+
+class TextFormatter(logging.Formatter):
+    """ Formats records as plain text lines, with the request id when there is one """
+
+    def format(self, record):
+        # the records of gunicorn itself do not go through RequestIdFilter
+        if not hasattr(record, "request_id"):
+            record.request_id = "-"
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats records as single line JSON objects """
+
+    def format(self, record):
+        data = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ) + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", "-")
+        if request_id != "-":
+            data["request_id"] = request_id
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        return encoding.dumps(data).decode("utf-8")
@@ -0,0 +1,180 @@
+"""
+Metrics
+
+Prometheus metrics of the service, exposed in text format at /metrics:
+request durations per endpoint, method and status code, the SQL
+statements and database time of each request (from SQLAlchemy engine
+events), the time spent serializing response bodies, and the state of
+the connection pool.
+
+Every gunicorn worker keeps its own metrics. To report them as a single
+service, point PROMETHEUS_MULTIPROC_DIR at an empty directory shared by
+the workers before starting gunicorn; gunicorn.conf.py cleans it up.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.pool import pool_stats
+
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, float("inf"))
+
+REQUEST_DURATION = Histogram(
+    "customers_http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["endpoint", "method", "status"],
+)
+REQUEST_QUERIES = Histogram(
+    "customers_http_request_db_queries",
+    "SQL statements issued per HTTP request",
+    ["endpoint"],
+    buckets=QUERY_BUCKETS,
+)
+REQUEST_DB_TIME = Histogram(
+    "customers_http_request_db_seconds",
+    "Time spent in SQL statements per HTTP request",
+    ["endpoint"],
+)
+SERIALIZATION_TIME = Histogram(
+    "customers_http_request_serialization_seconds",
+    "Time spent serializing the response body per HTTP request",
+    ["endpoint"],
+)
+POOL_CHECKED_OUT = Gauge(
+    "customers_db_pool_checked_out",
+    "Connections checked out of the pool",
+    multiprocess_mode="livesum",
+)
+POOL_OVERFLOW = Gauge(
+    "customers_db_pool_overflow",
+    "Connections open beyond the pool size",
+    multiprocess_mode="livesum",
+)
+POOL_WAITS = Counter(
+    "customers_db_pool_waits", "Checkouts that waited for a free connection"
+)
+POOL_WAIT_TIME = Counter(
+    "customers_db_pool_wait_seconds", "Time spent waiting for a free connection"
+)
+POOL_TIMEOUTS = Counter(
+    "customers_db_pool_timeouts", "Checkouts that gave up waiting for a connection"
+)
+
+# pool counters already reported by this process, to report only the increase
+_reported = {"pool": None, "waits": 0, "wait_time": 0.0, "timeouts": 0}
+_reported_lock = threading.Lock()
+
+
+def init_metrics(app):
+    """ Starts collecting the request and database metrics of an app """
+    app.before_request(start_request)
+    app.after_request(record_request)
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
+
+
+def start_request():
+    """ Resets the per-request counters """
+    # the app context, and so g, can outlive a request in sync workers
+    g.request_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_time = 0.0
+    g.serialization_time = 0.0
+
+
+def record_request(response):
+    """ Observes the metrics of a finished request """
+    start = g.pop("request_start", None)
+    if start is None:
+        return response
+    endpoint = request.endpoint or "unmatched"
+    REQUEST_DURATION.labels(endpoint, request.method, str(response.status_code)).observe(
+        time.perf_counter() - start
+    )
+    REQUEST_QUERIES.labels(endpoint).observe(g.db_queries)
+    REQUEST_DB_TIME.labels(endpoint).observe(g.db_time)
+    SERIALIZATION_TIME.labels(endpoint).observe(g.serialization_time)
+    update_pool_metrics(current_engine().pool)
+    return response
+
+
+@contextmanager
+def serialization_timer():
+    """ Adds the time spent in the block to the request's serialization time """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and "serialization_time" in g:
+            g.serialization_time += time.perf_counter() - start
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Notes when a SQL statement starts """
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Adds a finished SQL statement to the request's counters """
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_time += elapsed
+
+
+def handle_error(context):
+    """ Forgets the start of a SQL statement that failed """
+    starts = context.connection.info.get("query_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def update_pool_metrics(pool):
+    """ Copies the state of a connection pool into the pool metrics """
+    stats = pool_stats(pool)
+    POOL_CHECKED_OUT.set(stats.get("checked_out", 0))
+    POOL_OVERFLOW.set(stats.get("overflow", 0))
+    with _reported_lock:
+        if _reported["pool"] is not pool:
+            # a disposed engine starts a new pool with fresh counters
+            _reported.update(pool=pool, waits=0, wait_time=0.0, timeouts=0)
+        for key, counter in (
+            ("waits", POOL_WAITS),
+            ("wait_time", POOL_WAIT_TIME),
+            ("timeouts", POOL_TIMEOUTS),
+        ):
+            value = stats.get(key, 0)
+            if value > _reported[key]:
+                counter.inc(value - _reported[key])
+                _reported[key] = value
+
+
+def current_engine():
+    """ Returns the engine of the Flask-SQLAlchemy extension of the current app """
+    return current_app.extensions["sqlalchemy"].db.engine
+
+
+def render():
+    """ Returns the metrics in Prometheus text format and their content type """
+    update_pool_metrics(current_engine().pool)
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
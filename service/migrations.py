@@ -0,0 +1,247 @@
+"""
+Schema Migrations
+
+upgrade() creates the tables that are missing, but that does not change
+the tables of an existing deployment, so changes to the schema are made by
+the versioned migrations in this module. The version applied last is
+recorded in the schema_version table and upgrade() applies every newer
+migration in order.
+
+The service does not touch the schema when it starts. Run the migrations
+before deploying, or set DB_AUTO_MIGRATE to run them at startup:
+    flask db-upgrade
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, text
+from sqlalchemy import func, inspect, select
+
+logger = logging.getLogger("flask.app")
+
+# Arbitrary key of the PostgreSQL advisory lock held while migrating
+MIGRATION_LOCK_ID = 727274
+
+metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(256), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# (version, description, function) in the order they must be applied
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """ Registers a function as the migration to a schema version """
+
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return function
+
+    return register
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+
+
+@migration(1, "Index the Customer lookup columns")
+def index_customer_lookups(connection):
+    """ Adds the indexes used by the name, email, phone and active lookups """
+    for column in ("name", "email", "phone_number", "active"):
+        create_index(connection, "ix_customer_" + column, "customer", column)
+
+
+@migration(2, "Add the Customer row version")
+def add_customer_version(connection):
+    """ Adds the version column used for ETags and optimistic locking """
+    add_column(connection, "customer", "version", "INTEGER NOT NULL DEFAULT 1")
+
+
+@migration(3, "Index the Customer prefix filters")
+def index_customer_prefixes(connection):
+    """ Adds the pattern indexes used by the __prefix filters on PostgreSQL """
+    if connection.dialect.name != "postgresql":
+        # SQLite plans LIKE from the plain indexes, or not at all
+        return
+    for column in ("name", "phone_number", "email"):
+        create_index(
+            connection,
+            "ix_customer_{}_pattern".format(column),
+            "customer",
+            "{} varchar_pattern_ops".format(column),
+        )
+
+
+@migration(4, "Index the Customer search fields")
+def index_customer_search(connection):
+    """ Adds the trigram indexes used by Customer.search on PostgreSQL """
+    if connection.dialect.name != "postgresql":
+        # other databases search an in-process index
+        return
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for column in ("name", "email", "address"):
+        create_index(
+            connection,
+            "ix_customer_{}_trgm".format(column),
+            "customer",
+            "{} gin_trgm_ops".format(column),
+            using="gin",
+        )
+
+
+@migration(5, "Add the Customer soft delete marker")
+def add_customer_deleted_at(connection):
+    """ Adds the deleted_at column of soft deletes and the index used to purge them """
+    add_column(connection, "customer", "deleted_at", "TIMESTAMP")
+    create_index(
+        connection,
+        "ix_customer_deleted_at",
+        "customer",
+        "deleted_at",
+        where="deleted_at IS NOT NULL",
+    )
+
+
+@migration(6, "Index the Customer sort orders")
+def index_customer_sort_orders(connection):
+    """ Adds the (field, id) indexes that sorted pages are ranges of """
+    for column in ("name", "phone_number", "email", "active"):
+        create_index(
+            connection, "ix_customer_{}_id".format(column), "customer", "{}, id".format(column)
+        )
+
+
+@migration(7, "Rank the Customer searches from GiST indexes")
+def index_customer_search_gist(connection):
+    """ Replaces the GIN trigram indexes by GiST ones, which return matches nearest first """
+    if connection.dialect.name != "postgresql":
+        return
+    for column in ("name", "email", "address"):
+        create_index(
+            connection,
+            "ix_customer_{}_trgm_gist".format(column),
+            "customer",
+            "{} gist_trgm_ops".format(column),
+            using="gist",
+        )
+        drop_index(connection, "ix_customer_{}_trgm".format(column))
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+
+
+def create_index(connection, name, table, columns, using=None, where=None):
+    """
+    Creates an index unless it already exists
+
+    On PostgreSQL the index is built CONCURRENTLY so that writes to the
+    table are not blocked while it is built. A concurrent build that failed
+    leaves an invalid index behind, so one is dropped before retrying.
+    """
+    if connection.dialect.name == "postgresql":
+        invalid = connection.execute(
+            text(
+                "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+            ),
+            name=name,
+        ).scalar()
+        if invalid:
+            logger.warning("Dropping invalid index %s", name)
+            connection.execute(text("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name)))
+        statement = "CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}({}){}"
+    else:
+        statement = "CREATE INDEX IF NOT EXISTS {} ON {} {}({}){}"
+    method = "USING {} ".format(using) if using else ""
+    # a partial index only covers the rows matching the condition
+    condition = " WHERE {}".format(where) if where else ""
+    logger.info("Creating index %s on %s (%s)", name, table, columns)
+    connection.execute(text(statement.format(name, table, method, columns, condition)))
+
+
+def drop_index(connection, name):
+    """ Drops an index if it exists, CONCURRENTLY on PostgreSQL """
+    concurrently = "CONCURRENTLY " if connection.dialect.name == "postgresql" else ""
+    logger.info("Dropping index %s", name)
+    connection.execute(text("DROP INDEX {}IF EXISTS {}".format(concurrently, name)))
+
+
+def add_column(connection, table, name, definition):
+    """
+    Adds a column unless it already exists
+
+    A constant default keeps this cheap on PostgreSQL 11 and later, where
+    the existing rows are not rewritten.
+    """
+    columns = {column["name"] for column in inspect(connection).get_columns(table)}
+    if name in columns:
+        return
+    logger.info("Adding column %s.%s", table, name)
+    connection.execute(
+        text("ALTER TABLE {} ADD COLUMN {} {}".format(table, name, definition))
+    )
+
+
+def current_version(engine):
+    """ Returns the schema version of the database (0 when never migrated) """
+    metadata.create_all(engine)
+    return engine.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def upgrade(engine, target=None, tables=None):
+    """
+    Applies every migration newer than the schema version of the database
+
+    Args:
+        engine (Engine): the engine of the database to migrate
+        target (int): the version to stop at (defaults to the latest)
+        tables (MetaData): tables to create first, when they are missing
+
+    Returns:
+        int: the schema version of the database after the upgrade
+    """
+    if engine.dialect.name != "postgresql":
+        return apply_migrations(engine, target, tables)
+    with engine.connect() as lock:
+        # keep several workers starting at once from migrating together
+        lock.execute(text("SELECT pg_advisory_lock(:id)"), id=MIGRATION_LOCK_ID)
+        try:
+            return apply_migrations(engine, target, tables)
+        finally:
+            lock.execute(text("SELECT pg_advisory_unlock(:id)"), id=MIGRATION_LOCK_ID)
+
+
+def apply_migrations(engine, target=None, tables=None):
+    """ Applies the pending migrations one at a time and records each one """
+    if tables is not None:
+        # a new database gets the latest tables, which the migrations then skip
+        tables.create_all(engine)
+    version = current_version(engine)
+    for number, description, function in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        logger.info("Applying migration %d: %s", number, description)
+        if engine.dialect.name == "postgresql":
+            # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+            with engine.connect() as connection:
+                function(connection.execution_options(isolation_level="AUTOCOMMIT"))
+        else:
+            with engine.begin() as connection:
+                function(connection)
+        engine.execute(
+            schema_version.insert().values(
+                version=number, description=description, applied_at=datetime.utcnow()
+            )
+        )
+        version = number
+    logger.info("Database schema is at version %d", version)
+    return version
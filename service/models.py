@@ -4,12 +4,34 @@ Models for Customer
 All of the models are stored in this module
 """
 import logging
-from flask_sqlalchemy import SQLAlchemy
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import DDL, and_, event, func, literal, or_, select, union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.exc import StaleDataError
+from service import migrations, pool, replicas
+from service.cache import NullCache, create_cache
+from service.search import NgramIndex
+from service.singleflight import NullSingleFlight, create_single_flight
 
 logger = logging.getLogger("flask.app")
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Create the SQLAlchemy object to be initialized later in init_db(); its
+# sessions send the reads of GET requests to the replicas, when there are some
+db = replicas.RoutingSQLAlchemy()
+
+
+def end_session(error=None):  # pylint: disable=unused-argument
+    """ Returns the connections of the session of a request to their pools """
+    db.session.remove()
+
+
+@event.listens_for(db.session, "after_commit")
+def end_lookups(session):  # pylint: disable=unused-argument
+    """ Keeps the lookups started from now on out of the flights started before a commit """
+    Customer.lookups.wrote()
 
 
 class DataValidationError(Exception):
@@ -24,15 +46,51 @@ class Customer(db.Model):
     """
 
     app = None
+    # Read-through cache of Customer.find, configured in init_db()
+    cache = NullCache()
+    # Shares one query among concurrent identical lookups, configured in init_db()
+    lookups = NullSingleFlight()
+    # Trigram index of Customer.search on databases without pg_trgm
+    search_index = NgramIndex()
+    # Mark deleted CustomersModels instead of removing them, set in init_db()
+    soft_delete = False
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(63))
+    name = db.Column(db.String(63), index=True)
     address = db.Column(db.String(256), nullable=False)
-    phone_number = db.Column(db.String(63), nullable=False)
-    email = db.Column(db.String(63), nullable=False)
+    phone_number = db.Column(db.String(63), nullable=False, index=True)
+    email = db.Column(db.String(63), nullable=False, index=True)
     credit_card = db.Column(db.String(63), nullable=False)
-    active = db.Column(db.Boolean, nullable=False)
+    active = db.Column(db.Boolean, nullable=False, index=True)
+    # Row version, bumped on every UPDATE and checked in its WHERE clause
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # When a soft delete hid the row; purge() removes it for good later
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    __mapper_args__ = {"version_id_col": version}
+    __table_args__ = (
+        # only the few soft-deleted rows are indexed on PostgreSQL
+        db.Index(
+            "ix_customer_deleted_at", deleted_at, postgresql_where=deleted_at.isnot(None)
+        ),
+        # each page of a sort on one field is a range of its (field, id) index
+        db.Index("ix_customer_name_id", name, id),
+        db.Index("ix_customer_phone_number_id", phone_number, id),
+        db.Index("ix_customer_email_id", email, id),
+        db.Index("ix_customer_active_id", active, id),
+    )
+
+    # The fields returned by serialize(), in order
+    SERIALIZED_FIELDS = (
+        "id", "name", "address", "phone_number", "email", "credit_card", "active"
+    )
+    # The fields a client can change
+    UPDATABLE_FIELDS = ("name", "address", "phone_number", "email", "credit_card", "active")
+    # Fields with a pattern index on PostgreSQL for LIKE 'prefix%' filters
+    PREFIX_INDEXED_FIELDS = ("name", "phone_number", "email")
+    # Fields matched by search(), with a trigram index on PostgreSQL
+    SEARCH_FIELDS = ("name", "email", "address")
 
     def __repr__(self):
         return "<CustomersModel %r id=[%s]>" % (self.name, self.id)
@@ -45,19 +103,368 @@ class Customer(db.Model):
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
         db.session.commit()
+        self.cache.delete(self.id)
 
     def save(self):
         """
         Updates a Customer to the database
         """
         logger.info("Saving %s", self.name)
-        db.session.commit()
+        customer_id = self.id
+        try:
+            # raises StaleDataError when another writer changed the version
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            self.cache.delete(customer_id)
 
     def delete(self):
         """ Removes a Customer from the data store """
         logger.info("Deleting %s", self.name)
+        if self.soft_delete:
+            self.deleted_at = datetime.utcnow()
+            self.save()
+            return
+        customer_id = self.id
         db.session.delete(self)
         db.session.commit()
+        self.cache.delete(customer_id)
+
+    @classmethod
+    def create_many(cls, customers, chunk_size=1000):
+        """
+        Creates CustomersModels in bulk using a single transaction
+
+        The rows are inserted ``chunk_size`` at a time; on PostgreSQL each
+        chunk is one multi-row INSERT ... RETURNING id statement.
+
+        Args:
+            customers (iterable): the CustomersModels to insert
+            chunk_size (int): the number of rows inserted per statement
+
+        Returns:
+            list: the ids assigned to the new CustomersModels, in order
+        """
+        logger.info("Creating CustomersModels in bulk")
+        ids = []
+        chunk = []
+        try:
+            for customer in customers:
+                chunk.append(customer)
+                if len(chunk) >= chunk_size:
+                    ids.extend(cls._insert_chunk(chunk))
+                    chunk = []
+            if chunk:
+                ids.extend(cls._insert_chunk(chunk))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        logger.info("Created %d CustomersModels", len(ids))
+        return ids
+
+    @classmethod
+    def update_many(cls, values, query=None, ids=None, chunk_size=1000):
+        """
+        Updates CustomersModels with set-based UPDATE statements in a single transaction
+
+        Only the given columns are written, and the version of every updated
+        row is bumped. With ``ids`` one statement is run per ``chunk_size``
+        ids; otherwise every CustomersModel the query matches is updated by
+        a single statement.
+
+        Args:
+            values (dict): the new values of the fields to change
+            query (Query): an optional filtered query selecting the CustomersModels
+            ids (list): an optional list of ids further selecting the CustomersModels
+            chunk_size (int): the number of ids per statement
+
+        Returns:
+            int: the number of CustomersModels updated
+        """
+        logger.info("Updating CustomersModels in bulk")
+        values = dict(values, version=cls.version + 1)
+        count = cls._execute_many(
+            lambda chunk: chunk.update(values, synchronize_session=False),
+            query,
+            ids,
+            chunk_size,
+        )
+        logger.info("Updated %d CustomersModels", count)
+        return count
+
+    @classmethod
+    def update_by_id(cls, customer_id, values, versions=None):
+        """
+        Updates one CustomersModel without reading it first
+
+        On PostgreSQL this is a single UPDATE ... RETURNING statement; other
+        databases read the updated row back in the same transaction. Only
+        the given columns are written, and the version is bumped.
+
+        Args:
+            customer_id (int): the id of the CustomersModel
+            values (dict): the new values of the fields to change
+            versions (list): only update the CustomersModel if it still has one of these versions
+
+        Returns:
+            CustomersModel: the updated CustomersModel, outside of the session,
+            or None when there is none with this id
+
+        Raises:
+            StaleDataError: when the CustomersModel has another version
+        """
+        logger.info("Updating CustomersModel %s", customer_id)
+        table = cls.__table__
+        statement = table.update().where(cls._by_id(customer_id, versions)).values(
+            dict(values, version=table.c.version + 1)
+        )
+        try:
+            if db.engine.dialect.implicit_returning:
+                row = db.session.execute(statement.returning(*table.columns)).first()
+            else:
+                row = None
+                if db.session.execute(statement).rowcount:
+                    row = db.session.execute(
+                        select(table.columns).where(table.c.id == customer_id)
+                    ).first()
+            if row is None:
+                cls._check_version(customer_id, versions)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            cls.cache.delete(customer_id)
+        if row is None:
+            return None
+        return cls(**dict(row.items()))
+
+    @classmethod
+    def delete_by_id(cls, customer_id, versions=None):
+        """
+        Deletes one CustomersModel without reading it first
+
+        This is a single DELETE statement, or in soft delete mode a single
+        UPDATE that marks the row as deleted and bumps its version. The
+        version is only compared with ``versions``, never with a cached copy.
+
+        Args:
+            customer_id (int): the id of the CustomersModel
+            versions (list): only delete the CustomersModel if it still has one of these versions
+
+        Returns:
+            bool: True when the CustomersModel was deleted, False when there is none with this id
+
+        Raises:
+            StaleDataError: when the CustomersModel has another version
+        """
+        logger.info("Deleting CustomersModel %s", customer_id)
+        table = cls.__table__
+        condition = cls._by_id(customer_id, versions)
+        if cls.soft_delete:
+            statement = table.update().where(condition).values(
+                deleted_at=datetime.utcnow(), version=table.c.version + 1
+            )
+        else:
+            statement = table.delete().where(condition)
+        try:
+            deleted = db.session.execute(statement).rowcount > 0
+            if not deleted:
+                cls._check_version(customer_id, versions)
+            elif not cls.soft_delete:
+                # detach a copy loaded in the session, as session.delete() would
+                loaded = db.session.identity_map.get(identity_key(cls, customer_id))
+                if loaded is not None:
+                    db.session.expunge(loaded)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            cls.cache.delete(customer_id)
+        return deleted
+
+    @classmethod
+    def _by_id(cls, customer_id, versions=None):
+        """ Returns the condition matching a live CustomersModel, and one of some versions """
+        table = cls.__table__
+        condition = and_(table.c.id == customer_id, table.c.deleted_at.is_(None))
+        if versions is not None:
+            condition = and_(condition, table.c.version.in_(versions))
+        return condition
+
+    @classmethod
+    def _check_version(cls, customer_id, versions):
+        """ Raises StaleDataError when a write by id missed because of the version """
+        # only a miss pays for finding out why nothing was written
+        if versions is not None and cls.live().filter(cls.id == customer_id).count():
+            raise StaleDataError("CustomersModel {} has another version".format(customer_id))
+
+    @classmethod
+    def delete_many(cls, query=None, ids=None, chunk_size=1000):
+        """
+        Deletes CustomersModels with set-based statements in a single transaction
+
+        In soft delete mode the rows are only marked as deleted, by an
+        UPDATE that also bumps their version; purge() removes them later.
+        Otherwise they are removed by DELETE statements. The CustomersModels
+        are selected like in update_many().
+
+        Args:
+            query (Query): an optional filtered query selecting the CustomersModels
+            ids (list): an optional list of ids further selecting the CustomersModels
+            chunk_size (int): the number of ids per statement
+
+        Returns:
+            int: the number of CustomersModels deleted
+        """
+        if cls.soft_delete:
+            return cls.update_many({"deleted_at": datetime.utcnow()}, query, ids, chunk_size)
+        logger.info("Deleting CustomersModels in bulk")
+        count = cls._execute_many(
+            lambda chunk: chunk.delete(synchronize_session=False), query, ids, chunk_size
+        )
+        logger.info("Deleted %d CustomersModels", count)
+        return count
+
+    @classmethod
+    def _execute_many(cls, statement, query, ids, chunk_size):
+        """ Runs a bulk statement on a query, once per chunk of ids, and commits """
+        query = cls.live() if query is None else query
+        count = 0
+        try:
+            if ids is None:
+                count = statement(query)
+            else:
+                for start in range(0, len(ids), chunk_size):
+                    count += statement(query.filter(cls.id.in_(ids[start:start + chunk_size])))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            # the statements do not tell which of the rows they changed
+            if ids is None:
+                cls.cache.clear()
+            else:
+                for customer_id in ids:
+                    cls.cache.delete(customer_id)
+        return count
+
+    @classmethod
+    def purge(cls, older_than=timedelta(0), batch_size=1000, pause=0.0):
+        """
+        Removes the CustomersModels soft deleted some time ago
+
+        The rows are deleted ``batch_size`` at a time, each batch in its own
+        short transaction with a ``pause`` in between, so that a large purge
+        neither holds locks for long nor writes its whole WAL at once.
+
+        Args:
+            older_than (timedelta): only remove rows deleted longer ago than this
+            batch_size (int): the number of rows removed per transaction
+            pause (float): the seconds to wait between two batches
+
+        Returns:
+            int: the number of CustomersModels removed
+        """
+        cutoff = datetime.utcnow() - older_than
+        logger.info("Purging CustomersModels deleted before %s", cutoff)
+        count = 0
+        while True:
+            ids = [
+                row.id
+                for row in cls.query.with_entities(cls.id)
+                .filter(cls.deleted_at < cutoff)
+                .order_by(cls.id)
+                .limit(batch_size)
+            ]
+            if ids:
+                try:
+                    count += cls.query.filter(cls.id.in_(ids)).delete(
+                        synchronize_session=False
+                    )
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+            if len(ids) < batch_size:
+                break
+            time.sleep(pause)
+        logger.info("Purged %d CustomersModels", count)
+        return count
+
+    @classmethod
+    def load_many(cls, rows, chunk_size=1000):
+        """
+        Inserts rows of column values in bulk using a single transaction
+
+        Unlike create_many() the new ids are not returned, which lets every
+        chunk of ``chunk_size`` rows be a single multi-row INSERT on
+        PostgreSQL and a single executemany() elsewhere.
+
+        Args:
+            rows (iterable): dictionaries of the column values of each row
+            chunk_size (int): the number of rows inserted per statement
+
+        Returns:
+            int: the number of rows inserted
+        """
+        logger.info("Loading CustomersModels in bulk")
+        table = cls.__table__
+        count = 0
+        chunk = []
+        try:
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    count += cls._load_chunk(table, chunk)
+                    chunk = []
+            if chunk:
+                count += cls._load_chunk(table, chunk)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        logger.info("Loaded %d CustomersModels", count)
+        return count
+
+    @staticmethod
+    def _load_chunk(table, rows):
+        """ Inserts one chunk of rows and returns their number """
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(table.insert().values(rows))
+        else:
+            db.session.execute(table.insert(), rows)
+        return len(rows)
+
+    @classmethod
+    def _insert_chunk(cls, customers):
+        """ Inserts one chunk of CustomersModels and returns their ids """
+        rows = []
+        for customer in customers:
+            row = customer.to_row()
+            # let the database assign the id and the first version
+            del row["id"], row["version"]
+            rows.append(row)
+        if db.engine.dialect.name == "postgresql":
+            table = cls.__table__
+            result = db.session.execute(
+                table.insert().values(rows).returning(table.c.id)
+            )
+            return [row[0] for row in result]
+        # other backends cannot return ids from a multi-row INSERT
+        db.session.bulk_insert_mappings(cls, rows, return_defaults=True)
+        return [row["id"] for row in rows]
+
+    def to_row(self):
+        """ Returns the column values of a CustomersModel as a dictionary """
+        return {
+            column.name: getattr(self, column.name) for column in self.__table__.columns
+        }
 
     def serialize(self):
         """ Serializes a Customer into a dictionary """
@@ -95,33 +502,123 @@ class Customer(db.Model):
             )
         return self
 
+    @classmethod
+    def check_values(cls, data):
+        """
+        Checks the new values of some fields of a CustomersModel
+
+        Args:
+            data (dict): new values of UPDATABLE_FIELDS, by field name
+
+        Returns:
+            dict: the values, once checked
+
+        Raises:
+            DataValidationError: when a field cannot be updated or a value has the wrong type
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError(
+                "Invalid CustomersModel: body of request contained bad or no data"
+            )
+        for name, value in data.items():
+            if name not in cls.UPDATABLE_FIELDS:
+                raise DataValidationError("Invalid CustomersModel: cannot update {}".format(name))
+            column = cls.__table__.c[name]
+            if value is None and column.nullable:
+                continue
+            if type(value) is not column.type.python_type:  # pylint: disable=unidiomatic-typecheck
+                raise DataValidationError(
+                    "Invalid CustomersModel: {} must be a {}".format(
+                        name, column.type.python_type.__name__
+                    )
+                )
+        return dict(data)
+
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
         logger.info("Initializing database")
         cls.app = app
+        cls.cache = create_cache(
+            app.config.get("CUSTOMER_CACHE_SIZE", 0),
+            app.config.get("CUSTOMER_CACHE_TTL", 0),
+        )
+        cls.lookups = create_single_flight(
+            app.config.get("CUSTOMERS_SINGLE_FLIGHT", "off"),
+            app.config.get("CUSTOMERS_SINGLE_FLIGHT_DIR"),
+        )
+        cls.soft_delete = app.config.get("CUSTOMERS_SOFT_DELETE", False)
+        IdempotencyKey.init_db(app)
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", pool.engine_options(app.config))
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+        replicas.configure(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        # requests reuse the context pushed above in the main thread, so
+        # Flask-SQLAlchemy never removes their sessions: end each with its request
+        if end_session not in app.teardown_request_funcs.get(None, []):
+            app.teardown_request(end_session)
+        # the schema is created by `flask db-upgrade`, not by every worker
+        if app.config.get("DB_AUTO_MIGRATE"):
+            cls.upgrade_schema()
+
+    @classmethod
+    def upgrade_schema(cls, target=None):
+        """ Creates the missing tables, then applies the pending migrations """
+        return migrations.upgrade(db.engine, target, tables=db.metadata)
 
     @classmethod
     def all(cls):
         """ Returns all of the CustomersModels in the database """
         logger.info("Processing all CustomersModels")
-        return cls.query.all()
+        return cls.live().all()
+
+    @classmethod
+    def live(cls):
+        """ Returns the query of the CustomersModels that were not soft deleted """
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     @classmethod
     def find(cls, by_id):
         """ Finds a CustomersModel by it's ID """
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        primary = replicas.reads_own_writes()
+        # the cache may hold a row read from a lagging replica
+        row = None if primary else cls.cache.get(by_id)
+        if row is None:
+            # concurrent lookups of the same id share one query and its row
+            row = cls.lookups.do(("find", by_id, primary), lambda: cls._find_row(by_id))
+        if row is None:
+            return None
+        return cls._from_row(row)
+
+    @classmethod
+    def _find_row(cls, by_id):
+        """ Reads the column values of a CustomersModel into the cache, or returns None """
+        # a write invalidating the id while it is read keeps the old row out of the cache
+        generation = cls.cache.start_load(by_id)
+        row = None
+        try:
+            customer = cls.query.get(by_id)
+            if customer is not None and customer.deleted_at is None:
+                row = customer.to_row()
+        finally:
+            cls.cache.finish_load(by_id, row, generation)
+        return row
+
+    @classmethod
+    def _from_row(cls, row):
+        """ Attaches a CustomersModel built from cached column values to the session """
+        customer = cls(**row)
+        make_transient_to_detached(customer)
+        # load=False trusts the cached values instead of SELECTing them again
+        return db.session.merge(customer, load=False)
 
     @classmethod
     def find_or_404(cls, by_id):
         """ Find a CustomersModel by it's id """
         logger.info("Processing lookup or 404 for id %s ...", by_id)
-        return cls.query.get_or_404(by_id)
+        return cls.live().filter(cls.id == by_id).first_or_404()
 
     @classmethod
     def find_by_name(cls, name):
@@ -131,4 +628,317 @@ class Customer(db.Model):
             name (string): the name of the CustomersModels you want to match
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.live().filter(cls.name == name)
+
+    @classmethod
+    def search(cls, text, limit=None, offset=0, columns=None):
+        """Returns the CustomersModels best matching a text, best match first
+
+        A CustomersModel matches when one of its SEARCH_FIELDS contains most
+        of the trigrams of the text, so partial and misspelled words match.
+        Its rank is its best word similarity among those fields. A deep page
+        costs more than a shallow one: offset + limit matches are read.
+
+        Args:
+            text (string): the words to look for
+            limit (int): the maximum number of CustomersModels to return
+            offset (int): the number of better matches to skip
+            columns (list): return tuples of these columns instead of CustomersModels
+        """
+        logger.info("Processing search for %s ...", text)
+        query = cls.live().with_entities(*columns) if columns else cls.live()
+        fields = [cls.__table__.c[name] for name in cls.SEARCH_FIELDS]
+        dialect = db.engine.dialect
+        if dialect.name == "postgresql":
+            # the word similarity operator of pg_trgm, which the GiST indexes serve
+            operator = "<%%" if dialect.paramstyle in ("format", "pyformat") else "<%"
+            # each GiST index returns the matches of its field nearest first
+            # (KNN), so only the best offset + limit of each field are read
+            candidates = None if limit is None else offset + limit
+            nearest = []
+            for field in fields:
+                distance = literal(text).op("<<->")(field)
+                nearest.append(
+                    select([cls.id, distance.label("distance")])
+                    .where(cls.deleted_at.is_(None))
+                    .where(literal(text).op(operator)(field))
+                    .order_by(distance)
+                    .limit(candidates)
+                    .alias()
+                )
+            matches = union_all(
+                *[select([match.c.id, match.c.distance]) for match in nearest]
+            ).alias("matches")
+            ranked = (
+                select([matches.c.id, func.min(matches.c.distance).label("distance")])
+                .group_by(matches.c.id)
+                .alias("ranked")
+            )
+            query = query.join(ranked, ranked.c.id == cls.id)
+            return query.order_by(ranked.c.distance, cls.id).offset(offset).limit(limit).all()
+
+        # elsewhere the in-process index is rebuilt after any change to the table
+        version = db.session.query(
+            func.count(cls.id), func.max(cls.id), func.sum(cls.id), func.sum(cls.version)
+        ).one()
+        if not cls.search_index.is_current(version):
+            logger.info("Building the search index")
+            live = cls.live().with_entities(cls.id, *fields)
+            cls.search_index.build(live, version)
+        ranks = {
+            customer_id: rank
+            for rank, (customer_id, _) in enumerate(
+                cls.search_index.search(text, limit, offset)
+            )
+        }
+        if not ranks:
+            return []
+        query = query.add_columns(cls.id) if columns else query
+        results = query.filter(cls.id.in_(ranks)).all()
+        # the id of a column tuple is the extra column added last
+        results.sort(key=lambda result: ranks[result[-1] if columns else result.id])
+        return results
+
+    @classmethod
+    def page(cls, query=None, after_id=None, limit=None, columns=None, order_by=None):
+        """Returns one keyset page of CustomersModels ordered by id
+
+        Args:
+            query (Query): an optional filtered query to page through
+            after_id (int): only return CustomersModels with an id above this cursor
+            limit (int): the maximum number of CustomersModels to return
+            columns (list): return tuples of these columns instead of CustomersModels
+            order_by (list): an ORDER BY ending with the id, to use instead of the id
+        """
+        logger.info("Processing page after id %s (limit %s) ...", after_id, limit)
+        query = cls.live() if query is None else query
+        if columns:
+            # plain row tuples skip building and tracking ORM objects
+            query = query.with_entities(*columns)
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        return query.order_by(*(order_by or [cls.id])).limit(limit)
+
+    @classmethod
+    def stream(
+        cls, query=None, after_id=None, limit=None, batch_size=1000, columns=None, order_by=None
+    ):
+        """Returns CustomersModels ordered by id from a server-side cursor
+
+        Rows are fetched ``batch_size`` at a time so iterating over the
+        result never holds more than one batch in memory.
+
+        Args:
+            query (Query): an optional filtered query to stream
+            after_id (int): only return CustomersModels with an id above this cursor
+            limit (int): the maximum number of CustomersModels to return
+            batch_size (int): the number of rows fetched per round-trip
+            columns (list): return tuples of these columns instead of CustomersModels
+            order_by (list): an ORDER BY ending with the id, to use instead of the id
+        """
+        logger.info("Processing stream after id %s ...", after_id)
+        return cls.page(query, after_id, limit, columns, order_by).yield_per(batch_size)
+
+    @classmethod
+    def columns(cls, names=None):
+        """Returns the table columns with the given names
+
+        Args:
+            names (list): the column names (defaults to the serialized fields)
+        """
+        return [cls.__table__.c[name] for name in names or cls.SERIALIZED_FIELDS]
+
+
+# The default B-tree indexes cannot serve LIKE 'prefix%' under a non-C
+# collation, so PostgreSQL gets a varchar_pattern_ops index per field
+for _field in Customer.PREFIX_INDEXED_FIELDS:
+    event.listen(
+        Customer.__table__,
+        "after_create",
+        DDL(
+            "CREATE INDEX ix_customer_{0}_pattern ON customer ({0} varchar_pattern_ops)".format(
+                _field
+            )
+        ).execute_if(dialect="postgresql"),
+    )
+
+# Trigram indexes serving the word similarity searches of Customer.search;
+# GiST, unlike GIN, returns the nearest matches first
+event.listen(
+    Customer.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+for _field in Customer.SEARCH_FIELDS:
+    event.listen(
+        Customer.__table__,
+        "after_create",
+        DDL(
+            "CREATE INDEX ix_customer_{0}_trgm_gist ON customer "
+            "USING gist ({0} gist_trgm_ops)".format(_field)
+        ).execute_if(dialect="postgresql"),
+    )
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the response stored for an Idempotency-Key
+
+    A key is claimed by inserting its row before the request runs, so only
+    one request with the key runs at a time in all of the workers; the
+    response is then stored in the row and replayed until it expires.
+    """
+
+    # Completed keys replayed without a query, configured in init_db()
+    cache = NullCache()
+    # How long a response is replayed
+    ttl = timedelta(days=1)
+    # A claim left this long without a response belongs to a request that died
+    claim_timeout = timedelta(seconds=30)
+    # When this process last removed the expired keys, by time.monotonic()
+    purged_at = None
+
+    # Table Schema
+    key = db.Column(db.String(255), primary_key=True)
+    # Digest of the method, path and body of the request that claimed the key
+    fingerprint = db.Column(db.String(32), nullable=False)
+    # The stored response, None while the request runs
+    status = db.Column(db.Integer, nullable=True)
+    headers = db.Column(db.Text, nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<IdempotencyKey %r status=[%s]>" % (self.key, self.status)
+
+    @classmethod
+    def init_db(cls, app):
+        """ Applies the idempotency settings of an app """
+        cls.ttl = timedelta(seconds=app.config.get("IDEMPOTENCY_TTL", 86400))
+        cls.claim_timeout = timedelta(seconds=app.config.get("IDEMPOTENCY_CLAIM_TIMEOUT", 30))
+        cls.cache = create_cache(
+            app.config.get("IDEMPOTENCY_CACHE_SIZE", 0), cls.ttl.total_seconds()
+        )
+
+    @classmethod
+    def find_response(cls, key):
+        """
+        Returns the response stored for a key, or None
+
+        Returns:
+            dict: the fingerprint, status, headers, body and expires_at of
+            the response, or None while there is none or once it expired
+        """
+        stored = cls.cache.get(key)
+        if stored is None:
+            table = cls.__table__
+            row = db.session.execute(
+                select([table]).where(and_(table.c.key == key, table.c.status.isnot(None)))
+            ).first()
+            if row is None:
+                return None
+            stored = {
+                name: row[name]
+                for name in ("fingerprint", "status", "headers", "body", "expires_at")
+            }
+            cls.cache.set(key, stored)
+        if stored["expires_at"] <= datetime.utcnow():
+            return None
+        return stored
+
+    @classmethod
+    def claim(cls, key, fingerprint):
+        """
+        Claims a key for a request about to run
+
+        A key whose response expired, or whose claim timed out, is claimed again.
+
+        Returns:
+            bool: True when the key was claimed, False when another
+            request holds it or has stored its response
+        """
+        table = cls.__table__
+        now = datetime.utcnow()
+        values = dict(
+            fingerprint=fingerprint,
+            status=None,
+            headers=None,
+            body=None,
+            created_at=now,
+            expires_at=now + cls.ttl,
+        )
+        try:
+            db.session.execute(table.insert().values(key=key, **values))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+        stale = or_(
+            table.c.expires_at <= now,
+            and_(table.c.status.is_(None), table.c.created_at <= now - cls.claim_timeout),
+        )
+        try:
+            result = db.session.execute(
+                table.update().where(and_(table.c.key == key, stale)).values(**values)
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if result.rowcount:
+            cls.cache.delete(key)
+        return result.rowcount > 0
+
+    @classmethod
+    def store_response(cls, key, status, headers, body):
+        """ Stores the response of the request holding a key """
+        table = cls.__table__
+        try:
+            db.session.execute(
+                table.update()
+                .where(table.c.key == key)
+                .values(status=status, headers=headers, body=body)
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def release(cls, key):
+        """ Gives up the claim of a key without a response, so that it can be retried """
+        table = cls.__table__
+        try:
+            db.session.execute(
+                table.delete().where(and_(table.c.key == key, table.c.status.is_(None)))
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def purge_if_due(cls, interval=3600):
+        """ Removes the expired keys when this process has not for ``interval`` seconds """
+        now = time.monotonic()
+        if cls.purged_at is not None and now - cls.purged_at < interval:
+            return 0
+        cls.purged_at = now
+        return cls.purge()
+
+    @classmethod
+    def purge(cls):
+        """ Removes the expired keys and returns their number """
+        logger.info("Purging expired idempotency keys")
+        table = cls.__table__
+        try:
+            count = db.session.execute(
+                table.delete().where(table.c.expires_at <= datetime.utcnow())
+            ).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        logger.info("Purged %d idempotency keys", count)
+        return count
@@ -0,0 +1,119 @@
+"""
+Connection Pool
+
+Builds the SQLAlchemy engine options from the DB_POOL_* settings and
+provides a QueuePool that counts how often, and for how long, requests
+had to wait for a connection.
+"""
+import threading
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+# The recent wait of a pool halves every this many seconds without a longer one
+WAIT_HALF_LIFE = 1.0
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ A QueuePool that records the checkouts that had to wait """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+        self._recent_wait = 0.0
+        self._recent_at = 0.0
+        # start times of the checkouts waiting right now
+        self._waiting = []
+
+    def _do_get(self):
+        # no idle connection and no room to overflow: the checkout blocks
+        blocked = (
+            self._pool.empty()
+            and self._max_overflow > -1
+            and self._overflow >= self._max_overflow
+        )
+        if not blocked:
+            return super()._do_get()
+        start = time.monotonic()
+        with self._stats_lock:
+            self._waiting.append(start)
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            now = time.monotonic()
+            elapsed = now - start
+            with self._stats_lock:
+                self._waiting.remove(start)
+                self.waits += 1
+                self.wait_time += elapsed
+                self.max_wait = max(self.max_wait, elapsed)
+                self._recent_wait = max(elapsed, self._decayed_wait(now))
+                self._recent_at = now
+
+    def _decayed_wait(self, now):
+        return self._recent_wait * 0.5 ** ((now - self._recent_at) / WAIT_HALF_LIFE)
+
+    def recent_wait(self):
+        """
+        Returns how long checkouts have recently waited, in seconds
+
+        This is the longest of the waits going on and of the recent ones,
+        which count for half as much every WAIT_HALF_LIFE seconds.
+        """
+        now = time.monotonic()
+        with self._stats_lock:
+            waiting = now - min(self._waiting) if self._waiting else 0.0
+            return max(waiting, self._decayed_wait(now))
+
+
+def engine_options(config):
+    """
+    Returns the create_engine() options for the pool settings in a config
+
+    SQLite is left to Flask-SQLAlchemy, which picks the only pools that
+    work for it. In PgBouncer mode PgBouncer owns the server connections,
+    so connections are opened per checkout instead of being pooled here.
+    """
+    if config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return {}
+    if config.get("DB_PGBOUNCER"):
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": config.get("DB_POOL_SIZE", 5),
+        "max_overflow": config.get("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": config.get("DB_POOL_RECYCLE", -1),
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", False),
+    }
+
+
+def pool_stats(pool):
+    """ Returns the occupancy and wait counters of a connection pool """
+    stats = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+        )
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._stats_lock:
+            stats.update(
+                waits=pool.waits,
+                wait_time=pool.wait_time,
+                max_wait=pool.max_wait,
+                timeouts=pool.timeouts,
+                waiting=len(pool._waiting),
+            )
+        stats["recent_wait"] = pool.recent_wait()
+    return stats
@@ -0,0 +1,257 @@
+"""
+Query Profiler
+
+Records the SQL statements of a request, from SQLAlchemy engine events,
+with their timings and parameters. Profiling is opt-in: with
+PROFILE_ENABLED set, a request is profiled when it sends an ``X-Profile:
+true`` header, or at random for a PROFILE_SAMPLE_RATE share of requests.
+The response of a profiled request names its profile in ``X-Profile-Id``,
+and the last PROFILE_HISTORY profiles of the worker are served at
+/debug/profiles.
+
+Statements slower than SLOW_QUERY_MS milliseconds are written to the
+slow query log as JSON, whether or not the request is profiled. In a
+profiled request their plan is captured too: EXPLAIN ANALYZE for queries
+on PostgreSQL, which runs them again, and a plain EXPLAIN for writes,
+which must not run twice. Card numbers never reach a profile or the log.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_query_logger = logging.getLogger("flask.app.slow_queries")
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+# Parameters whose value is replaced in profiles and logs
+REDACTED_PARAMETERS = ("credit_card",)
+REDACTED = "[REDACTED]"
+
+# Statements kept per profile, so a runaway request cannot exhaust memory
+MAX_QUERIES = 500
+
+_profiles = OrderedDict()
+_profiles_lock = threading.Lock()
+# set by init_profiler() from the configuration of the app
+_settings = {"enabled": False, "sample_rate": 0.0, "history": 100, "slow_query_ms": 0}
+
+
+def init_profiler(app):
+    """ Starts profiling the requests of an app, as its configuration asks """
+    configure(app.config)
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        event.listen(Engine, "handle_error", handle_error)
+
+
+def configure(config):
+    """ Applies the profiling settings of a configuration """
+    _settings.update(
+        slow_query_ms=config.get("SLOW_QUERY_MS", 0),
+        enabled=config.get("PROFILE_ENABLED", False),
+        sample_rate=config.get("PROFILE_SAMPLE_RATE", 0.0),
+        history=config.get("PROFILE_HISTORY", 100),
+    )
+
+
+def is_enabled():
+    """ Returns True when requests can be profiled """
+    return _settings["enabled"]
+
+
+def wants_profile():
+    """ Returns True when the current request should be profiled """
+    if not is_enabled():
+        return False
+    if request.headers.get(PROFILE_HEADER, "").lower() in ("1", "true"):
+        return True
+    return random.random() < _settings["sample_rate"]
+
+
+def start_profile():
+    """ Starts the profile of the current request, when it is profiled """
+    g.pop("profile", None)
+    if not wants_profile():
+        return
+    g.profile = {
+        "id": uuid.uuid4().hex,
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "start": time.perf_counter(),
+        "queries": [],
+        "dropped_queries": 0,
+    }
+
+
+def finish_profile(response):
+    """ Stores the profile of the current request """
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    start = profile.pop("start")
+    profile.update(
+        endpoint=request.endpoint,
+        status=response.status_code,
+        duration_ms=_milliseconds(time.perf_counter() - start),
+        db_time_ms=round(sum(query["duration_ms"] for query in profile["queries"]), 3),
+    )
+    with _profiles_lock:
+        _profiles[profile["id"]] = profile
+        while len(_profiles) > _settings["history"]:
+            _profiles.popitem(last=False)
+    response.headers[PROFILE_ID_HEADER] = profile["id"]
+    return response
+
+
+def profiles():
+    """ Returns the stored profiles, the most recent first """
+    with _profiles_lock:
+        return list(reversed(_profiles.values()))
+
+
+def find_profile(profile_id):
+    """ Returns a stored profile, or None """
+    with _profiles_lock:
+        return _profiles.get(profile_id)
+
+
+def clear():
+    """ Forgets the stored profiles """
+    with _profiles_lock:
+        _profiles.clear()
+
+
+######################################################################
+#  E N G I N E   E V E N T S
+######################################################################
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Notes when a SQL statement starts """
+    conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Adds a finished SQL statement to the profile and the slow query log """
+    elapsed = _milliseconds(time.perf_counter() - conn.info["profile_start"].pop())
+    profile = g.get("profile") if has_request_context() else None
+    slow = 0 < _settings["slow_query_ms"] <= elapsed
+    if profile is None and not slow:
+        return
+    query = {
+        "statement": statement,
+        "parameters": redact(parameters, context, executemany),
+        "duration_ms": elapsed,
+        "executemany": executemany,
+    }
+    if slow and profile is not None and not executemany:
+        query["plan"] = explain(conn, statement, parameters)
+    if profile is not None:
+        if len(profile["queries"]) < MAX_QUERIES:
+            profile["queries"].append(query)
+        else:
+            profile["dropped_queries"] += 1
+    if slow:
+        entry = dict(query)
+        if has_request_context():
+            entry.update(method=request.method, path=request.path)
+        slow_query_logger.warning(json.dumps(entry, default=str))
+
+
+def handle_error(context):
+    """ Forgets the start of a SQL statement that failed """
+    starts = context.connection.info.get("profile_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+######################################################################
+#  R E D A C T I O N   A N D   P L A N S
+######################################################################
+
+
+def redact(parameters, context, executemany):
+    """
+    Returns a copy of the parameters of a statement without card numbers
+
+    Named parameters are matched by name; credit_card_1 or credit_card_m0
+    are the names SQLAlchemy gives to further values of the column.
+    Positional parameters are named by the compiled statement, and are
+    all withheld when it is textual SQL that cannot tell them apart.
+    """
+    if executemany:
+        return [redact(values, context, False) for values in parameters]
+    if isinstance(parameters, dict):
+        return {
+            name: REDACTED if _is_redacted(name) else value
+            for name, value in parameters.items()
+        }
+    names = getattr(getattr(context, "compiled", None), "positiontup", None)
+    if names is None or len(names) != len(parameters):
+        return [REDACTED] * len(parameters) if parameters else []
+    return [
+        REDACTED if _is_redacted(name) else value for name, value in zip(names, parameters)
+    ]
+
+
+def _is_redacted(name):
+    """ Returns True when a bind parameter holds a redacted column """
+    return any(
+        name == column or name.startswith(column + "_") for column in REDACTED_PARAMETERS
+    )
+
+
+def explain(conn, statement, parameters):
+    """
+    Returns the plan of a statement, as lines of text
+
+    The plan is read on a cursor of its own on the same DBAPI connection,
+    which shares the transaction of the statement and fires no events. On
+    PostgreSQL a savepoint keeps a failed EXPLAIN from aborting it.
+
+    EXPLAIN ANALYZE runs the statement again, so only plain SELECTs get
+    it: a WITH may hold an UPDATE or DELETE, which must not run twice.
+    """
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        is_query = statement.lstrip().split(None, 1)[0].upper() == "SELECT"
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if is_query else "EXPLAIN "
+    elif dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        return None
+    savepoint = dialect == "postgresql"
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT profile_explain")
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT profile_explain")
+    except Exception as error:  # pylint: disable=broad-except
+        if savepoint:
+            cursor.execute("ROLLBACK TO SAVEPOINT profile_explain")
+        return ["EXPLAIN failed: {}".format(error)]
+    finally:
+        cursor.close()
+    # PostgreSQL returns one line per row, SQLite the detail in the last column
+    return [str(row[-1]) for row in rows]
+
+
+def _milliseconds(seconds):
+    """ Returns a duration in seconds as rounded milliseconds """
+    return round(seconds * 1000, 3)
@@ -0,0 +1,206 @@
+"""
+Read Replicas
+
+When DATABASE_REPLICA_URIS lists read replicas of the database, the
+queries of GET and HEAD requests are sent to one of them, and everything
+else, writes included, to the primary. Each request sticks to the replica
+it first reads from, picked in turn (round_robin) or as the one with the
+fewest connections in use (least_loaded) by DB_REPLICA_BALANCE.
+
+Replicas lag behind the primary, so a client reads its own writes from
+the primary: a request that writes sets a cookie pinning the reads of its
+client to the primary for DB_READ_YOUR_WRITES_SECONDS, and a request can
+ask for the primary with the X-Read-Primary header.
+"""
+import itertools
+import threading
+import time
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.sql.expression import Select
+from service import pool
+
+READ_METHODS = ("GET", "HEAD")
+PRIMARY_HEADER = "X-Read-Primary"
+PRIMARY_COOKIE = "read_primary_until"
+BALANCES = ("round_robin", "least_loaded")
+
+
+def init_replicas(app):
+    """ Routes the reads of each request of an app to a replica or the primary """
+    app.before_request(route_reads)
+    app.after_request(remember_writes)
+
+
+def configure(app):
+    """
+    Creates the engines of the replicas of an app, replacing any previous ones
+
+    Args:
+        app (Flask): the app, configured with DATABASE_REPLICA_URIS,
+            DB_REPLICA_BALANCE and the DB_POOL_* settings
+    """
+    previous = app.extensions.pop("replicas", None)
+    if previous is not None:
+        previous.dispose()
+    uris = app.config.get("DATABASE_REPLICA_URIS") or []
+    if uris:
+        app.extensions["replicas"] = ReplicaSet(
+            uris, app.config, app.config.get("DB_REPLICA_BALANCE", "round_robin")
+        )
+
+
+def replica_set(app=None):
+    """ Returns the replicas of an app (the current one by default), or None """
+    app = app or current_app
+    return app.extensions.get("replicas")
+
+
+def reads_own_writes():
+    """ Returns True when the current request must see the writes of its client """
+    return has_request_context() and g.get("read_your_writes", False)
+
+
+######################################################################
+#  R E Q U E S T   R O U T I N G
+######################################################################
+
+
+def route_reads():
+    """ Decides whether the reads of the current request may go to a replica """
+    if request.method not in READ_METHODS or replica_set() is None:
+        g.read_replica = False
+        return
+    pinned = request.headers.get(PRIMARY_HEADER, "").lower() in ("1", "true")
+    try:
+        pinned = pinned or float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        pass
+    g.read_replica = not pinned
+    g.read_your_writes = pinned
+    g.replica = None
+
+
+def remember_writes(response):
+    """ Pins the reads of a client that wrote to the primary for a while """
+    seconds = current_app.config.get("DB_READ_YOUR_WRITES_SECONDS", 0)
+    if (
+        request.method not in READ_METHODS
+        and response.status_code < 400
+        and seconds > 0
+        and replica_set() is not None
+    ):
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            "{:.3f}".format(time.time() + seconds),
+            max_age=seconds,
+            httponly=True,
+        )
+    return response
+
+
+######################################################################
+#  R E P L I C A S
+######################################################################
+
+
+class Replica:
+    """ The engine of a read replica and the connections in use on it """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.in_use = 0
+        self.reads = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "checkout", self._checkout)
+        event.listen(engine, "checkin", self._checkin)
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.in_use += 1
+
+    def _checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use -= 1
+
+    def stats(self):
+        """ Returns the URL of the replica, without its password, and its counters """
+        with self._lock:
+            return {"url": repr(self.engine.url), "in_use": self.in_use, "reads": self.reads}
+
+
+class ReplicaSet:
+    """ The read replicas of a database and the balancing between them """
+
+    def __init__(self, uris, config, balance="round_robin"):
+        if balance not in BALANCES:
+            raise ValueError(
+                "DB_REPLICA_BALANCE must be one of {}: {}".format(", ".join(BALANCES), balance)
+            )
+        self.balance = balance
+        self.replicas = [
+            Replica(
+                create_engine(
+                    uri, **pool.engine_options(dict(config, SQLALCHEMY_DATABASE_URI=uri))
+                )
+            )
+            for uri in uris
+        ]
+        self._turns = itertools.count()
+
+    def choose(self):
+        """ Returns the replica to read from next """
+        if self.balance == "least_loaded":
+            replica = min(self.replicas, key=lambda item: (item.in_use, item.reads))
+        else:
+            replica = self.replicas[next(self._turns) % len(self.replicas)]
+        with replica._lock:  # pylint: disable=protected-access
+            replica.reads += 1
+        return replica
+
+    def stats(self):
+        """ Returns the counters of every replica """
+        return [replica.stats() for replica in self.replicas]
+
+    def dispose(self):
+        """ Closes the connections to the replicas, as before a fork """
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+
+######################################################################
+#  S E S S I O N
+######################################################################
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session sending the SELECT statements of read requests to a replica
+
+    Flushes, other statements and plain connections go to the primary, and
+    once a request wrote, its reads do too.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, Select) and self._reads_from_replica():
+            if g.get("replica") is None:
+                g.replica = self.app.extensions["replicas"].choose()
+            return g.replica.engine
+        if not isinstance(clause, Select) and has_request_context():
+            g.read_replica = False
+        return super().get_bind(mapper, clause)
+
+    def _reads_from_replica(self):
+        return (
+            "replicas" in self.app.extensions
+            and has_request_context()
+            and g.get("read_replica", False)
+        )
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ The Flask-SQLAlchemy extension, with sessions routing reads to replicas """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
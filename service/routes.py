@@ -6,20 +6,31 @@ This service will create, add, update, list, read, and delete customer profiles.
 
 import os
 import sys
+import hashlib
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
-from flasgger import Swagger
+from flask import Flask, Response, json, jsonify, request, url_for, make_response, abort
+from flask import stream_with_context
 from flask_api import status  # HTTP Status Codes
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, PreconditionFailed, UnprocessableEntity
+from werkzeug.http import quote_etag
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Customer, DataValidationError
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import Customer, DataValidationError, db
+from service import apidocs, compression, encoding, filters, idempotency, limits, logs
+from service import metrics, profiler, replicas, transfer
+from service.encoding import RowEncoder
+from service.metrics import serialization_timer
+from service.pool import pool_stats
 
 # Import Flask application
 from . import app
 
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+
 # Configure Swagger before initilaizing it
 app.config['SWAGGER'] = {
     "swagger_version": "2.0",
@@ -34,8 +45,26 @@ app.config['SWAGGER'] = {
     ]
 }
 
-# Initialize Swagger after configuring it
-Swagger(app)
+# Serve Swagger after configuring it; the spec is only generated when first asked for
+apidocs.init_apidocs(app)
+
+# Collect request and database metrics for /metrics
+metrics.init_metrics(app)
+
+# Profile requests on demand and log slow SQL statements
+profiler.init_profiler(app)
+
+# Read from the replicas in GET requests, unless the client has just written
+replicas.init_replicas(app)
+
+# Refuse the requests of clients over their rate, and shed load while the database is busy
+limits.init_limits(app)
+
+# Compress the large responses for the clients that accept it
+compression.init_compression(app)
+
+# Pick the JSON library for customer payloads
+encoding.set_backend(app.config["JSON_BACKEND"])
 
 ######################################################################
 # Error Handlers
@@ -100,6 +129,79 @@ def mediatype_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def conflict(error):
+    """ Handles requests clashing with another one still running with 409_CONFLICT """
+    message = str(error)
+    app.logger.warning(message)
+    headers = {}
+    if getattr(error, "retry_after", None):
+        headers["Retry-After"] = str(error.retry_after)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+        headers,
+    )
+
+
+@app.errorhandler(UnprocessableEntity)
+def unprocessable_entity(error):
+    """ Handles requests that cannot be run as sent with 422_UNPROCESSABLE_ENTITY """
+    message = str(error)
+    app.logger.warning(message)
+    # flask_api has no constant for 422
+    return (
+        jsonify(
+            status=UnprocessableEntity.code,
+            error="Unprocessable Entity",
+            message=message,
+        ),
+        UnprocessableEntity.code,
+    )
+
+
+@app.errorhandler(status.HTTP_429_TOO_MANY_REQUESTS)
+def too_many_requests(error):
+    """ Handles requests of clients over their rate limit with 429_TOO_MANY_REQUESTS """
+    message = str(error)
+    app.logger.warning(message)
+    headers = {}
+    if getattr(error, "retry_after", None):
+        headers["Retry-After"] = str(error.retry_after)
+    return (
+        jsonify(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=message,
+        ),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        headers,
+    )
+
+
+@app.errorhandler(StaleDataError)
+def concurrent_update(error):
+    """ Handles a write that lost the race with another writer """
+    return precondition_failed(
+        PreconditionFailed("The Customer was changed by another request")
+    )
+
+
+@app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """ Handles stale conditional requests with 412_PRECONDITION_FAILED """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -114,6 +216,25 @@ def internal_server_error(error):
         status.HTTP_500_INTERNAL_SERVER_ERROR,
     )
 
+
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """ Handles requests shed while the service is overloaded with 503_SERVICE_UNAVAILABLE """
+    message = str(error)
+    app.logger.warning(message)
+    headers = {}
+    if getattr(error, "retry_after", None):
+        headers["Retry-After"] = str(error.retry_after)
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers,
+    )
+
 ######################################################################
 # G E T  I N D E X
 ######################################################################
@@ -129,14 +250,114 @@ def index():
     # )
     return app.send_static_file('index.html')
 
+######################################################################
+# S E R V I C E   S T A T U S
+######################################################################
+@app.route("/status", methods=["GET"])
+def service_status():
+    """
+    Service status
+    This endpoint will return the counters used to tune the service
+    ---
+    tags:
+      - Status
+    produces:
+      - application/json
+    responses:
+      200:
+        description: The service is up, with the Customer cache, connection pool, replica, single flight, request limit and log queue counters
+    """
+    replica_set = replicas.replica_set()
+    return make_response(
+        jsonify(
+            status="OK",
+            cache=Customer.cache.stats(),
+            pool=pool_stats(db.engine.pool),
+            replicas=replica_set.stats() if replica_set is not None else [],
+            single_flight=Customer.lookups.stats(),
+            limits=limits.stats(),
+            logs=logs.stats(),
+        ),
+        status.HTTP_200_OK,
+    )
+
+@app.route("/metrics", methods=["GET"])
+def service_metrics():
+    """
+    Service metrics
+    This endpoint will return the request, database and pool metrics in Prometheus text format
+    ---
+    tags:
+      - Status
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: The metrics of every worker of the service
+    """
+    body, content_type = metrics.render()
+    return Response(body, status=status.HTTP_200_OK, content_type=content_type)
+
+######################################################################
+# Q U E R Y   P R O F I L E S
+######################################################################
+@app.route("/debug/profiles", methods=["GET"])
+def list_profiles():
+    """
+    Query profiles
+    This endpoint will return the last profiled requests of this worker, the most recent first
+    ---
+    tags:
+      - Status
+    produces:
+      - application/json
+    responses:
+      200:
+        description: The profiles, with the SQL statements of every request
+      404:
+        description: Profiling is turned off
+    """
+    check_profiling()
+    return json_response(json.dumps(profiler.profiles(), default=str), status.HTTP_200_OK)
+
+@app.route("/debug/profiles/<profile_id>", methods=["GET"])
+def get_profiles(profile_id):
+    """
+    Retrieve a query profile
+    This endpoint will return the profile named by the X-Profile-Id of a response
+    ---
+    tags:
+      - Status
+    produces:
+      - application/json
+    parameters:
+      - name: profile_id
+        in: path
+        description: X-Profile-Id of the profiled response
+        type: string
+        required: true
+    responses:
+      200:
+        description: The SQL statements of the request, with their timings and plans
+      404:
+        description: Profiling is turned off, or the profile is not kept any more
+    """
+    check_profiling()
+    profile = profiler.find_profile(profile_id)
+    if profile is None:
+        raise NotFound("Profile '{}' was not found.".format(profile_id))
+    return json_response(json.dumps(profile, default=str), status.HTTP_200_OK)
+
 ######################################################################
 # C R E A T E  A  C U S T O M E R
 ######################################################################
 @app.route("/customers", methods=["POST"])
+@idempotency.idempotent
 def create_customers():
     """
     Creates a Customer
     This endpoint will create a Customer based the data in the body that is posted
+    A retry sending the same Idempotency-Key gets the first response back
     ---
     tags:
       - Customers
@@ -145,6 +366,11 @@ def create_customers():
     produces:
       - application/json
     parameters:
+      - in: header
+        name: Idempotency-Key
+        type: string
+        required: false
+        description: a unique key sent with every retry of the request
       - in: body
         name: body
         required: true
@@ -183,18 +409,165 @@ def create_customers():
           $ref: '#/definitions/Customer'
       400:
         description: Bad Request (the posted data was not valid)
+      409:
+        description: A request with the same Idempotency-Key is still running
+      422:
+        description: The Idempotency-Key was used by a request with another body
     """
     app.logger.info("Request to create a customer")
     check_content_type("application/json")
     customer = Customer()
     customer.deserialize(request.get_json())
     customer.create()
-    message = customer.serialize()
     location_url = url_for("get_customers", customer_id=customer.id, _external=True)
-    return make_response(
-        jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
+    return customer_response(
+        customer, status.HTTP_201_CREATED, {"Location": location_url}
+    )
+
+######################################################################
+# C R E A T E  C U S T O M E R S  I N  B U L K
+######################################################################
+@app.route("/customers/batch", methods=["POST"])
+def create_customers_batch():
+    """
+    Creates Customers in bulk
+    This endpoint will create every valid Customer in a JSON array or NDJSON body
+    in a single transaction and report the invalid ones by their position
+    ---
+    tags:
+      - Customers
+    consumes:
+      - application/json
+      - application/x-ndjson
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            $ref: '#/definitions/Customer'
+    responses:
+      201:
+        description: All of the Customers were created
+      207:
+        description: Some of the Customers were created and the others are listed in errors
+      400:
+        description: Bad Request (none of the posted data was valid)
+    """
+    app.logger.info("Request to create customers in bulk")
+    check_content_type("application/json", NDJSON)
+    if request.headers["Content-Type"] == NDJSON:
+        records = read_ndjson_records()
+    else:
+        data = request.get_json()
+        if not isinstance(data, list):
+            raise DataValidationError("Invalid batch: body must be a JSON array")
+        records = enumerate(data)
+
+    errors = []
+
+    def valid_customers():
+        for index, record in records:
+            try:
+                yield Customer().deserialize(record)
+            except DataValidationError as error:
+                errors.append({"index": index, "message": str(error)})
+
+    ids = Customer.create_many(
+        valid_customers(), app.config["CUSTOMERS_BATCH_CHUNK_SIZE"]
+    )
+    body = encoding.dumps({"created": len(ids), "ids": ids, "errors": errors})
+    if not errors:
+        return json_response(body, status.HTTP_201_CREATED)
+    if ids:
+        return json_response(body, status.HTTP_207_MULTI_STATUS)
+    return json_response(body, status.HTTP_400_BAD_REQUEST)
+
+######################################################################
+# E X P O R T  A N D  I M P O R T  C U S T O M E R S
+######################################################################
+@app.route("/customers/export", methods=["GET"])
+def export_customers():
+    """
+    Export all of the Customers
+    This endpoint will stream every Customer as CSV or NDJSON
+    ---
+    tags:
+      - Customers
+    produces:
+      - text/csv
+      - application/x-ndjson
+    parameters:
+      - name: format
+        in: query
+        description: the format of the export
+        required: false
+        type: string
+        default: csv
+        enum:
+          - csv
+          - ndjson
+    responses:
+      200:
+        description: Every Customer, as CSV with a header line or as NDJSON lines
+      400:
+        description: Bad Request (the format was not valid)
+    """
+    export_format = request.args.get("format", "csv")
+    if export_format not in transfer.FORMATS:
+        abort(status.HTTP_400_BAD_REQUEST, "format must be csv or ndjson")
+    app.logger.info("Request to export customers as %s", export_format)
+    chunks = transfer.export_customers(
+        export_format, app.config["CUSTOMERS_STREAM_BATCH_SIZE"]
+    )
+    return Response(
+        stream_with_context(chunks),
+        status=status.HTTP_200_OK,
+        mimetype=CSV if export_format == "csv" else NDJSON,
+        headers={
+            "Content-Disposition": "attachment; filename=customers.{}".format(export_format)
+        },
     )
 
+
+@app.route("/customers/import", methods=["POST"])
+def import_customers():
+    """
+    Import Customers
+    This endpoint will create a Customer from every record of a CSV or NDJSON body
+    ---
+    tags:
+      - Customers
+    description: Loads the output of /customers/export into new Customers, in a
+      single transaction. The ids of the records are not kept.
+    consumes:
+      - text/csv
+      - application/x-ndjson
+    responses:
+      201:
+        description: Customers imported
+        schema:
+          properties:
+            created:
+                type: integer
+                description: the number of Customers created
+      400:
+        description: Bad Request (a record was not valid; nothing was imported)
+      415:
+        description: Unsupported Media Type
+    """
+    app.logger.info("Request to import customers")
+    check_content_type(CSV, NDJSON)
+    import_format = "csv" if request.headers["Content-Type"] == CSV else "ndjson"
+    count = transfer.import_customers(
+        request.stream, import_format, app.config["CUSTOMERS_BATCH_CHUNK_SIZE"]
+    )
+    app.logger.info("Imported %d customers", count)
+    return json_response(encoding.dumps({"created": count}), status.HTTP_201_CREATED)
+
 ######################################################################
 # R E T R I E V E  A  C U S T O M E R
 ######################################################################
@@ -214,11 +587,22 @@ def get_customers(customer_id):
         description: ID of customer to retrieve
         type: integer
         required: true
+      - name: If-None-Match
+        in: header
+        description: the ETag of the copy the client already has
+        type: string
+        required: false
     responses:
       200:
         description: Customer returned
+        headers:
+          ETag:
+            type: string
+            description: the version of the Customer
         schema:
           $ref: '#/definitions/Customer'
+      304:
+        description: Customer not modified since the version in If-None-Match
       404:
         description: Customer not found
     """
@@ -226,7 +610,11 @@ def get_customers(customer_id):
     customer = Customer.find(customer_id)
     if not customer:
         raise NotFound("Customer with id '{}' was not found.".format(customer_id))
-    return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
+    etag = customer_etag(customer)
+    known = if_none_match(etag)
+    if known:
+        return not_modified(known)
+    return customer_response(customer, status.HTTP_200_OK)
 
 ######################################################################
 # D E L E T E  A  C U S T O M E R
@@ -247,16 +635,66 @@ def delete_customers(customer_id):
         description: ID of customer to delete
         type: integer
         required: true
+      - name: If-Match
+        in: header
+        description: only delete the Customer if it still has this ETag
+        type: string
+        required: false
     responses:
       204:
         description: Customer deleted
+      412:
+        description: The Customer was changed since the version in If-Match
     """
     app.logger.info("Request to delete customer with id: %s", customer_id)
-    customer = Customer.find(customer_id)
-    if customer:
-        customer.delete()
+    # a single statement by id: the cache never decides which version is deleted
+    Customer.delete_by_id(customer_id, if_match_versions(customer_id))
     return make_response("", status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# D E L E T E  C U S T O M E R S  I N  B U L K
+######################################################################
+@app.route("/customers", methods=["DELETE"])
+def delete_customers_bulk():
+    """
+    Delete many Customers
+    This endpoint will delete every selected Customer at once
+    ---
+    tags:
+      - Customers
+    description: Selects Customers with a list of ids, with the filters of
+      GET /customers, or both. In soft delete mode the Customers are only
+      hidden until the purge command removes them.
+    parameters:
+      - name: ids
+        in: query
+        description: comma separated ids of the Customers to delete
+        required: false
+        type: string
+    responses:
+      200:
+        description: Customers deleted
+        schema:
+          properties:
+            deleted:
+                type: integer
+                description: the number of Customers deleted
+      400:
+        description: Bad Request (the selection was not valid)
+    """
+    app.logger.info("Request to delete customers in bulk")
+    ids = None
+    args = request.args.copy()
+    if "ids" in args:
+        try:
+            ids = [int(item) for item in ",".join(args.poplist("ids")).split(",") if item]
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, "ids must be comma separated integers")
+    query = select_customers(ids, "delete", args)
+    count = Customer.delete_many(query, ids, app.config["CUSTOMERS_BATCH_CHUNK_SIZE"])
+    app.logger.info("Deleted %d customers", count)
+    return json_response(encoding.dumps({"deleted": count}), status.HTTP_200_OK)
+
 ######################################################################
 # L I S T  A L L  C U S T O M E R S
 ######################################################################
@@ -267,13 +705,53 @@ def list_customers():
     ---
     tags:
       - Customers
-    description: The Customers endpoint allows you to query Customers by name
+    description: The Customers endpoint allows you to filter Customers on any field but
+      credit_card with <field>=value, <field>__in=a,b, <field>__prefix=value,
+      <field>__suffix=value and <field>__contains=value
     parameters:
       - name: name
         in: query
         description: the name of Customer you are looking for
         required: false
         type: string
+      - name: active
+        in: query
+        description: only return active (true) or inactive (false) Customers
+        required: false
+        type: boolean
+      - name: sort
+        in: query
+        description: comma separated indexed fields to order by, - for descending (e.g., -active,name)
+        required: false
+        type: string
+      - name: after
+        in: query
+        description: the cursor of the next sorted page, from the Link header
+        required: false
+        type: string
+      - name: limit
+        in: query
+        description: the maximum number of Customers to return in one page
+        required: false
+        type: integer
+      - name: after_id
+        in: query
+        description: only return Customers with an id above this cursor
+        required: false
+        type: integer
+      - name: fields
+        in: query
+        description: comma separated Customer fields to return (e.g., id,name,active)
+        required: false
+        type: string
+      - name: stream
+        in: query
+        description: stream the whole result as a json array or ndjson lines
+        required: false
+        type: string
+        enum:
+          - json
+          - ndjson
     definitions:
       Customer:
         type: object
@@ -303,22 +781,192 @@ def list_customers():
     responses:
       200:
         description: An array of Customers
+        headers:
+          Link:
+            type: string
+            description: the URL of the next page, when there is one
+          ETag:
+            type: string
+            description: the version of the page
         schema:
           type: array
           items:
             schema:
               $ref: '#/definitions/Customer'
+      304:
+        description: Page not modified since the version in If-None-Match
+      400:
+        description: Bad Request (the paging parameters, filters, sort or fields were not valid)
     """
     app.logger.info("Request for customer list")
-    customers = []
-    name = request.args.get("name")
-    if name:
-        customers = Customer.find_by_name(name)
-    else:
-        customers = Customer.all()
+    customer_filters = filters.parse_filters(request.args)
+    query = filters.apply_filters(Customer.live(), customer_filters)
+    # filters that no index can answer make the database scan for matches
+    indexed = filters.is_indexed(customer_filters)
+    after_id = get_int_arg("after_id", minimum=0)
+    sort = filters.parse_sort(request.args.get("sort"))
+    order_by = filters.order_by(sort)
+    if "after" in request.args:
+        if not sort or after_id is not None:
+            abort(status.HTTP_400_BAD_REQUEST, "after is only valid with sort, instead of after_id")
+        query = filters.apply_cursor(query, sort, request.args["after"])
+    elif sort and after_id is not None:
+        abort(status.HTTP_400_BAD_REQUEST, "Sorted pages start after a cursor, not after_id")
+
+    # read plain rows of only the selected fields; the id, version and sort
+    # columns after them feed the paging cursor and the ETag
+    fields = get_fields()
+    encoder = RowEncoder(Customer.columns(fields))
+    columns = Customer.columns(fields) + [Customer.version]
+    for name in ["id"] + [key.field for key in sort]:
+        if Customer.__table__.c[name] not in columns:
+            columns.append(Customer.__table__.c[name])
+
+    stream_format = get_stream_format()
+    if stream_format:
+        if not indexed:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                "Streaming needs a filter on an indexed field: {}".format(
+                    ", ".join(
+                        name for name in filters.INDEXED_FIELDS
+                        if name not in filters.LOW_SELECTIVITY_FIELDS
+                    )
+                ),
+            )
+        limit = get_int_arg("limit", minimum=1)
+        rows = Customer.stream(
+            query,
+            after_id,
+            limit,
+            app.config["CUSTOMERS_STREAM_BATCH_SIZE"],
+            columns,
+            order_by,
+        )
+        return stream_rows(rows, encoder, stream_format)
+
+    limit = get_int_arg("limit", minimum=1) or app.config["CUSTOMERS_PAGE_SIZE"]
+    limit = min(limit, app.config["CUSTOMERS_MAX_PAGE_SIZE"])
+    # as do sort orders whose pages are not ranges of an index
+    if not indexed or not filters.is_range_sort(sort):
+        limit = min(limit, app.config["CUSTOMERS_UNINDEXED_PAGE_SIZE"])
+
+    def read_page():
+        """ Returns the ETag, headers and row values of the page """
+        # fetch one extra row to learn whether there is a next page
+        rows = Customer.page(query, after_id, limit + 1, columns, order_by).all()
+        # the page, including the row that decides its next link, is the resource
+        etag = hashlib.sha1(
+            ",".join("{}.{}".format(row.id, row.version) for row in rows).encode()
+        ).hexdigest()
+        headers = {"ETag": quote_etag(etag)}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            args = request.args.to_dict(flat=False)
+            if sort:
+                args.update(after=filters.encode_cursor(sort, rows[-1]), limit=limit)
+            else:
+                args.update(after_id=rows[-1].id, limit=limit)
+            next_url = url_for("list_customers", _external=True, **args)
+            headers["Link"] = '<{}>; rel="next"'.format(next_url)
+        return etag, headers, [tuple(row) for row in rows]
+
+    # concurrent identical requests, e.g. for the same ?name=, share one
+    # query and its rows; each encodes them only when its copy is stale
+    key = (
+        "list",
+        request.host_url,
+        tuple(sorted(request.args.items(multi=True))),
+        replicas.reads_own_writes(),
+    )
+    etag, headers, rows = Customer.lookups.do(key, read_page)
+    known = if_none_match(etag)
+    if known:
+        return not_modified(known)
+    with serialization_timer():
+        body = encoder.encode_rows(rows)
+    return json_response(body, status.HTTP_200_OK, headers)
+
+######################################################################
+# SEARCH CUSTOMERS
+######################################################################
+@app.route("/customers/search", methods=["GET"])
+def search_customers():
+    """ Searches the Customers
+    This endpoint will return the Customers best matching some words
+    ---
+    tags:
+      - Customers
+    description: Fuzzy search of the Customer name, email and address. Partial and
+      misspelled words match; the best matches come first.
+    parameters:
+      - name: q
+        in: query
+        description: the words to look for (at least 3 letters or digits)
+        required: true
+        type: string
+      - name: limit
+        in: query
+        description: the maximum number of Customers to return in one page
+        required: false
+        type: integer
+      - name: offset
+        in: query
+        description: the number of better matches to skip
+        required: false
+        type: integer
+      - name: fields
+        in: query
+        description: comma separated Customer fields to return (e.g., id,name,active)
+        required: false
+        type: string
+    responses:
+      200:
+        description: An array of Customers, best match first
+        headers:
+          Link:
+            type: string
+            description: the URL of the next page, when there is one
+        schema:
+          type: array
+          items:
+            schema:
+              $ref: '#/definitions/Customer'
+      400:
+        description: Bad Request (the words or paging parameters were not valid)
+    """
+    text = request.args.get("q", "")
+    app.logger.info("Request to search customers for %s", text)
+    # shorter words share their trigrams with too many customers to rank
+    if sum(character.isalnum() for character in text) < 3:
+        abort(status.HTTP_400_BAD_REQUEST, "q must have at least 3 letters or digits")
+    offset = get_int_arg("offset", minimum=0) or 0
+    limit = get_int_arg("limit", minimum=1) or app.config["CUSTOMERS_SEARCH_PAGE_SIZE"]
+    limit = min(limit, app.config["CUSTOMERS_MAX_PAGE_SIZE"])
+    # ranking every match of a deep page costs as much as all the pages before it
+    limit = min(limit, app.config["CUSTOMERS_SEARCH_MAX_RESULTS"] - offset)
+    if limit < 1:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Search results stop after {}".format(app.config["CUSTOMERS_SEARCH_MAX_RESULTS"]),
+        )
 
-    results = [customer.serialize() for customer in customers]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    fields = get_fields()
+    encoder = RowEncoder(Customer.columns(fields))
+    # fetch one extra row to learn whether there is a next page
+    rows = Customer.search(text, limit + 1, offset, Customer.columns(fields))
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if offset + limit < app.config["CUSTOMERS_SEARCH_MAX_RESULTS"]:
+            args = request.args.to_dict()
+            args.update(offset=offset + limit, limit=limit)
+            next_url = url_for("search_customers", _external=True, **args)
+            headers["Link"] = '<{}>; rel="next"'.format(next_url)
+
+    with serialization_timer():
+        body = encoder.encode_rows(rows)
+    return json_response(body, status.HTTP_200_OK, headers)
 
 ######################################################################
 # UPDATE AN EXISTING CUSTOMER
@@ -341,6 +989,11 @@ def update_customers(customer_id):
         description: ID of customer to update
         type: integer
         required: true
+      - name: If-Match
+        in: header
+        description: only update the Customer if it still has this ETag
+        type: string
+        required: false
       - in: body
         name: body
         schema:  
@@ -373,16 +1026,63 @@ def update_customers(customer_id):
           $ref: '#/definitions/Customer'
       400:
         description: Bad Request (the posted data was not valid)
+      412:
+        description: The Customer was changed since the version in If-Match
     """
     app.logger.info("Request to update customer with id: %s", customer_id)
     check_content_type("application/json")
-    customer = Customer.find(customer_id)
-    if not customer:
-        raise NotFound("Customer with id '{}' was not found.".format(customer_id))
-    customer.deserialize(request.get_json())
-    customer.id = customer_id
-    customer.save()
-    return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
+    customer = Customer().deserialize(request.get_json())
+    values = {name: getattr(customer, name) for name in Customer.UPDATABLE_FIELDS}
+    return update_customer(customer_id, values)
+
+
+######################################################################
+# UPDATE SOME FIELDS OF AN EXISTING CUSTOMER
+######################################################################
+@app.route("/customers/<int:customer_id>", methods=["PATCH"])
+def patch_customers(customer_id):
+    """
+    Update some fields of a Customer
+    This endpoint will only change the fields in the body that is posted
+    ---
+    tags:
+      - Customers
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - name: customer_id
+        in: path
+        description: ID of customer to update
+        type: integer
+        required: true
+      - name: If-Match
+        in: header
+        description: only update the Customer if it still has this ETag
+        type: string
+        required: false
+      - in: body
+        name: body
+        schema:
+          $ref: '#/definitions/CustomerFields'
+    responses:
+      200:
+        description: Customer Updated
+        schema:
+          $ref: '#/definitions/Customer'
+      400:
+        description: Bad Request (the posted data was not valid)
+      412:
+        description: The Customer was changed since the version in If-Match
+    """
+    app.logger.info("Request to patch customer with id: %s", customer_id)
+    check_content_type("application/json")
+    values = Customer.check_values(request.get_json())
+    if not values:
+        abort(status.HTTP_400_BAD_REQUEST, "No fields to update")
+    # the UPDATE only sets the columns in the body
+    return update_customer(customer_id, values)
 
 
 ######################################################################
@@ -403,6 +1103,11 @@ def deactivate(customer_id):
         description: ID of customer to deactivate
         type: integer
         required: true
+      - name: If-Match
+        in: header
+        description: only deactivate the Customer if it still has this ETag
+        type: string
+        required: false
     responses:
       200:
         description: Customer Deactivated
@@ -410,15 +1115,11 @@ def deactivate(customer_id):
           $ref: '#/definitions/Customer'
       400:
         description: Bad Request (the posted data was not valid)
+      412:
+        description: The Customer was changed since the version in If-Match
     """
     app.logger.info('Request to deactivate customer with id: %s', customer_id)
-    customer = Customer.find(customer_id)
-    if not customer:
-        app.abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found".format(customer_id))
-    customer.user_id = customer_id
-    customer.active = False
-    customer.save()
-    return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
+    return update_customer(customer_id, {"active": False})
 
 ######################################################################
 # ACTIVATE A CUSTOMER
@@ -439,6 +1140,11 @@ def activate(customer_id):
         description: ID of customer to activate
         type: integer
         required: true
+      - name: If-Match
+        in: header
+        description: only activate the Customer if it still has this ETag
+        type: string
+        required: false
     responses:
       200:
         description: Customer Activated
@@ -446,15 +1152,141 @@ def activate(customer_id):
           $ref: '#/definitions/Customer'
       400:
         description: Bad Request (the posted data was not valid)
+      412:
+        description: The Customer was changed since the version in If-Match
     """
     app.logger.info('Request to activate customer with id: %s', customer_id)
-    customer = Customer.find(customer_id)
-    if not customer:
-        app.abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found".format(customer_id))
-    customer.customer_id = customer_id
-    customer.active = True
-    customer.save()
-    return make_response(jsonify(customer.serialize()), status.HTTP_200_OK)
+    return update_customer(customer_id, {"active": True})
+
+######################################################################
+# UPDATE CUSTOMERS IN BULK
+######################################################################
+@app.route("/customers", methods=["PATCH"])
+def patch_customers_bulk():
+    """
+    Update some fields of many Customers
+    This endpoint will change the posted fields of every selected Customer at once
+    ---
+    tags:
+      - Customers
+    description: Selects Customers with a list of ids in the body, with the filters of
+      GET /customers in the query string (e.g., ?email__suffix=@nyu.edu), or both.
+      The changes are made by set-based UPDATE statements in a single transaction.
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        schema:
+          id: CustomerFields
+          properties:
+            ids:
+                type: array
+                items:
+                  type: integer
+                description: the ids of the Customers to update
+            name:
+                type: string
+                description: the customers's name
+            address:
+                type: string
+                description: the address of customer (e.g., 55 Washington Way)
+            phone_number:
+                type: string
+                description: the phone number of customer (e.g., 555-156-1557)
+            email:
+                type: string
+                description: the email of customer (e.g., swagger@test.com)
+            credit_card:
+                type: string
+                description: the credit card of customer (e.g., VISA)
+            active:
+                type: boolean
+                description: whether the customer is active
+    responses:
+      200:
+        description: Customers Updated
+        schema:
+          $ref: '#/definitions/UpdateResult'
+      400:
+        description: Bad Request (the posted data or the selection was not valid)
+    """
+    app.logger.info("Request to patch customers in bulk")
+    check_content_type("application/json")
+    data = request.get_json()
+    ids = data.pop("ids", None) if isinstance(data, dict) else None
+    values = Customer.check_values(data)
+    if not values:
+        abort(status.HTTP_400_BAD_REQUEST, "No fields to update")
+    return update_selected(values, ids)
+
+
+@app.route("/customers/deactivate", methods=["PUT"])
+def deactivate_bulk():
+    """
+    Deactivate many Customers
+    This endpoint will deactivate every selected Customer at once
+    ---
+    tags:
+      - Customers
+    description: Selects Customers with a list of ids in the body, with the filters of
+      GET /customers in the query string, or both.
+    parameters:
+      - in: body
+        name: body
+        required: false
+        schema:
+          id: CustomerIds
+          properties:
+            ids:
+                type: array
+                items:
+                  type: integer
+                description: the ids of the Customers
+    responses:
+      200:
+        description: Customers Deactivated
+        schema:
+          id: UpdateResult
+          properties:
+            updated:
+                type: integer
+                description: the number of Customers updated
+      400:
+        description: Bad Request (the selection was not valid)
+    """
+    app.logger.info("Request to deactivate customers in bulk")
+    return update_selected({"active": False}, get_body_ids())
+
+
+@app.route("/customers/activate", methods=["PUT"])
+def activate_bulk():
+    """
+    Activate many Customers
+    This endpoint will activate every selected Customer at once
+    ---
+    tags:
+      - Customers
+    description: Selects Customers with a list of ids in the body, with the filters of
+      GET /customers in the query string, or both.
+    parameters:
+      - in: body
+        name: body
+        required: false
+        schema:
+          $ref: '#/definitions/CustomerIds'
+    responses:
+      200:
+        description: Customers Activated
+        schema:
+          $ref: '#/definitions/UpdateResult'
+      400:
+        description: Bad Request (the selection was not valid)
+    """
+    app.logger.info("Request to activate customers in bulk")
+    return update_selected({"active": True}, get_body_ids())
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
@@ -466,9 +1298,192 @@ def init_db():
     global app
     Customer.init_db(app)
 
-def check_content_type(content_type):
+def customer_etag(customer):
+    """ Returns the strong ETag of a Customer, derived from its row version """
+    return "{}.{}".format(customer.id, customer.version)
+
+def customer_response(customer, code, headers=None):
+    """ Returns a serialized Customer along with its ETag """
+    with serialization_timer():
+        body = encoding.dumps(customer.serialize())
+    response = json_response(body, code, headers)
+    response.set_etag(customer_etag(customer))
+    return response
+
+def json_response(body, code, headers=None):
+    """ Returns a response for an already encoded JSON body """
+    return Response(body, status=code, headers=headers, mimetype="application/json")
+
+def not_modified(etag):
+    """ Returns an empty 304 response for a resource the client already has """
+    response = make_response("", status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
+
+def if_none_match(etag):
+    """
+    Returns the ETag of If-None-Match naming this version in any encoding
+
+    The 304 response repeats it, so that it names the representation the
+    client has. None means the client has none of them.
+    """
+    if request.if_none_match.star_tag:
+        return etag
+    for tag in request.if_none_match.as_set(include_weak=True):
+        if compression.decoded_etag(tag) == etag:
+            return tag
+    return None
+
+def if_match_versions(customer_id):
+    """
+    Returns the versions of a Customer its If-Match header accepts
+
+    None means any version: there is no If-Match header, or it is "*".
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = "{}.".format(customer_id)
+    # the ETags of compressed responses name the same versions
+    etags = [compression.decoded_etag(etag) for etag in request.if_match]
+    versions = [
+        int(etag[len(prefix):])
+        for etag in etags
+        if etag.startswith(prefix) and etag[len(prefix):].isdigit()
+    ]
+    if not versions:
+        # none of the ETags belongs to this Customer
+        raise PreconditionFailed(
+            "Customer with id '{}' has changed since it was read".format(customer_id)
+        )
+    return versions
+
+def update_customer(customer_id, values):
+    """ Updates a Customer with a single UPDATE and returns the updated Customer """
+    customer = Customer.update_by_id(customer_id, values, if_match_versions(customer_id))
+    if customer is None:
+        raise NotFound("Customer with id '{}' was not found.".format(customer_id))
+    return customer_response(customer, status.HTTP_200_OK)
+
+def check_profiling():
+    """ Hides the query profiles unless profiling is turned on """
+    if not profiler.is_enabled():
+        raise NotFound("Profiling is turned off.")
+
+def get_body_ids():
+    """ Returns the ids of an optional JSON body, or None without a body """
+    if not request.get_data():
+        return None
+    check_content_type("application/json")
+    data = request.get_json()
+    if not isinstance(data, dict):
+        abort(status.HTTP_400_BAD_REQUEST, "The body must be an object with ids")
+    return data.get("ids")
+
+def select_customers(ids, action, args=None):
+    """ Returns the query of the Customers selected by the filters of the query string """
+    args = request.args if args is None else args
+    # a bulk change applies to every match: paging would not narrow it down
+    paging = sorted(filters.RESERVED_ARGS.intersection(args))
+    if paging:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Cannot {} Customers in bulk by page: {} only apply to GET /customers".format(
+                action, ", ".join(paging)
+            ),
+        )
+    customer_filters = filters.parse_filters(args)
+    if ids is None and not customer_filters:
+        # never change the whole table by accident
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Select the Customers to {} with ids or filters".format(action),
+        )
+    if ids is not None and (
+        not isinstance(ids, list) or any(type(item) is not int for item in ids)
+    ):
+        abort(status.HTTP_400_BAD_REQUEST, "ids must be a list of integers")
+    return filters.apply_filters(Customer.live(), customer_filters)
+
+def update_selected(values, ids=None):
+    """ Updates the Customers selected by ids and the filters of the query string """
+    query = select_customers(ids, "update")
+    count = Customer.update_many(
+        values, query, ids, app.config["CUSTOMERS_BATCH_CHUNK_SIZE"]
+    )
+    app.logger.info("Updated %d customers", count)
+    return json_response(encoding.dumps({"updated": count}), status.HTTP_200_OK)
+
+def get_int_arg(name, minimum=None):
+    """ Returns an integer query parameter or None when it is absent """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "{} must be an integer".format(name))
+    if minimum is not None and value < minimum:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "{} must be at least {}".format(name, minimum),
+        )
+    return value
+
+def get_fields():
+    """ Returns the Customer fields selected with ?fields= (all by default) """
+    names = {name.strip() for name in request.args.get("fields", "").split(",")}
+    names.discard("")
+    if not names:
+        return Customer.SERIALIZED_FIELDS
+    unknown = names.difference(Customer.SERIALIZED_FIELDS)
+    if unknown:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "Unknown fields: {}".format(", ".join(sorted(unknown))),
+        )
+    return tuple(name for name in Customer.SERIALIZED_FIELDS if name in names)
+
+def get_stream_format():
+    """ Returns the requested streaming format (json or ndjson) or None """
+    stream_format = request.args.get("stream")
+    if stream_format is None and request.accept_mimetypes.best == NDJSON:
+        stream_format = "ndjson"
+    if stream_format not in (None, "json", "ndjson"):
+        abort(status.HTTP_400_BAD_REQUEST, "stream must be json or ndjson")
+    return stream_format
+
+def stream_rows(rows, encoder, stream_format):
+    """ Streams rows as a JSON array or as NDJSON lines """
+
+    def generate_ndjson():
+        for row in rows:
+            yield encoder.encode_row(row) + "\n"
+
+    def generate_json():
+        separator = "["
+        for row in rows:
+            yield separator + encoder.encode_row(row)
+            separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    if stream_format == "ndjson":
+        return Response(stream_with_context(generate_ndjson()), mimetype=NDJSON)
+    return Response(stream_with_context(generate_json()), mimetype="application/json")
+
+def read_ndjson_records():
+    """ Yields (line number, record) pairs from an NDJSON request body """
+    for index, line in enumerate(request.stream):
+        if not line.strip():
+            continue
+        try:
+            yield index, json.loads(line)
+        except ValueError:
+            # let deserialize report the line as bad data
+            yield index, None
+
+def check_content_type(*content_types):
     """ Checks that the media type is correct """
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
         return
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
-    abort(415, "Content-Type must be {}".format(content_type))
\ No newline at end of file
+    abort(415, "Content-Type must be {}".format(" or ".join(content_types)))
\ No newline at end of file
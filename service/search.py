@@ -0,0 +1,94 @@
+"""
+Customer Search
+
+Fuzzy matching of partial or misspelled words against the Customer name,
+email and address. PostgreSQL answers searches from the pg_trgm GIN
+indexes declared by the model. Other databases, such as the SQLite used
+in development and tests, get NgramIndex: an in-process index of the same
+trigrams, rebuilt whenever the customer table has changed.
+"""
+import re
+import threading
+from collections import defaultdict
+
+# Matches of a word need this share of its trigrams, as the pg_trgm default
+# pg_trgm.word_similarity_threshold does
+WORD_SIMILARITY_THRESHOLD = 0.6
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def trigrams(value):
+    """
+    Returns the set of trigrams of a string, as pg_trgm computes them
+
+    Each lower case word is padded with two spaces in front and one
+    behind, so short words and word boundaries get trigrams of their own.
+    """
+    grams = set()
+    for word in _WORD.findall((value or "").lower()):
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NgramIndex:
+    """
+    An in-process trigram index of some text fields
+
+    Documents are scored like the pg_trgm word_similarity() function: the
+    best share of the trigrams of the query found in any one field. Only
+    documents scoring at least ``threshold`` match.
+    """
+
+    def __init__(self, threshold=WORD_SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self.version = None
+        self._postings = {}
+        self._lock = threading.Lock()
+
+    def build(self, documents, version=None):
+        """
+        Replaces the content of the index
+
+        Args:
+            documents (iterable): (id, field, field, ...) tuples
+            version: a value identifying the indexed data, see is_current()
+        """
+        postings = defaultdict(set)
+        for document in documents:
+            key = document[0]
+            for position, value in enumerate(document[1:]):
+                for gram in trigrams(value):
+                    postings[gram].add((key, position))
+        with self._lock:
+            self._postings = dict(postings)
+            self.version = version
+
+    def is_current(self, version):
+        """ Returns True when the index was built from the data of this version """
+        return self.version is not None and self.version == version
+
+    def search(self, text, limit=None, offset=0):
+        """
+        Returns the (id, score) pairs of the best matches of a text
+
+        The pairs are ordered by descending score, then by id.
+        """
+        grams = trigrams(text)
+        if not grams:
+            return []
+        with self._lock:
+            postings = self._postings
+        counts = defaultdict(int)
+        for gram in grams:
+            for posting in postings.get(gram, ()):
+                counts[posting] += 1
+        scores = {}
+        for (key, _), count in counts.items():
+            score = count / len(grams)
+            if score >= self.threshold and score > scores.get(key, 0):
+                scores[key] = score
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        end = None if limit is None else offset + limit
+        return ranked[offset:end]
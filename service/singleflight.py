@@ -0,0 +1,263 @@
+"""
+Single Flight
+
+Collapses concurrent identical lookups: the first caller of a key runs
+the lookup, and the callers asking for the same key while it runs wait
+for it and share its result, so a burst of requests for one customer or
+one page runs its SQL once. Results are shared as they are, so lookups
+must return plain values (rows, ETags), never objects bound to
+the session of one request.
+
+A lookup only shares the flight of one that started after the last
+committed write (see wrote()): the key of every flight includes the
+number of writes seen, so a client reading after its own write never
+gets a result read before it.
+
+SharedSingleFlight also collapses the lookups of the workers of one host,
+through a lock file per key in a local directory: a worker holding the
+lock of a key runs its lookup and writes the result into the lock file,
+which the workers waiting for the lock then read back. Results are
+written as JSON, so they must be JSON values, and a tuple comes back as
+a list. The files hold customers, so the directory must belong to the
+user running the service and be closed to everyone else (mode 0700).
+"""
+import fcntl
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+
+MODES = ("off", "worker", "host")
+# Size of the writes file of a host at which it starts over
+MAX_WRITES_FILE_SIZE = 1 << 20
+
+
+class Call:
+    """ A lookup in flight, and its result once it is done """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        """ Returns the result of the lookup, or raises its error """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """ Shares the result of a lookup among the threads asking for the same key """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self.writes = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def wrote(self):
+        """ Records a committed write, after which new lookups start new flights """
+        with self._lock:
+            self.writes += 1
+
+    def generation(self):
+        """ Returns the number of writes recorded so far """
+        with self._lock:
+            return self.writes
+
+    def do(self, key, function):
+        """
+        Returns the result of a lookup, running it unless it is already running
+
+        Args:
+            key (hashable): identifies the lookup, e.g. ("find", 42)
+            function (callable): runs the lookup and returns its result
+        """
+        # flights started before the last write never serve later lookups
+        key = (self.generation(), key)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if not leader:
+            return call.wait()
+        try:
+            call.result = self.run(key, function)
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def run(self, key, function):  # pylint: disable=unused-argument
+        """ Runs the lookup of a key for the threads of this process """
+        return function()
+
+    def stats(self):
+        """ Returns the number of lookups run and shared """
+        with self._lock:
+            return {
+                "mode": "worker",
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "in_flight": len(self._calls),
+            }
+
+
+class NullSingleFlight(SingleFlight):
+    """ Runs every lookup, used when single flight is turned off """
+
+    def do(self, key, function):
+        return function()
+
+    def wrote(self):
+        pass
+
+    def stats(self):
+        return {"mode": "off"}
+
+
+class SharedSingleFlight(SingleFlight):
+    """
+    Shares the result of a lookup among the workers of a host too
+
+    A worker waits at most ``timeout`` seconds for another one, then runs
+    the lookup itself. The lock is polled, so a waiting gevent worker
+    keeps serving its other requests.
+    """
+
+    def __init__(self, directory, timeout=5.0, poll_interval=0.005):
+        super().__init__()
+        self.directory = directory
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.shared = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        check_private(directory)
+
+    def wrote(self):
+        # the writes file grows a byte per write, so its size is the generation
+        # every worker of the host sees; a reset only has to differ from the
+        # generations of the lookups in flight
+        descriptor = os.open(self._writes_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(descriptor).st_size >= MAX_WRITES_FILE_SIZE:
+                os.ftruncate(descriptor, 0)
+            os.write(descriptor, b".")
+        finally:
+            os.close(descriptor)
+
+    def generation(self):
+        try:
+            return os.stat(self._writes_path()).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _writes_path(self):
+        """ Returns the path of the file counting the writes of the host """
+        return os.path.join(self.directory, "writes")
+
+    def path(self, key):
+        """ Returns the path of the lock file of a key """
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode("utf-8")).hexdigest())
+
+    def run(self, key, function):
+        path = self.path(key)
+        started = time.time()
+        with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), "r+b") as lock_file:
+            if not self._lock_file(lock_file):
+                return function()
+            try:
+                lock_file.seek(0)
+                data = lock_file.read()
+                if data:
+                    written_at, result = json.loads(data.decode("utf-8"))
+                    if written_at >= started:
+                        # another worker ran the lookup while this one waited
+                        with self._lock:
+                            self.shared += 1
+                        return result
+                result = function()
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(json.dumps([time.time(), result]).encode("utf-8"))
+                lock_file.flush()
+                self._unlink(path, lock_file)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _lock_file(self, lock_file):
+        """ Locks a file, polling until the timeout; returns False when it timed out """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _unlink(path, lock_file):
+        """
+        Removes the lock file of a key, unless another worker replaced it
+
+        The workers waiting for the lock read the result through the file
+        they opened, while the next lookup of the key starts a new file.
+        """
+        try:
+            if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats.update(mode="host", shared=self.shared)
+        return stats
+
+
+def check_private(directory):
+    """
+    Checks that a directory belongs to the current user and nobody else can use it
+
+    Raises:
+        ValueError: when it is a link, has another owner, or is open to others
+    """
+    info = os.lstat(directory)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or stat.S_IMODE(info.st_mode) != 0o700
+    ):
+        raise ValueError(
+            "Single flight directory {} must be a directory of uid {} with mode 0700".format(
+                directory, os.getuid()
+            )
+        )
+
+
+def create_single_flight(mode, directory=None):
+    """ Returns the single flight group of a CUSTOMERS_SINGLE_FLIGHT mode """
+    if mode not in MODES:
+        raise ValueError("Single flight mode must be one of {}".format(", ".join(MODES)))
+    if mode == "off":
+        return NullSingleFlight()
+    if mode == "host":
+        return SharedSingleFlight(directory)
+    return SingleFlight()
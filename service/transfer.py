@@ -0,0 +1,323 @@
+"""
+Customer Export and Import
+
+Moves the whole customer table in and out as CSV or NDJSON in constant
+memory. On PostgreSQL, CSV exports are streamed from COPY ... TO STDOUT
+and imports are loaded with COPY ... FROM STDIN. Elsewhere, and when
+psycogreen has registered a wait callback (psycopg2 cannot COPY then),
+exports read a server-side cursor and imports use chunked bulk inserts.
+"""
+import csv
+import io
+import json
+import logging
+import queue
+import threading
+from service.encoding import RowEncoder
+from service.models import Customer, DataValidationError, db
+
+logger = logging.getLogger("flask.app")
+
+FORMATS = ("csv", "ndjson")
+
+# Bytes handed over at a time between COPY and the response
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Chunks of COPY output waiting for the response, at most
+COPY_QUEUE_SIZE = 16
+
+_DONE = object()
+
+
+def can_copy(engine):
+    """ Returns True when the engine can run COPY through psycopg2 """
+    if engine.dialect.name != "postgresql" or engine.dialect.driver != "psycopg2":
+        return False
+    import psycopg2.extensions  # pylint: disable=import-outside-toplevel
+
+    return psycopg2.extensions.get_wait_callback() is None
+
+
+######################################################################
+#  E X P O R T
+######################################################################
+
+
+def export_customers(export_format, batch_size=1000):
+    """
+    Returns an iterator over the live Customers as chunks of bytes
+
+    Args:
+        export_format (string): csv (with a header line) or ndjson
+        batch_size (int): the number of rows read per round-trip and per chunk
+    """
+    logger.info("Exporting customers as %s", export_format)
+    engine = db.engine
+    if export_format == "csv" and can_copy(engine):
+        return _copy_out(engine, _copy_out_statement())
+    columns = Customer.columns()
+    rows = Customer.stream(batch_size=batch_size, columns=columns)
+    if export_format == "csv":
+        return _csv_chunks(rows, batch_size)
+    return _ndjson_chunks(rows, RowEncoder(columns), batch_size)
+
+
+def _copy_out_statement():
+    """ Returns the COPY statement writing the live Customers as CSV """
+    fields = [
+        "CASE WHEN active THEN 'true' ELSE 'false' END AS active" if name == "active" else name
+        for name in Customer.SERIALIZED_FIELDS
+    ]
+    return (
+        "COPY (SELECT {} FROM customer WHERE deleted_at IS NULL ORDER BY id) "
+        "TO STDOUT WITH (FORMAT csv, HEADER)".format(", ".join(fields))
+    )
+
+
+def _csv_chunks(rows, batch_size):
+    """ Yields CSV chunks of ``batch_size`` rows, after a header line """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(Customer.SERIALIZED_FIELDS)
+    active = Customer.SERIALIZED_FIELDS.index("active")
+    count = 0
+    for row in rows:
+        row = list(row)
+        row[active] = "true" if row[active] else "false"
+        writer.writerow(row)
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _ndjson_chunks(rows, encoder, batch_size):
+    """ Yields NDJSON chunks of ``batch_size`` rows """
+    lines = []
+    for row in rows:
+        lines.append(encoder.encode_row(row))
+        if len(lines) == batch_size:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class _QueueWriter:
+    """ A file that hands what COPY writes to a queue, in buffered chunks """
+
+    def __init__(self, chunks, stop):
+        self.chunks = chunks
+        self.stop = stop
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        """ Buffers the output of COPY, one row at a time """
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= COPY_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Queues the buffered output """
+        if self.buffer:
+            self.put(b"".join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def put(self, item):
+        """ Waits for room in the queue, unless the reader went away """
+        while True:
+            if self.stop.is_set():
+                raise IOError("The export was cancelled")
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+def _copy_out(engine, statement):
+    """
+    Yields the output of COPY ... TO STDOUT in chunks
+
+    copy_expert() blocks until COPY has written everything, so it runs in
+    a thread of its own. The bounded queue between the two makes COPY wait
+    for a slow reader, which keeps the memory used constant.
+    """
+    chunks = queue.Queue(maxsize=COPY_QUEUE_SIZE)
+    stop = threading.Event()
+    writer = _QueueWriter(chunks, stop)
+
+    def copy():
+        connection = engine.raw_connection()
+        try:
+            connection.cursor().copy_expert(statement, writer)
+            writer.flush()
+            writer.put(_DONE)
+        except Exception as error:  # pylint: disable=broad-except
+            if not stop.is_set():
+                writer.put(error)
+        finally:
+            # returning the connection to the pool rolls the transaction back
+            connection.close()
+
+    thread = threading.Thread(target=copy, name="customers-export", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _DONE:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+######################################################################
+#  I M P O R T
+######################################################################
+
+
+def import_customers(stream, import_format, chunk_size=1000):
+    """
+    Creates Customers from a binary stream of CSV or NDJSON records
+
+    CSV needs a header line naming the fields. The id of exported records
+    is ignored: the imported Customers get new ids. The records are loaded
+    in a single transaction, so an invalid one leaves nothing behind.
+
+    Args:
+        stream (file): the records, read as they are loaded
+        import_format (string): csv or ndjson
+        chunk_size (int): the number of rows per INSERT statement
+
+    Returns:
+        int: the number of Customers created
+
+    Raises:
+        DataValidationError: when a record is not a valid Customer
+    """
+    logger.info("Importing customers from %s", import_format)
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    rows = (
+        _row(values, number, import_format)
+        for number, values in _read_records(text, import_format)
+    )
+    engine = db.engine
+    if can_copy(engine):
+        return _copy_in(engine, rows)
+    return Customer.load_many(rows, chunk_size)
+
+
+def _read_records(text, import_format):
+    """ Yields the line number and the dictionary of every record """
+    if import_format == "csv":
+        reader = csv.DictReader(text)
+        for values in reader:
+            yield reader.line_num, values
+        return
+    for number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            raise DataValidationError("Line {}: not a JSON object".format(number))
+
+
+def _row(values, number, import_format):
+    """ Returns the column values of the Customer of one record """
+    try:
+        if not isinstance(values, dict):
+            raise DataValidationError("not a JSON object")
+        values = {name: value for name, value in values.items() if name != "id"}
+        if import_format == "csv":
+            # DictReader puts the fields past the header under None
+            if None in values:
+                raise DataValidationError("more fields than the header line")
+            if values.get("name") == "":
+                values["name"] = None
+            if "active" in values:
+                if values["active"] not in ("true", "false"):
+                    raise DataValidationError("active must be true or false")
+                values["active"] = values["active"] == "true"
+        values.setdefault("active", True)
+        for name in Customer.UPDATABLE_FIELDS:
+            if name not in values:
+                raise DataValidationError("Invalid CustomersModel: missing " + name)
+        # the same checks as PATCH, without building a CustomersModel per row
+        return Customer.check_values(values)
+    except DataValidationError as error:
+        raise DataValidationError("Line {}: {}".format(number, error))
+
+
+def _copy_field(value):
+    """ Returns a value as a COPY CSV field, where an unquoted empty field is NULL """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return '"' + value.replace('"', '""') + '"'
+
+
+class _CsvReader:
+    """ A file that reads the COPY CSV lines of rows as they are checked """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ""
+        self.count = 0
+        self.error = None
+
+    def read(self, size=-1):
+        """ Returns ``size`` characters, or fewer once the rows run out """
+        lines = [self.buffer]
+        length = len(self.buffer)
+        try:
+            for row in self.rows:
+                line = ",".join(_copy_field(row[name]) for name in Customer.UPDATABLE_FIELDS)
+                lines.append(line + "\n")
+                length += len(line) + 1
+                self.count += 1
+                if 0 <= size <= length:
+                    break
+        except DataValidationError as error:
+            # psycopg2 only reports that read() failed, so keep the reason
+            self.error = error
+            raise
+        data = "".join(lines)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def _copy_in(engine, rows):
+    """ Loads rows with COPY ... FROM STDIN in a single transaction """
+    reader = _CsvReader(rows)
+    statement = "COPY customer ({}) FROM STDIN WITH (FORMAT csv)".format(
+        ", ".join(Customer.UPDATABLE_FIELDS)
+    )
+    connection = engine.raw_connection()
+    try:
+        connection.cursor().copy_expert(statement, reader, size=COPY_BUFFER_SIZE)
+        connection.commit()
+        # the commit bypasses the session, which tells the lookups otherwise
+        Customer.lookups.wrote()
+    except Exception:
+        connection.rollback()
+        if reader.error is not None:
+            raise reader.error
+        raise
+    finally:
+        connection.close()
+    logger.info("Imported %d customers", reader.count)
+    return reader.count
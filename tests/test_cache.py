@@ -0,0 +1,96 @@
+"""
+Test cases for the Cache Backends
+
+"""
+import unittest
+from service.cache import LRUCache, NullCache, create_cache
+
+
+class FakeClock:
+    """ A clock that only moves when told to """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the LRUCache """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """ Count hits and misses """
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, "one")
+        self.assertEqual(self.cache.get(1), "one")
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the least recently used entry when full """
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.get(1)
+        self.cache.set(3, "three")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "one")
+        self.assertEqual(self.cache.get(3), "three")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_expires_entries(self):
+        """ Treat entries older than the ttl as missing """
+        self.cache.set(1, "one")
+        self.clock.now = 9
+        self.assertEqual(self.cache.get(1), "one")
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_delete_and_clear(self):
+        """ Invalidate one entry or all of them """
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.delete(1)
+        self.cache.delete(3)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+
+    def test_invalidated_while_loading(self):
+        """ Drop a value read before its key was invalidated """
+        generation = self.cache.start_load(1)
+        self.cache.delete(1)
+        self.cache.finish_load(1, "old", generation)
+        self.assertIsNone(self.cache.get(1))
+        # a load started after the invalidation is stored
+        generation = self.cache.start_load(1)
+        self.cache.delete(2)
+        self.cache.finish_load(1, "new", generation)
+        self.assertEqual(self.cache.get(1), "new")
+        generation = self.cache.start_load(2)
+        self.cache.clear()
+        self.cache.finish_load(2, "old", generation)
+        self.assertIsNone(self.cache.get(2))
+        # nothing is remembered once the loads are done
+        self.assertEqual(self.cache._loading, {})
+        self.assertEqual(self.cache._deleted_at, {})
+
+    def test_create_cache(self):
+        """ Turn the cache off with a size of 0 """
+        self.assertIsInstance(create_cache(0, 10), NullCache)
+        self.assertIsInstance(create_cache(5, 10), LRUCache)
+        cache = NullCache()
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["misses"], 1)
@@ -0,0 +1,60 @@
+"""
+Test cases for the JSON Encoding
+
+"""
+import json
+import unittest
+from sqlalchemy import Boolean, Column, Float, Integer, MetaData, String, Table
+from service import encoding
+from service.encoding import RowEncoder
+
+TABLE = Table(
+    "things",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("name", String(63)),
+    Column("count", Integer, nullable=True),
+    Column("active", Boolean, nullable=False),
+    Column("score", Float),
+)
+
+
+######################################################################
+#  E N C O D I N G   T E S T   C A S E S
+######################################################################
+class TestEncoding(unittest.TestCase):
+    """ Test Cases for the JSON Encoding """
+
+    def tearDown(self):
+        encoding.set_backend("auto")
+
+    def test_row_encoder(self):
+        """ Encode row tuples as JSON objects """
+        encoder = RowEncoder(list(TABLE.columns))
+        rows = [
+            (1, 'Al "the" \\ 100%', 3, True, 1.5),
+            (2, None, None, False, None),
+            (3, "Zoë ☃\n", 0, True, 0.0, "extra value"),
+        ]
+        data = json.loads(encoder.encode_rows(rows))
+        self.assertEqual(
+            data,
+            [
+                {"id": 1, "name": 'Al "the" \\ 100%', "count": 3, "active": True, "score": 1.5},
+                {"id": 2, "name": None, "count": None, "active": False, "score": None},
+                {"id": 3, "name": "Zoë ☃\n", "count": 0, "active": True, "score": 0.0},
+            ],
+        )
+        self.assertEqual(json.loads(encoder.encode_row(rows[0]))["id"], 1)
+        self.assertEqual(encoder.encode_rows([]), b"[]")
+
+    def test_backends(self):
+        """ Switch between the JSON libraries """
+        data = {"name": "Alex", "ids": [1, 2], "active": True}
+        self.assertEqual(encoding.set_backend("json"), "json")
+        self.assertEqual(encoding.backend(), "json")
+        self.assertEqual(json.loads(encoding.dumps(data)), data)
+        if encoding.orjson is not None:
+            self.assertEqual(encoding.set_backend("orjson"), "orjson")
+            self.assertEqual(json.loads(encoding.dumps(data)), data)
+        self.assertRaises(ValueError, encoding.set_backend, "yaml")
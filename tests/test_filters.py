@@ -0,0 +1,95 @@
+"""
+Test cases for the Customer Filters
+
+"""
+import unittest
+from collections import namedtuple
+from werkzeug.datastructures import MultiDict
+from service import filters
+from service.filters import Filter, SortKey
+from service.models import DataValidationError
+
+Row = namedtuple("Row", "id name active")
+
+
+######################################################################
+#  F I L T E R   T E S T   C A S E S
+######################################################################
+class TestFilters(unittest.TestCase):
+    """ Test Cases for the Customer Filters """
+
+    def test_parse_filters(self):
+        """ Parse filters and convert their values """
+        args = MultiDict(
+            [("active", "False"), ("id__in", "1,2,"), ("email__suffix", "@nyu.edu"), ("limit", "5")]
+        )
+        self.assertEqual(
+            filters.parse_filters(args),
+            [
+                Filter("active", "eq", False),
+                Filter("id", "in", [1, 2]),
+                Filter("email", "suffix", "@nyu.edu"),
+            ],
+        )
+        args = MultiDict([("id__in", ",".join(["1"] * (filters.MAX_IN_VALUES + 1)))])
+        self.assertRaises(DataValidationError, filters.parse_filters, args)
+
+    def test_is_indexed(self):
+        """ Tell filters that can use an index from those that cannot """
+        self.assertTrue(filters.is_indexed([]))
+        self.assertTrue(filters.is_indexed([Filter("email", "prefix", "al")]))
+        self.assertFalse(filters.is_indexed([Filter("address", "eq", "NYC")]))
+        self.assertFalse(filters.is_indexed([Filter("email", "contains", "al")]))
+        self.assertTrue(
+            filters.is_indexed([Filter("address", "eq", "NYC"), Filter("email", "eq", "al")])
+        )
+        # the active index matches half of the table: alone it is a fine
+        # range, next to an unindexed filter it is a scan
+        self.assertTrue(filters.is_indexed([Filter("active", "eq", True)]))
+        self.assertFalse(
+            filters.is_indexed([Filter("address", "eq", "NYC"), Filter("active", "eq", True)])
+        )
+
+    def test_parse_sort(self):
+        """ Parse sort orders and end them with the id """
+        self.assertEqual(filters.parse_sort(None), [])
+        self.assertEqual(
+            filters.parse_sort("-active, name"),
+            [SortKey("active", True), SortKey("name", False), SortKey("id", False)],
+        )
+        self.assertEqual(filters.parse_sort("-id"), [SortKey("id", True)])
+        self.assertEqual(
+            filters.parse_sort("-email"), [SortKey("email", True), SortKey("id", True)]
+        )
+        self.assertRaises(DataValidationError, filters.parse_sort, "name,-name")
+
+    def test_is_range_sort(self):
+        """ Tell sorts served by a (field, id) index from the others """
+        for value in (None, "-id", "email", "-email,-id", "-name", "active"):
+            self.assertTrue(filters.is_range_sort(filters.parse_sort(value)), value)
+        # the NULL names follow the rest, and two fields have no index
+        for value in ("name", "-email,id", "active,name"):
+            self.assertFalse(filters.is_range_sort(filters.parse_sort(value)), value)
+
+    def test_after(self):
+        """ Compare row values when no NULL can follow the cursor """
+        keys = filters.parse_sort("-name")
+        condition = str(filters.after(keys, ["Al", 3]))
+        self.assertIn("(customer.name, customer.id) < (", condition)
+        self.assertNotIn(" OR ", condition)
+        # unnamed customers follow the named ones in ascending order
+        condition = str(filters.after(filters.parse_sort("name"), ["Al", 3]))
+        self.assertIn("customer.name IS NULL", condition)
+        condition = str(filters.after(keys, [None, 3]))
+        self.assertNotIn("(customer.name, customer.id)", condition)
+
+    def test_cursor(self):
+        """ Round-trip the sort values of a row through a cursor """
+        keys = filters.parse_sort("active,name")
+        cursor = filters.encode_cursor(keys, Row(7, None, True))
+        self.assertEqual(filters.decode_cursor(keys, cursor), [True, None, 7])
+        # the cursor of another sort order is rejected
+        other = filters.parse_sort("name")
+        self.assertRaises(DataValidationError, filters.decode_cursor, other, cursor)
+        cursor = filters.encode_cursor(filters.parse_sort("id"), Row(True, "Al", True))
+        self.assertRaises(DataValidationError, filters.decode_cursor, [SortKey("id", False)], cursor)
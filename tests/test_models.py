@@ -5,7 +5,10 @@ Test cases for Customer Model
 import logging
 import unittest
 import os
+from datetime import timedelta
+from unittest.mock import patch
 from service.models import Customer, DataValidationError, db
+from sqlalchemy.orm.exc import StaleDataError
 from service import app
 
 DATABASE_URI = os.getenv(
@@ -36,6 +39,7 @@ class TestCustomer(unittest.TestCase):
         """ This runs before each test """
         db.drop_all()  # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        Customer.cache.clear()
 
     def tearDown(self):
         """ This runs after each test """
@@ -227,3 +231,159 @@ class TestCustomer(unittest.TestCase):
         self.assertEqual(same_customer.id, customer.id)
         self.assertEqual(same_customer.name, customer.name)
     
+    def test_page(self):
+        """ Page through Customers by id """
+        for customer in self._create_customers(5):
+            customer.create()
+        page = Customer.page(limit=2).all()
+        self.assertEqual([c.id for c in page], [1, 2])
+        page = Customer.page(after_id=page[-1].id, limit=2).all()
+        self.assertEqual([c.id for c in page], [3, 4])
+        page = Customer.page(Customer.find_by_name("Alex"), after_id=4).all()
+        self.assertEqual([c.id for c in page], [5])
+
+    def test_stream(self):
+        """ Stream Customers in batches """
+        for customer in self._create_customers(5):
+            customer.create()
+        ids = [c.id for c in Customer.stream(after_id=1, batch_size=2)]
+        self.assertEqual(ids, [2, 3, 4, 5])
+
+    def test_create_many(self):
+        """ Create Customers in bulk """
+        ids = Customer.create_many(self._create_customers(5), chunk_size=2)
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+        self.assertEqual(len(Customer.all()), 5)
+        self.assertEqual(Customer.find(5).name, "Alex")
+
+    def test_find_is_cached(self):
+        """ Serve repeated lookups from the cache """
+        customer = self._create_customer()
+        customer.create()
+        db.session.expunge_all()
+        hits = Customer.cache.stats()["hits"]
+        Customer.find(customer.id)
+        db.session.expunge_all()
+        cached = Customer.find(customer.id)
+        self.assertEqual(Customer.cache.stats()["hits"], hits + 1)
+        self.assertEqual(cached.name, "Alex")
+        self.assertEqual(cached.active, True)
+        # the cached Customer can still be changed and saved
+        cached.name = "Sally"
+        cached.save()
+        db.session.expunge_all()
+        self.assertEqual(Customer.find(customer.id).name, "Sally")
+
+    def test_update_while_finding(self):
+        """ Keep a row read before an update out of the cache """
+        customer = self._create_customer()
+        customer.create()
+        db.session.expunge_all()
+        finish_load = Customer.cache.finish_load
+
+        def update_first(key, value, generation):
+            # the update commits between the SELECT and the cache write
+            Customer.update_by_id(key, {"address": "Union Square"})
+            finish_load(key, value, generation)
+
+        with patch.object(Customer.cache, "finish_load", side_effect=update_first):
+            Customer.find(customer.id)
+        db.session.expunge_all()
+        self.assertEqual(Customer.find(customer.id).address, "Union Square")
+
+    def test_delete_invalidates_cache(self):
+        """ Do not serve deleted Customers from the cache """
+        customer = self._create_customer()
+        customer.create()
+        found = Customer.find(customer.id)
+        found.delete()
+        db.session.expunge_all()
+        self.assertIsNone(Customer.find(customer.id))
+
+    def test_save_bumps_version(self):
+        """ Bump the row version on every update """
+        customer = self._create_customer()
+        customer.create()
+        self.assertEqual(customer.version, 1)
+        customer.address = "Union Square"
+        customer.save()
+        self.assertEqual(customer.version, 2)
+
+    def test_save_stale_version(self):
+        """ Refuse to overwrite a concurrent update """
+        customer = self._create_customer()
+        customer.create()
+        db.session.execute(
+            Customer.__table__.update().values(version=Customer.version + 1)
+        )
+        customer.address = "Union Square"
+        self.assertRaises(StaleDataError, customer.save)
+
+    def test_update_many(self):
+        """ Update many Customers with set-based statements """
+        ids = Customer.create_many(
+            Customer(name=name, address="NYC", phone_number="555", email="a@b.c",
+                     credit_card="VISA", active=True)
+            for name in ["Alex", "Sally", "John", "Jane"]
+        )
+        count = Customer.update_many({"active": False}, ids=ids[:3], chunk_size=2)
+        self.assertEqual(count, 3)
+        count = Customer.update_many(
+            {"address": "LA"}, Customer.query.filter(Customer.active == False)
+        )
+        self.assertEqual(count, 3)
+        customer = Customer.find(ids[0])
+        self.assertEqual((customer.active, customer.address, customer.version), (False, "LA", 3))
+        self.assertEqual(Customer.find(ids[3]).version, 1)
+
+    def test_update_by_id(self):
+        """ Update a Customer without reading it first """
+        customer = self._create_customer()
+        customer.create()
+        customer_id = customer.id
+        updated = Customer.update_by_id(customer_id, {"address": "Union Square"})
+        self.assertEqual(
+            (updated.address, updated.name, updated.version), ("Union Square", "Alex", 2)
+        )
+        updated = Customer.update_by_id(customer_id, {"active": False}, versions=[1, 2])
+        self.assertEqual((updated.active, updated.version), (False, 3))
+        self.assertRaises(StaleDataError, Customer.update_by_id, customer_id, {"active": True}, [2])
+        self.assertIsNone(Customer.update_by_id(99, {"active": True}))
+        self.assertIsNone(Customer.update_by_id(99, {"active": True}, [1]))
+        db.session.expunge_all()
+        self.assertEqual(Customer.find(customer_id).version, 3)
+
+    def test_check_values(self):
+        """ Check the new values of some fields """
+        self.assertEqual(Customer.check_values({"name": None}), {"name": None})
+        self.assertRaises(DataValidationError, Customer.check_values, {"email": None})
+        self.assertRaises(DataValidationError, Customer.check_values, {"active": 1})
+        self.assertRaises(DataValidationError, Customer.check_values, {"version": 3})
+        self.assertRaises(DataValidationError, Customer.check_values, ["name"])
+
+    def test_delete_many(self):
+        """ Delete many Customers with set-based statements """
+        ids = Customer.create_many(self._create_customers(5))
+        self.assertEqual(Customer.delete_many(ids=ids[:2] + [99]), 2)
+        query = Customer.live().filter(Customer.id > ids[3])
+        self.assertEqual(Customer.delete_many(query), 1)
+        self.assertEqual([c.id for c in Customer.all()], ids[2:4])
+
+    def test_soft_delete(self):
+        """ Hide soft deleted Customers until they are purged """
+        ids = Customer.create_many(self._create_customers(4))
+        Customer.soft_delete = True
+        try:
+            Customer.find(ids[0]).delete()
+            self.assertEqual(Customer.delete_many(ids=ids[1:3]), 2)
+            self.assertIsNone(Customer.find(ids[0]))
+            self.assertEqual([c.id for c in Customer.all()], [ids[3]])
+            self.assertEqual([c.id for c in Customer.page()], [ids[3]])
+            self.assertEqual(Customer.find_by_name("Alex").count(), 1)
+            # the rows are still there until they are purged
+            self.assertEqual(Customer.query.count(), 4)
+            self.assertEqual(Customer.purge(timedelta(days=1)), 0)
+            self.assertEqual(Customer.purge(batch_size=2), 3)
+            self.assertEqual(Customer.query.count(), 1)
+        finally:
+            Customer.soft_delete = False
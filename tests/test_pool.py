@@ -0,0 +1,64 @@
+"""
+Test cases for the Connection Pool
+
+"""
+import unittest
+from sqlalchemy import create_engine, exc
+from sqlalchemy.pool import NullPool
+from service.pool import InstrumentedQueuePool, engine_options, pool_stats
+
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+class TestPool(unittest.TestCase):
+    """ Test Cases for the Connection Pool """
+
+    def test_engine_options(self):
+        """ Build the pool options from the config """
+        config = {
+            "SQLALCHEMY_DATABASE_URI": "postgres://postgres@localhost/postgres",
+            "DB_POOL_SIZE": 3,
+            "DB_MAX_OVERFLOW": 2,
+            "DB_POOL_TIMEOUT": 5,
+            "DB_POOL_RECYCLE": 600,
+            "DB_POOL_PRE_PING": True,
+        }
+        options = engine_options(config)
+        self.assertIs(options["poolclass"], InstrumentedQueuePool)
+        self.assertEqual(options["pool_size"], 3)
+        self.assertEqual(options["max_overflow"], 2)
+        self.assertEqual(options["pool_timeout"], 5)
+        self.assertEqual(options["pool_recycle"], 600)
+        self.assertTrue(options["pool_pre_ping"])
+        config["DB_PGBOUNCER"] = True
+        self.assertEqual(engine_options(config), {"poolclass": NullPool})
+        config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.assertEqual(engine_options(config), {})
+
+    def test_pool_stats(self):
+        """ Count the checkouts that waited for a connection """
+        engine = create_engine(
+            "sqlite://",
+            poolclass=InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.05,
+        )
+        connection = engine.connect()
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats["class"], "InstrumentedQueuePool")
+        self.assertEqual(stats["checked_out"], 1)
+        self.assertEqual(stats["waits"], 0)
+        self.assertRaises(exc.TimeoutError, engine.connect)
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats["waits"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreater(stats["wait_time"], 0)
+        self.assertGreater(stats["recent_wait"], 0.04)
+        self.assertEqual(stats["waiting"], 0)
+        connection.close()
+        engine.connect().close()
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["waits"], 1)
@@ -6,10 +6,12 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 from flask_api import status  # HTTP Status Codes
+from sqlalchemy import event
 from service.models import db, Customer
 from service.routes import app, init_db
 
@@ -37,6 +39,7 @@ class TestCustomerServer(TestCase):
         """ Runs before each test """
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        Customer.cache.clear()
         self.app = app.test_client()
 
     def tearDown(self):
@@ -189,6 +192,24 @@ class TestCustomerServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_delete_customer_changed_elsewhere(self):
+        """ Delete a cached Customer that another worker changed since """
+        self._create_customers("Alex").create()
+        url = "/customers/1"
+        etag = self.app.get(url).headers["ETag"]
+        # another worker bumps the version without touching this cache
+        db.session.execute(
+            Customer.__table__.update().values(version=Customer.version + 1)
+        )
+        db.session.commit()
+        resp = self.app.delete(url, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.delete(url)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+
     def test_bad_request(self):
         """ Send bad request """
         customer = self._create_customers()
@@ -280,4 +301,550 @@ class TestCustomerServer(TestCase):
                             json=body,
                             content_type="application/json")
         self.assertEqual(resp_activate.status_code, status.HTTP_200_OK)
-        self.assertEqual(resp_activate.get_json()["active"], True)
\ No newline at end of file
+        self.assertEqual(resp_activate.get_json()["active"], True)
+
+    def test_get_customer_list_paged(self):
+        """ Page through Customers with limit and after_id """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        resp = self.app.get("/customers?limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([c["name"] for c in data], ["Alex", "Sally"])
+        link = resp.headers.get("Link")
+        self.assertIn('rel="next"', link)
+        self.assertIn("after_id={}".format(data[-1]["id"]), link)
+        next_url = link[link.index("<") + 1:link.index(">")]
+        resp = self.app.get(next_url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([c["name"] for c in data], ["John"])
+        self.assertIsNone(resp.headers.get("Link"))
+
+    def test_get_customer_list_bad_paging(self):
+        """ Reject invalid paging parameters """
+        resp = self.app.get("/customers?limit=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/customers?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/customers?stream=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_customer_list(self):
+        """ Stream Customers as a JSON array """
+        resp = self.app.get("/customers?stream=json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        resp = self.app.get("/customers?stream=json&after_id=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([c["name"] for c in data], ["Sally", "John"])
+
+    def test_stream_customer_list_ndjson(self):
+        """ Stream Customers as NDJSON lines """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        resp = self.app.get(
+            "/customers?name=Sally", headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])["name"], "Sally")
+
+    def test_create_customers_batch(self):
+        """ Create Customers in bulk from a JSON array """
+        body = [self._create_customers(name).serialize() for name in ["Alex", "Sally"]]
+        resp = self.app.post("/customers/batch", json=body, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 2)
+        self.assertEqual(data["errors"], [])
+        self.assertEqual(len(data["ids"]), 2)
+        resp = self.app.get("/customers/{}".format(data["ids"][1]))
+        self.assertEqual(resp.get_json()["name"], "Sally")
+
+    def test_create_customers_batch_ndjson_errors(self):
+        """ Report invalid rows of an NDJSON batch without failing it """
+        lines = [
+            json.dumps(self._create_customers("Alex").serialize()),
+            json.dumps({"name": "not enough data"}),
+            "this is not json",
+            json.dumps(self._create_customers("John").serialize()),
+        ]
+        resp = self.app.post(
+            "/customers/batch",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 2)
+        self.assertEqual([error["index"] for error in data["errors"]], [1, 2])
+        self.assertEqual(len(Customer.all()), 2)
+
+    def test_create_customers_batch_bad_request(self):
+        """ Reject a batch with no valid rows """
+        resp = self.app.post(
+            "/customers/batch", json=[{"name": "nope"}], content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(resp.get_json()["errors"]), 1)
+        resp = self.app.post(
+            "/customers/batch", json={"name": "nope"}, content_type="application/json"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/customers/batch", data="[]", content_type="text/html")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_service_status(self):
+        """ Report the cache counters """
+        test_customer = self._create_customers("Alex")
+        test_customer.create()
+        for _ in range(2):
+            db.session.expunge_all()
+            resp = self.app.get("/customers/{}".format(test_customer.id))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/status")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["status"], "OK")
+        self.assertGreaterEqual(data["cache"]["hits"], 1)
+        self.assertIn("class", data["pool"])
+
+    def test_deactivate_invalidates_cache(self):
+        """ Read a deactivated Customer back without a stale cache entry """
+        test_customer = self._create_customers("Alex")
+        test_customer.create()
+        url = "/customers/{}".format(test_customer.id)
+        self.assertEqual(self.app.get(url).get_json()["active"], True)
+        resp = self.app.put(url + "/deactivate")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        db.session.expunge_all()
+        self.assertEqual(self.app.get(url).get_json()["active"], False)
+
+    def test_update_without_select(self):
+        """ Update a Customer with a single round-trip, or two without RETURNING """
+        test_customer = self._create_customers("Alex")
+        test_customer.create()
+        url = "/customers/{}".format(test_customer.id)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            resp = self.app.put(url + "/deactivate", headers={"If-Match": '"1.1"'})
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["active"], False)
+        self.assertEqual(resp.headers["ETag"], '"1.2"')
+        expected = 1 if db.engine.dialect.implicit_returning else 2
+        self.assertEqual(len(statements), expected)
+        self.assertTrue(statements[0].startswith("UPDATE"))
+        # another Customer's ETag never matches, "*" matches any version
+        resp = self.app.put(url + "/activate", headers={"If-Match": '"2.2"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url + "/activate", headers={"If-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put("/customers/9/activate", headers={"If-Match": '"9.1"'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_customer_not_modified(self):
+        """ Answer If-None-Match with 304 until the Customer changes """
+        test_customer = self._create_customers("Alex")
+        test_customer.create()
+        url = "/customers/{}".format(test_customer.id)
+        resp = self.app.get(url)
+        etag = resp.headers.get("ETag")
+        self.assertIsNotNone(etag)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        resp = self.app.put(url + "/deactivate")
+        self.assertNotEqual(resp.headers.get("ETag"), etag)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_get_customer_list_not_modified(self):
+        """ Answer If-None-Match on a page with 304 until it changes """
+        self._create_customers("Alex").create()
+        resp = self.app.get("/customers")
+        etag = resp.headers.get("ETag")
+        # the page is not encoded for a client that already has it
+        with patch("service.routes.RowEncoder.encode_rows") as encode_rows:
+            resp = self.app.get("/customers", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        encode_rows.assert_not_called()
+        self._create_customers("Sally").create()
+        resp = self.app.get("/customers", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_update_customer_if_match(self):
+        """ Reject an update whose If-Match is stale with 412 """
+        test_customer = self._create_customers("Alex")
+        resp = self.app.post(
+            "/customers", json=test_customer.serialize(), content_type="application/json"
+        )
+        etag = resp.headers.get("ETag")
+        new_customer = resp.get_json()
+        url = "/customers/{}".format(new_customer["id"])
+        new_customer["address"] = "Union Square"
+        resp = self.app.put(
+            url, json=new_customer, content_type="application/json",
+            headers={"If-Match": etag},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # the second writer still holds the first version
+        new_customer["address"] = "Times Square"
+        resp = self.app.put(
+            url, json=new_customer, content_type="application/json",
+            headers={"If-Match": etag},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url + "/activate", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        db.session.expunge_all()
+        self.assertEqual(self.app.get(url).get_json()["address"], "Union Square")
+
+    def test_apidocs(self):
+        """ Serve the Swagger UI without loading flasgger at startup """
+        resp = self.app.get("/apidocs/?json=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["specs"][0]["url"], "/v1/spec")
+        resp = self.app.get("/apidocs/")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn(b"/flasgger_static/swagger-ui.js", resp.data)
+        resp = self.app.get("/flasgger_static/swagger-ui.js")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp.close()
+
+    def test_metrics(self):
+        """ Expose request and database metrics in Prometheus format """
+        self._create_customers("Alex").create()
+        resp = self.app.get("/customers")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("text/plain", resp.headers["Content-Type"])
+        text = resp.get_data(as_text=True)
+        self.assertIn(
+            'customers_http_request_duration_seconds_count{endpoint="list_customers",'
+            'method="GET",status="200"}',
+            text,
+        )
+        self.assertIn('customers_http_request_db_queries_bucket{endpoint="list_customers"', text)
+        self.assertIn("customers_http_request_serialization_seconds", text)
+        self.assertIn("customers_db_pool_checked_out", text)
+        queries = [
+            float(line.split()[-1]) for line in text.splitlines()
+            if line.startswith('customers_http_request_db_queries_sum{endpoint="list_customers"')
+        ]
+        self.assertGreaterEqual(queries[0], 1)
+
+    def test_get_customer_list_fields(self):
+        """ Return only the requested fields """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        resp = self.app.get("/customers?fields=active,name&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data, [{"name": "Alex", "active": True}, {"name": "Sally", "active": True}])
+        # paging still works when the id is not one of the fields
+        self.assertIn("after_id=2", resp.headers["Link"])
+        resp = self.app.get("/customers?fields=id&stream=ndjson")
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{"id": 1}, {"id": 2}, {"id": 3}])
+        resp = self.app.get("/customers?fields=name,password")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_list_filtered(self):
+        """ Filter Customers on several fields at once """
+        for name in ["Alex", "Sally", "Sam", "John"]:
+            customer = self._create_customers(name)
+            customer.email = "{}@{}".format(name.lower(), "nyu.edu" if name != "John" else "jr.com")
+            customer.create()
+        Customer.find(3).active = False
+        db.session.commit()
+        resp = self.app.get("/customers?name__prefix=S&active=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([c["name"] for c in resp.get_json()], ["Sally"])
+        resp = self.app.get("/customers?name__in=Alex,John,Nobody&fields=name")
+        self.assertEqual(resp.get_json(), [{"name": "Alex"}, {"name": "John"}])
+        resp = self.app.get("/customers?email__suffix=@nyu.edu&active=false")
+        self.assertEqual([c["name"] for c in resp.get_json()], ["Sam"])
+        # a wildcard in the value is matched literally
+        resp = self.app.get("/customers?name__prefix=%25")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_get_customer_list_unindexed_filter(self):
+        """ Cap the pages of filters that cannot use an index """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        self.app.application.config["CUSTOMERS_UNINDEXED_PAGE_SIZE"] = 2
+        try:
+            resp = self.app.get("/customers?address__contains=Square")
+            self.assertEqual(len(resp.get_json()), 2)
+            self.assertIn("limit=2", resp.headers["Link"])
+            # a selective indexed filter next to it lifts the cap
+            resp = self.app.get("/customers?address__contains=Square&id__in=1,2,3")
+            self.assertEqual(len(resp.get_json()), 3)
+            # the active index matches about half of the table, which is still a scan
+            resp = self.app.get("/customers?address__contains=Square&active=true")
+            self.assertEqual(len(resp.get_json()), 2)
+            resp = self.app.get("/customers?active=true")
+            self.assertEqual(len(resp.get_json()), 3)
+        finally:
+            self.app.application.config["CUSTOMERS_UNINDEXED_PAGE_SIZE"] = 100
+        for query in ("address__contains=Square", "address__contains=Square&active=true"):
+            resp = self.app.get("/customers?stream=json&" + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_list_sorted(self):
+        """ Page through Customers sorted by name """
+        for name in ["Sally", None, "Alex", "John", "Alex"]:
+            self._create_customers(name).create()
+        resp = self.app.get("/customers?sort=name&limit=2&fields=id")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        ids = [c["id"] for c in resp.get_json()]
+        while "Link" in resp.headers:
+            link = resp.headers["Link"]
+            self.assertIn("after=", link)
+            resp = self.app.get(link[link.index("<") + 1:link.index(">")])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            ids += [c["id"] for c in resp.get_json()]
+        self.assertEqual(ids, [3, 5, 4, 1, 2])
+        resp = self.app.get("/customers?sort=-name,-id&limit=2&fields=id")
+        ids = [c["id"] for c in resp.get_json()]
+        link = resp.headers["Link"]
+        resp = self.app.get(link[link.index("<") + 1:link.index(">")])
+        ids += [c["id"] for c in resp.get_json()]
+        self.assertEqual(ids, [2, 1, 4, 5])
+        # sorts that are not index ranges are capped like unindexed filters
+        self.app.application.config["CUSTOMERS_UNINDEXED_PAGE_SIZE"] = 2
+        try:
+            resp = self.app.get("/customers?sort=name&limit=3&fields=id")
+            self.assertEqual(len(resp.get_json()), 2)
+            resp = self.app.get("/customers?sort=-name&limit=3&fields=id")
+            self.assertEqual([c["id"] for c in resp.get_json()], [2, 1, 4])
+        finally:
+            self.app.application.config["CUSTOMERS_UNINDEXED_PAGE_SIZE"] = 100
+
+    def test_get_customer_list_bad_filters(self):
+        """ Reject unknown filters and unindexed sorts """
+        for query in [
+            "password=x",
+            "credit_card__prefix=4",
+            "name__like=A",
+            "active=maybe",
+            "active__prefix=t",
+            "id__in=1,a",
+            "sort=address",
+            "sort=id,name",
+            "sort=name&after=not-a-cursor",
+            "sort=name&after_id=1",
+            "after=WzFd",
+        ]:
+            resp = self.app.get("/customers?" + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_search_customers(self):
+        """ Search Customers by partial and misspelled words """
+        for name, email, address in [
+            ("Alexander Hamilton", "alex@jr.com", "1 Wall Street"),
+            ("Sally Ride", "sally@nasa.gov", "Washington Square Park"),
+            ("John Jay", "jjay@court.gov", "52 Broadway"),
+        ]:
+            customer = self._create_customers(name)
+            customer.email = email
+            customer.address = address
+            customer.create()
+        resp = self.app.get("/customers/search?q=Washingtn&fields=name")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"name": "Sally Ride"}])
+        resp = self.app.get("/customers/search?q=alexand")
+        self.assertEqual([c["id"] for c in resp.get_json()], [1])
+        # the index follows changes to the table
+        customer = Customer.find(3)
+        customer.address = "Washington Heights"
+        customer.save()
+        resp = self.app.get("/customers/search?q=washington&limit=1")
+        self.assertEqual(len(resp.get_json()), 1)
+        link = resp.headers["Link"]
+        self.assertIn("offset=1", link)
+        resp = self.app.get(link[link.index("<") + 1:link.index(">")])
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertNotIn("Link", resp.headers)
+        resp = self.app.get("/customers/search?q=zzzz")
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get("/customers/search?q=a.b")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/customers/search?q=sally&offset=1000")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_patch_customer(self):
+        """ Update some fields of a Customer """
+        self._create_customers("Alex").create()
+        resp = self.app.patch(
+            "/customers/1", json={"address": "1 Wall Street", "active": False}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["address"], "1 Wall Street")
+        self.assertEqual(data["active"], False)
+        self.assertEqual(data["name"], "Alex")
+        self.assertEqual(resp.headers["ETag"], '"1.2"')
+        resp = self.app.patch("/customers/1", json={"active": "no"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch("/customers/1", json={"id": 5})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # an empty patch leaves the version alone
+        resp = self.app.patch("/customers/1", json={})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("No fields to update", resp.get_json()["message"])
+        resp = self.app.get("/customers/1")
+        self.assertEqual(resp.headers["ETag"], '"1.2"')
+        resp = self.app.patch("/customers/9", json={"name": "Nobody"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_patch_customers_bulk(self):
+        """ Update many Customers with one statement """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        self.assertIsNotNone(Customer.find(1))
+        resp = self.app.patch("/customers", json={"ids": [1, 3, 7], "address": "Moved"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"updated": 2})
+        # the cached copy of Customer 1 was dropped
+        resp = self.app.get("/customers/1")
+        self.assertEqual(resp.get_json()["address"], "Moved")
+        self.assertEqual(resp.headers["ETag"], '"1.2"')
+        resp = self.app.patch("/customers?name__in=Sally,John", json={"phone_number": "555"})
+        self.assertEqual(resp.get_json(), {"updated": 2})
+        resp = self.app.get("/customers?phone_number=555&fields=id")
+        self.assertEqual(resp.get_json(), [{"id": 2}, {"id": 3}])
+        # every update needs a selection, fields to change and valid values
+        resp = self.app.patch("/customers", json={"address": "Everywhere"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch("/customers", json={"ids": [1]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch("/customers", json={"ids": ["1"], "name": "X"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_deactivate_customers_bulk(self):
+        """ Deactivate and activate many Customers at once """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        resp = self.app.put("/customers/deactivate", json={"ids": [1, 2]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"updated": 2})
+        resp = self.app.get("/customers?active=false&fields=id")
+        self.assertEqual(resp.get_json(), [{"id": 1}, {"id": 2}])
+        resp = self.app.put("/customers/activate?active=false")
+        self.assertEqual(resp.get_json(), {"updated": 2})
+        resp = self.app.put("/customers/deactivate")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_customers_bulk(self):
+        """ Delete many Customers with one request """
+        for name in ["Alex", "Sally", "John", "Jane"]:
+            self._create_customers(name).create()
+        resp = self.app.delete("/customers?ids=1,2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"deleted": 2})
+        resp = self.app.delete("/customers?name__prefix=J&ids=3")
+        self.assertEqual(resp.get_json(), {"deleted": 1})
+        resp = self.app.get("/customers?fields=name")
+        self.assertEqual(resp.get_json(), [{"name": "Jane"}])
+        resp = self.app.delete("/customers")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.delete("/customers?ids=1,x")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ids_only_in_bulk_delete(self):
+        """ Refuse ids in the query string of every route but the bulk delete """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        resp = self.app.get("/customers?ids=1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("id__in", resp.get_json()["message"])
+        resp = self.app.patch("/customers?ids=1,2&active=true", json={"name": "Bulk"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put("/customers/deactivate?ids=1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/customers?name=Bulk")
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get("/customers?id__in=1,2&fields=id")
+        self.assertEqual(resp.get_json(), [{"id": 1}, {"id": 2}])
+        resp = self.app.delete("/customers?ids=1&ids=3")
+        self.assertEqual(resp.get_json(), {"deleted": 2})
+
+    def test_bulk_refuses_paging(self):
+        """ Refuse to page a bulk change, which would apply to every match """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        for query in ("active=true&limit=1", "active=true&after_id=1", "active=true&sort=name"):
+            resp = self.app.delete("/customers?" + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.put("/customers/deactivate?" + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch("/customers?fields=id", json={"ids": [1], "name": "Bulk"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("fields", resp.get_json()["message"])
+        resp = self.app.get("/customers?active=true&fields=id")
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_soft_delete_customers(self):
+        """ Hide soft deleted Customers from every read """
+        for name in ["Alex", "Sally", "John"]:
+            self._create_customers(name).create()
+        Customer.soft_delete = True
+        try:
+            resp = self.app.delete("/customers/1")
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+            resp = self.app.delete("/customers?ids=2")
+            self.assertEqual(resp.get_json(), {"deleted": 1})
+        finally:
+            Customer.soft_delete = False
+        resp = self.app.get("/customers/1")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("/customers?fields=id")
+        self.assertEqual(resp.get_json(), [{"id": 3}])
+        resp = self.app.put("/customers/activate?active=true")
+        self.assertEqual(resp.get_json(), {"updated": 1})
+        resp = self.app.get("/customers/search?q=sally")
+        self.assertEqual(resp.get_json(), [])
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["customers-purge", "--older-than", "0", "--pause", "0"])
+        self.assertIn("Purged 2 customers", result.output)
+        self.assertEqual(Customer.query.count(), 1)
+
+    def test_export_import_customers(self):
+        """ Export the Customers and import them again """
+        for name in ["Alex", "Sally"]:
+            self._create_customers(name).create()
+        resp = self.app.get("/customers/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        exported = resp.get_data()
+        self.assertEqual(len(exported.splitlines()), 3)
+        resp = self.app.get("/customers/export?format=ndjson")
+        self.assertEqual(len(resp.get_data().splitlines()), 2)
+        resp = self.app.post("/customers/import", data=exported, content_type="text/csv")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json(), {"created": 2})
+        self.assertEqual(len(self.app.get("/customers").get_json()), 4)
+        resp = self.app.post(
+            "/customers/import", data=b'{"name": "x"}\n', content_type="application/x-ndjson"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/customers/export?format=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/customers/import", data=exported, content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
@@ -0,0 +1,39 @@
+"""
+Test cases for the Customer Search
+
+"""
+import unittest
+from service.search import NgramIndex, trigrams
+
+
+######################################################################
+#  S E A R C H   T E S T   C A S E S
+######################################################################
+class TestSearch(unittest.TestCase):
+    """ Test Cases for the in-process trigram index """
+
+    def test_trigrams(self):
+        """ Split words into padded trigrams like pg_trgm """
+        self.assertEqual(trigrams("Cat"), {"  c", " ca", "cat", "at "})
+        self.assertEqual(trigrams("a-b"), {"  a", " a ", "  b", " b "})
+        self.assertEqual(trigrams(None), set())
+
+    def test_search(self):
+        """ Rank the documents matching most trigrams first """
+        index = NgramIndex()
+        index.build(
+            [
+                (1, "Sally Ride", "55 Washington Square"),
+                (2, "Washington Irving", None),
+                (3, "John Jay", "52 Broadway"),
+            ],
+            version=1,
+        )
+        self.assertTrue(index.is_current(1))
+        self.assertFalse(index.is_current(2))
+        self.assertEqual([key for key, _ in index.search("washington")], [1, 2])
+        self.assertEqual([key for key, _ in index.search("washington", 1, 1)], [2])
+        self.assertEqual(index.search("broadwya")[0][0], 3)
+        self.assertLess(index.search("broadwya")[0][1], 1.0)
+        self.assertEqual(index.search("?!"), [])
+        self.assertEqual(index.search("zebra"), [])